@@ -7,8 +7,39 @@ from rest_framework.exceptions import ValidationError
 
 
 # not real randint but 3x faster
-def randint(low, high):
-    return low + int(random.random() * (high - low + 1))
+def randint(low, high, rng=random):
+    return low + int(rng.random() * (high - low + 1))
+
+
+# 重複 n 次機率為 p 的判定，回傳成功次數
+# 以幾何分布直接跳到下一次成功，只需約 n * p + 1 個亂數，成功次數的分布與逐次判定相同
+def binomial(n, p, rng=random):
+    if p >= 1:
+        return n
+    if p <= 0:
+        return 0
+
+    log_q = math.log(1 - p)
+    count = 0
+    trials = 0
+    while True:
+        trials += int(math.log(1 - rng.random()) / log_q) + 1
+        if trials > n:
+            return count
+        count += 1
+
+
+# n 次判定中各結果發生的次數，probabilities 的總和不超過 1，其餘的機率為皆未發生
+# 依序以剩餘的次數與條件機率決定各結果的次數，分布與逐次判定相同
+def multinomial(n, probabilities, rng=random):
+    counts = []
+    rest_probability = 1
+    for probability in probabilities:
+        count = binomial(n, probability / rest_probability if rest_probability > 0 else 1, rng)
+        n -= count
+        rest_probability -= probability
+        counts.append(count)
+    return counts
 
 
 def sigmoid(n, base):
@@ -28,33 +59,77 @@ def add_class(dictionary):
 
 
 def get_items(field, limit, items):
+    """
+    將物品加入 field（多對多），同類型的非裝備物品合併後只寫入一次，新物品以一個 INSERT 加入中介表
+    和逐一加入時相同，只在加入前檢查一次數量上限
+    """
+    from item.models import Item, bulk_create_items
+    from item.pools import item_type_pools
+
     if not items:
         return
 
     if field.count() >= limit:
         raise ValidationError("物品已滿")
 
+    # 以 type_id 建立的物品改用快取的 ItemType，判斷類別時不需逐一查詢
+    for item in items:
+        if not Item.type.is_cached(item):
+            item.type = item_type_pools.get_item_type(item.type_id)
+    items = merge_items(items)
     exists_item_by_type = {
         item.type_id: item for item in
         field.filter(type__in=[x.type for x in items if x.type.category_id != 1])
     }
 
+    changed_items = {}
+    merged_item_ids = []
+    new_items = []
     for item in items:
         assert item.number > 0
 
         if item.type_id in exists_item_by_type:
-            exists_item_by_type[item.type_id].number += item.number
-            exists_item_by_type[item.type_id].save()
+            exists_item = exists_item_by_type[item.type_id]
+            exists_item.number += item.number
+            changed_items[exists_item.type_id] = exists_item
             if item.id is not None:
-                item.delete()
+                merged_item_ids.append(item.id)
         else:
-            if item.id is None:
-                item.save()
-            field.add(item)
+            new_items.append(item)
 
             if item.type.category_id != 1:
                 exists_item_by_type[item.type_id] = item
 
+    # 尚未建立的物品稍後以合併後的數量建立
+    for item in changed_items.values():
+        if item.id is not None:
+            item.save()
+    if merged_item_ids:
+        Item.objects.filter(id__in=merged_item_ids).delete()
+
+    bulk_create_items([x for x in new_items if x.id is None])
+    field.through.objects.bulk_create([
+        field.through(**{field.source_field_name: field.instance, field.target_field_name: item})
+        for item in new_items
+    ])
+
+
+def merge_items(items):
+    """
+    將尚未存檔、同類型的非裝備物品合併為一個
+    """
+    merged = []
+    item_by_type = {}
+    for item in items:
+        if item.id is not None or item.type.category_id == 1:
+            merged.append(item)
+        elif item.type_id in item_by_type:
+            item_by_type[item.type_id].number += item.number
+        else:
+            item_by_type[item.type_id] = item
+            merged.append(item)
+    return merged
+
 
 def lose_items(field, items, mode='delete'):
     assert mode in ['delete', 'return']
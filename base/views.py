@@ -7,6 +7,7 @@ from rest_framework.exceptions import ValidationError, PermissionDenied
 from rest_framework.response import Response
 
 from town.models import Town
+from chara.counters import chara_counters
 from chara.models import Chara
 from country.models import Country, CountryOfficial
 
@@ -113,12 +114,16 @@ class LockObjectMixin:
 
 class CharaProcessPayloadViewMixin:
     lock_chara = True
+    # 讀取戰鬥紀錄與屬性熟練時加上尚未寫入資料庫的累積值
+    with_chara_counters = False
 
     with_instance = False
     lock_instance = False
 
     def process_payload(self, request):
         chara = self.get_chara(lock=self.lock_chara)
+        if self.with_chara_counters:
+            chara_counters.apply_pending(chara.id, record=chara.record, attributes=chara.attrs.values())
         if self.with_instance:
             serializer = self.get_serializer(self.get_object(lock=self.lock_instance), data=request.data)
         else:
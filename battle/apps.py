@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BattleConfig(AppConfig):
     name = 'battle'
+
+    def ready(self):
+        from battle.signals import connect_signals
+        connect_signals()
@@ -1,27 +1,40 @@
-from random import choice, choices, random
+import random
+from time import perf_counter
 from statistics import mean
-from collections import Counter
+from functools import wraps
+from itertools import accumulate
+from collections import Counter, deque
+from contextlib import nullcontext
+from django.conf import settings
 from django.utils.timezone import localtime
 
 from base.utils import randint, sigmoid
 from battle.models import Monster, WorldBoss
+from battle.executor import execute_battle
+from battle.instrumentation import BattleMetrics
+from battle.loader import BattleSourceLoader, EmptyEquipment, serialize_ability, deserialize_ability
+from battle.log_format import LOG_FORMATS, LOG_LEVELS, diff_profiles
 from chara.models import Chara
 from npc.models import NPC
 from ugc.models import UGCMonster
-from item.models import Equipment
 
 
-class EmptyEquipment:
-    name = '無裝備'
+def cached_stat(func):
+    """
+    快取衍生數值，裝備、加成或奧義變動時須呼叫 BattleChara.invalidate_stats
+    """
+    name = func.__name__
 
-    attack = 0
-    defense = 0
-    weight = 0
-
-    ability_1 = None
-    ability_2 = None
+    @property
+    @wraps(func)
+    def wrapper(self):
+        try:
+            return self.stats_cache[name]
+        except KeyError:
+            value = self.stats_cache[name] = func(self)
+            return value
 
-    element_type_id = None
+    return wrapper
 
 
 class BattleParams:
@@ -61,10 +74,23 @@ class BattleParams:
 class Battle:
     def __init__(
         self, attackers, defenders, battle_type,
-        element_type=None, attacker_bonus=1, defender_bonus=1, context=None
+        element_type=None, attacker_bonus=1, defender_bonus=1, context=None, log_format='full', seed=None,
+        log_level='full', instrument=None, stalemate_window=None
     ):
+        start = perf_counter()
         assert battle_type in ['pvp', 'pve', 'dungeon', 'world_boss', 'mirror', 'ugc_dungeon', 'adventure']
+        assert log_format in LOG_FORMATS
+        assert log_level in LOG_LEVELS
         self.battle_type = battle_type
+        self.log_format = log_format
+        # summary 模式不產生每次行動的訊息與 profile，只在戰鬥結束時記錄一次 profile
+        self.log_level = log_level
+        # 所有隨機數皆由 seed 產生，相同的 seed 與參戰者資料可重現同一場戰鬥
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        if instrument is None:
+            instrument = settings.BATTLE_INSTRUMENTATION
+        self.metrics = BattleMetrics(battle_type, self.seed) if instrument else None
         self.element_type = element_type
         self.attacker_bonus = attacker_bonus
         self.defender_bonus = defender_bonus
@@ -76,10 +102,19 @@ class Battle:
             isinstance(context, dict)
             self.context = context
 
-        self.charas = [BattleChara(x, battle=self, team='attacker') for x in attackers] + \
-            [BattleChara(x, battle=self, team='defender') for x in defenders]
+        attackers = list(attackers)
+        defenders = list(defenders)
+        with self.timer('loading'):
+            snapshots = BattleSourceLoader(summon_filter=self.can_summon).load(attackers + defenders)
+        self.attacker_snapshots = snapshots[:len(attackers)]
+        self.defender_snapshots = snapshots[len(attackers):]
+
+        self.rosters = None
+        self.charas = [BattleChara(x, battle=self, team='attacker') for x in snapshots[:len(attackers)]] + \
+            [BattleChara(x, battle=self, team='defender') for x in snapshots[len(attackers):]]
         self.summon()
         self.rename_charas()
+        self.update_rosters()
 
         self.params = BattleParams()
         for effect in self.effects:
@@ -87,17 +122,81 @@ class Battle:
 
         self.executed = False
         self.logs = []
+        self.last_profiles = None
         self.rounds = 0
 
         self.actions = 0
         self.max_actions = (len(attackers) + len(defenders)) * 2 * self.params['max_rounds']
 
+        # 連續 stalemate_window 回合雙方的 HP、MP 皆未改變時提前以平手結束，0 為不偵測
+        # 奧義類型47:覺醒、50:霸氣的攻擊力隨回合數成長，僵局可能被打破，不偵測
+        if stalemate_window is None:
+            stalemate_window = settings.BATTLE_STALEMATE_WINDOWS.get(battle_type, 0)
+        if any(47 in chara.ability_types or 50 in chara.ability_types for chara in self.charas):
+            stalemate_window = 0
+        self.stalemate_window = stalemate_window
+        self.stalemate_history = deque()
+        self.stalemate = False
+
+        if self.metrics is not None:
+            self.metrics.timings['construction'] += perf_counter() - start - self.metrics.timings['loading']
+
+    def replay_data(self):
+        """
+        重現此戰鬥所需的資料，可存成 JSON 並以 Battle.replay 重新產生戰鬥紀錄
+        """
+        data = {
+            'battle_type': self.battle_type,
+            'element_type': None if self.element_type is None else self.element_type.id,
+            'attacker_bonus': self.attacker_bonus,
+            'defender_bonus': self.defender_bonus,
+            'log_format': self.log_format,
+            'seed': self.seed,
+            'stalemate_window': self.stalemate_window,
+            'attackers': [x.serialize() for x in self.attacker_snapshots],
+            'defenders': [x.serialize() for x in self.defender_snapshots],
+        }
+        if 'adventure_abilities' in self.context:
+            data['adventure_abilities'] = [serialize_ability(x) for x in self.context['adventure_abilities']]
+        return data
+
+    @classmethod
+    def replay(cls, data, log_level='full', loader=None):
+        battle = cls.from_replay_data(data, log_level=log_level, loader=loader, instrument=False)
+        battle.execute()
+        return battle
+
+    @classmethod
+    def from_replay_data(cls, data, log_level='full', loader=None, instrument=None):
+        if loader is None:
+            loader = BattleSourceLoader()
+        element_types = loader.get_element_types()
+
+        context = {}
+        if 'adventure_abilities' in data:
+            context['adventure_abilities'] = [deserialize_ability(x) for x in data['adventure_abilities']]
+
+        return cls(
+            attackers=[loader.deserialize(x) for x in data['attackers']],
+            defenders=[loader.deserialize(x) for x in data['defenders']],
+            battle_type=data['battle_type'],
+            element_type=None if data['element_type'] is None else element_types[data['element_type']],
+            attacker_bonus=data['attacker_bonus'],
+            defender_bonus=data['defender_bonus'],
+            context=context,
+            log_format=data['log_format'],
+            seed=data['seed'],
+            log_level=log_level,
+            instrument=instrument,
+            # 加入僵局偵測前保存的戰鬥皆執行至回合數上限
+            stalemate_window=data.get('stalemate_window', 0),
+        )
+
     @property
     def winner(self):
-        charas = self.alive_charas
-        if not any(chara.team == 'attacker' for chara in charas):
+        if not self.rosters['attacker']:
             return "defender"
-        elif not any(chara.team == 'defender' for chara in charas):
+        elif not self.rosters['defender']:
             return "attacker"
         else:
             return "draw"
@@ -113,13 +212,16 @@ class Battle:
         else:
             return "draw"
 
+    def can_summon(self, partner):
+        if partner.due_time < localtime():
+            return False
+        return self.battle_type in ['pve', 'mirror', 'ugc_dungeon'] or \
+            (self.battle_type == 'dungeon' and partner.target_npc_id is not None)
+
     def summon(self):
         for chara in self.charas[:]:
-            partner = getattr(chara.source, 'partner', None)
-            if partner is not None and partner.due_time >= localtime():
-                if self.battle_type in ['pve', 'mirror', 'ugc_dungeon'] or (self.battle_type == 'dungeon' and partner.target_npc):
-                    obj = partner.target_chara or partner.target_monster or partner.target_npc
-                    self.charas.append(BattleChara(obj, battle=self, team=chara.team))
+            if chara.partner is not None:
+                self.charas.append(BattleChara(chara.partner, battle=self, team=chara.team))
 
     def rename_charas(self):
         total_counter = Counter([x.name for x in self.charas])
@@ -132,37 +234,79 @@ class Battle:
 
     def execute(self):
         assert not self.executed
-        self.executed = True
+        execute_battle(self)
 
-        self.before_execute()
+        if self.metrics is not None:
+            self.metrics.report()
 
-        while True:
-            self.logs.append({'actions': []})
-
-            act_chara = self.get_act_chara()
-            if act_chara is None:
-                self.next_round()
-            else:
-                act_chara.take_action()
-                self.actions += 1
-                self.logs[-1]['charas'] = [chara.profile for chara in self.charas]
+    def run(self):
+        assert not self.executed
+        self.executed = True
 
-            if self.winner != 'draw' or self.rounds >= self.params['max_rounds'] or self.actions >= self.max_actions:
-                break
+        with self.timer('before_execute'):
+            self.before_execute()
+
+        with self.timer('loop'):
+            while True:
+                act_chara = self.get_act_chara()
+                if act_chara is None:
+                    self.next_round(self.rounds_until_next_action())
+                elif self.log_level == 'full':
+                    self.logs.append({'actions': []})
+                    act_chara.take_action()
+                    self.actions += 1
+                    self.log_profiles()
+                else:
+                    act_chara.take_action()
+                    self.actions += 1
+
+                if self.winner != 'draw' or self.rounds >= self.params['max_rounds'] or \
+                        self.actions >= self.max_actions or self.stalemate:
+                    break
+
+        with self.timer('finalization'):
+            if self.stalemate and self.log_level == 'full':
+                self.logs[-1]['actions'].append({'team': None, 'chara': None, 'message': '雙方陷入僵局，戰鬥提前結束'})
+            if self.log_level == 'summary':
+                self.logs.append({'actions': [], 'charas': [chara.profile for chara in self.charas]})
+            if self.metrics is not None:
+                self.count_metrics()
+
+    def timer(self, name):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer(name)
+
+    def count_metrics(self):
+        self.metrics.counters.update({'actions': self.actions, 'rounds': self.rounds, 'log_entries': len(self.logs)})
+        if self.stalemate:
+            self.metrics.counters.update({
+                'stalemates': 1, 'stalemate_rounds_saved': self.params['max_rounds'] - self.rounds
+            })
+        for chara in self.charas:
+            skill_types = {x.skill.id: x.skill.type_id for x in chara.skill_settings}
+            for skill_id, times in chara.skill_counter.items():
+                self.metrics.skill_casts[skill_types[skill_id]] += times
 
     def before_execute(self):
-        self.logs.append({'actions': [{'team': None, 'chara': None, 'message': '戰鬥開始'}]})
+        if self.log_level == 'full':
+            self.logs.append({'actions': [{'team': None, 'chara': None, 'message': '戰鬥開始'}]})
+            if self.log_format == 'delta':
+                self.logs[-1]['log_format'] = 'delta'
 
         for chara in self.alive_charas:
             if chara.has_ability_type(68):
                 if chara.is_admin:
-                    chara.log(f"{chara.name}使用了管理員權限")
+                    chara.log("{}使用了管理員權限", chara.name)
                     for enemy in chara.alive_enemy_charas:
                         enemy.hp = 0
-                        enemy.log(f"{enemy.name}的HP歸零了")
+                        enemy.log("{}的HP歸零了", enemy.name)
                 else:
                     chara.hp = 0
-                    chara.log(f"檢測到{chara.name}進行違規操作，HP已歸零")
+                    chara.log("檢測到{}進行違規操作，HP已歸零", chara.name)
+
+        if self.log_level == 'summary':
+            return
 
         for effect in self.effects:
             self.logs[-1]['actions'].append(
@@ -182,17 +326,91 @@ class Battle:
                 {'team': None, 'chara': None, 'message': f'{name}：{round(self.params[field],2):g}'}
             )
 
-        self.logs[-1]['charas'] = [chara.profile for chara in self.charas]
+        self.log_profiles()
 
-    @property
-    def alive_charas(self):
-        return [chara for chara in self.charas if chara.hp > 0]
+    def log_profiles(self):
+        # delta 格式只在第一筆紀錄保存完整 profile，之後只保存有變化的欄位
+        profiles = [chara.profile for chara in self.charas]
+        if self.log_format == 'full' or self.last_profiles is None:
+            self.logs[-1]['charas'] = profiles
+        else:
+            self.logs[-1]['chara_changes'] = diff_profiles(self.last_profiles, profiles)
+        self.last_profiles = profiles
+
+    def update_rosters(self):
+        """
+        角色的 HP 跨過 0 時（倒下、復活、即死）重建存活名單
+        名單只會整個替換，不會原地修改，迭代中的舊名單不受影響
+        """
+        self.alive_charas = [chara for chara in self.charas if chara.hp > 0]
+        self.rosters = {
+            team: [chara for chara in self.alive_charas if chara.team == team]
+            for team in ['attacker', 'defender']
+        }
+        self.target_weights = {}
+
+    def get_target_weights(self, team):
+        # 依仇恨值選擇目標的累積權重，名單或仇恨值變動時才重新計算
+        try:
+            return self.target_weights[team]
+        except KeyError:
+            weights = self.target_weights[team] = list(accumulate(chara.hate for chara in self.rosters[team]))
+            return weights
 
-    def next_round(self):
-        self.rounds += 1
+    def invalidate_target_weights(self, team):
+        self.target_weights.pop(team, None)
+
+    def next_round(self, rounds=1):
+        self.rounds += rounds
 
         for chara in self.alive_charas:
-            chara.increase_action_points()
+            chara.increase_action_points(rounds)
+
+        if self.stalemate_window:
+            self.check_stalemate()
+
+    def check_stalemate(self):
+        """
+        stalemate_window 回合內所有角色的 HP、MP 皆維持不變，與 stalemate_window 回合前相比其餘會讓戰局推進的狀態皆未改變，
+        且沒有角色的 HP 低於一半，即視為僵局，以平手或 hp_winner 提前結束
+        此為推測：之後的回合仍可能因機率打破僵局，結果不保證與執行至回合數上限時相同
+        """
+        state = [
+            (chara.hp, chara.mp, chara.hp_max, chara.attack, chara.defense, chara.magic_defense, chara.speed,
+             chara.poison, chara.bleed, chara.vulnerable, chara.eva_add, chara.buff_count,
+             chara.blocked_ability_count)
+            for chara in self.charas
+        ]
+        history = self.stalemate_history
+        history.append((self.rounds, state))
+
+        start = self.rounds - self.stalemate_window
+        while len(history) > 1 and history[1][0] <= start:
+            history.popleft()
+
+        rounds, previous_state = history[0]
+        if rounds > start:
+            return
+        for current, previous in zip(state, previous_state):
+            if current[2:] != previous[2:]:
+                return
+        # 期間內 HP、MP 回復或先減少再回復時，結束時的數值取決於剩餘的回合數，不視為僵局
+        for _, past_state in history:
+            for current, past in zip(state, past_state):
+                if current[:2] != past[:2]:
+                    return
+        for chara_state in state:
+            if chara_state[0] * 2 < chara_state[2]:
+                return
+        self.stalemate = True
+
+    def rounds_until_next_action(self):
+        # 沒有角色行動的回合中屬性不會變化，直接跳到第一個 AP 達到 1000 的回合
+        rounds = min(
+            -(-(1000 - chara.action_points) // chara.action_points_per_round)
+            for chara in self.alive_charas
+        )
+        return int(max(1, min(rounds, self.params['max_rounds'] - self.rounds)))
 
     def get_act_chara(self):
         charas = self.alive_charas
@@ -206,7 +424,7 @@ class Battle:
         if len(charas) == 1:
             return charas[0]
         else:
-            return choice(charas)
+            return self.rng.choice(charas)
 
     def find_chara_by_source(self, source):
         for chara in self.charas:
@@ -215,27 +433,38 @@ class Battle:
 
 
 class BattleChara:
-    def __init__(self, source, battle, team):
+    def __init__(self, snapshot, battle, team):
         self.battle = battle
         self.team = team
+        self.enemy_team = 'defender' if team == 'attacker' else 'attacker'
+        self._hp = 0
 
+        source = snapshot.source
         self.source = source
+        self.partner = snapshot.partner
         self.skill_counter = Counter()
-        self.name = source.name
-        self.element_type = source.element_type
-        self.is_admin = getattr(source, 'is_admin', False)
+        self.name = snapshot.name
+        self.element_type = snapshot.element_type
+        self.is_admin = snapshot.is_admin
+        self.luck_sigmoid = snapshot.luck_sigmoid
         self.action_points = 0
+        self.stats_cache = {}
+
+        self.skill_settings = snapshot.skill_settings
 
-        self.skill_settings = list(source.skill_settings.all().order_by('order').select_related('skill'))
+        # 統計奧義查詢次數
+        if battle.metrics is not None:
+            self.has_ability_type = self.counted_has_ability_type
+            self.ability_type_power = self.counted_ability_type_power
 
         if isinstance(source, Chara):
-            self.create_from_chara(source)
+            self.create_from_chara(snapshot)
         elif isinstance(source, (Monster, WorldBoss, NPC, UGCMonster)):
-            self.create_from_monster(source)
+            self.create_from_monster(snapshot)
         else:
             raise Exception("illegal source")
 
-        self.set_attributes()
+        self.set_attributes(snapshot)
         for field in ['hp', 'hp_max', 'mp', 'mp_max']:
             setattr(self, field, int(getattr(self, field) * self.bonus))
 
@@ -254,15 +483,18 @@ class BattleChara:
         self.weapon_effect_blocked_flag = False
         self.reduced_skill_rate = 0
         self.vulnerable = 0
+        self.damage_dealt = 0
 
         # 奧義類型15:增加初始AP
         self.action_points += self.ability_type_power(15)
 
-    def set_attributes(self):
-        for attr in self.source.attributes.all().select_related('type'):
+        self.compile_hooks()
+
+    def set_attributes(self, snapshot):
+        for attr in snapshot.attributes:
             attr_value = int(attr.value * self.bonus)
             if isinstance(self.source, Chara):
-                attr_value = int(attr_value * (1 + self.source.buff_effect_power(attr.type.id) / 100))
+                attr_value = int(attr_value * (1 + snapshot.buff_effect_power(attr.type.id) / 100))
 
             if self.battle.element_type is not None:
                 if self.element_type == self.battle.element_type and self.element_type.id != 'none':
@@ -271,20 +503,13 @@ class BattleChara:
                     attr_value = int(attr_value * 0.9)
             setattr(self, attr.type.en_name, attr_value)
 
-    def create_from_chara(self, chara):
+    def create_from_chara(self, snapshot):
         # 裝備
-        self.equipments = {}
-        for slot in chara.slots.all().select_related('item__equipment__battle_effect', 'item__type'):
-            if slot.item:
-                self.equipments[slot.type_id] = slot.item.equipment
-                battle_effect = slot.item.equipment.battle_effect
-                if battle_effect:
-                    self.battle.effects.append(battle_effect)
-            else:
-                self.equipments[slot.type_id] = EmptyEquipment()
+        self.equipments = dict(snapshot.equipments)
+        self.battle.effects.extend(snapshot.battle_effects)
 
         # 奧義
-        self.ability_types = chara.equipped_ability_types
+        self.ability_types = dict(snapshot.ability_types)
 
         # 冒險模式
         if self.battle.battle_type == 'adventure':
@@ -297,14 +522,12 @@ class BattleChara:
 
         # hp, mp
         for field in ['hp', 'hp_max', 'mp', 'mp_max']:
-            setattr(self, field, getattr(chara, field))
+            setattr(self, field, getattr(snapshot, field))
 
         if self.battle.battle_type == 'pvp':
             self.hp = self.hp_max
             self.mp = self.mp_max
 
-        self.luck_sigmoid = chara.luck_sigmoid
-
         # 同屬武防提升HP
         equipmen_hp_bonus = 0.1 * \
             (int(self.equipments[1].element_type_id == self.element_type.id) +
@@ -316,27 +539,20 @@ class BattleChara:
         self.mp_max += int(self.mp_max * equipmen_mp_bonus)
         self.mp += int(self.mp * equipmen_mp_bonus)
 
-    def create_from_monster(self, monster):
+    def create_from_monster(self, snapshot):
         # 裝備
         self.equipments = {}
         for i in range(1, 5):
             self.equipments[i] = EmptyEquipment()
 
         # 奧義
-        abilities = list(monster.abilities.all())
-        self.ability_types = {
-            ability.type_id: ability
-            for ability in sorted(abilities, key=lambda x: x.power)
-        }
+        self.ability_types = dict(snapshot.ability_types)
 
-        if isinstance(self.source, WorldBoss):
-            for field in ['hp', 'hp_max', 'mp', 'mp_max']:
-                setattr(self, field, getattr(monster, field))
-        elif isinstance(self.source, (Monster, NPC, UGCMonster)):
-            self.hp = self.hp_max = monster.hp
-            self.mp = self.mp_max = monster.mp
+        for field in ['hp', 'hp_max', 'mp', 'mp_max']:
+            setattr(self, field, getattr(snapshot, field))
 
-        self.luck_sigmoid = 0.5
+    def randint(self, low, high):
+        return randint(low, high, self.battle.rng)
 
     @property
     def bonus(self):
@@ -346,26 +562,26 @@ class BattleChara:
             return self.battle.defender_bonus
         return 1
 
-    @property
+    @cached_stat
     def attack(self):
         # 奧義類型18:魔法劍
         return self.attack_add_on + self.str + int(self.int * self.ability_type_power(18)) + \
             sum(x.attack for x in self.equipments.values()) + self.equipments[1].weight // 5
 
-    @property
+    @cached_stat
     def defense(self):
         return self.defense_add_on + self.vit + sum(x.defense for x in self.equipments.values())
 
-    @property
+    @cached_stat
     def magic_defense(self):
         return self.magic_defense_add_on + (self.men + self.equipments[4].defense) // 2
 
-    @property
+    @cached_stat
     def speed(self):
         speed = self.speed_add_on + self.agi - sum(x.weight for x in self.equipments.values())
         return max(100, speed)
 
-    @property
+    @cached_stat
     def critical(self):
         # 奧義類型10:暴擊率提升
         critical = min(self.battle.params['critical_rate_upper_bound'], 0.02 + self.dex / 3000)
@@ -390,13 +606,24 @@ class BattleChara:
     def hate(self):
         return 100 + self.ability_type_power(59)
 
+    @property
+    def hp(self):
+        return self._hp
+
+    @hp.setter
+    def hp(self, value):
+        crossed = (value > 0) != (self._hp > 0)
+        self._hp = value
+        if crossed and self.battle.rosters is not None:
+            self.battle.update_rosters()
+
     @property
     def alive_enemy_charas(self):
-        return [chara for chara in self.battle.alive_charas if chara.team != self.team]
+        return self.battle.rosters[self.enemy_team]
 
     def pick_alive_enemy_chara(self):
-        charas = self.alive_enemy_charas
-        return choices(charas, weights=[x.hate for x in charas])[0]
+        charas = self.battle.rosters[self.enemy_team]
+        return self.battle.rng.choices(charas, cum_weights=self.battle.get_target_weights(self.enemy_team))[0]
 
     def take_action(self):
         self.before_action()
@@ -408,7 +635,7 @@ class BattleChara:
         if self.effects['confusion'] > 0:
             defenders = [self]
         # 奧義類型63:全體攻擊
-        elif self.has_ability_type(63) and randint(1, 4) == 1 and \
+        elif self.has_ability_type(63) and self.randint(1, 4) == 1 and \
                 (skill is None or skill.type_id not in [2, 3, 4, 5, 6, 19]):
             defenders = self.alive_enemy_charas
         else:
@@ -429,16 +656,24 @@ class BattleChara:
 
         self.after_action()
 
-    def log(self, message):
-        self.battle.logs[-1]['actions'].append({'team': self.team, 'chara': self.name, 'message': message})
+    def log(self, message, *args):
+        # 訊息以樣板與參數傳入，summary 模式下不格式化
+        if self.battle.log_level == 'full':
+            self.battle.logs[-1]['actions'].append(
+                {'team': self.team, 'chara': self.name, 'message': message.format(*args)}
+            )
 
-    def increase_action_points(self):
+    @property
+    def action_points_per_round(self):
         # 奧義類型53:天使之翼
-        self.action_points += int(self.speed * (1 + self.ability_type_power(53)))
+        return int(self.speed * (1 + self.ability_type_power(53)))
+
+    def increase_action_points(self, rounds=1):
+        self.action_points += self.action_points_per_round * rounds
 
     def get_skill(self, defender):
         if self.effects['silence'] > 0:
-            self.log(f"{self.name}處於沉默狀態，無法發動技能")
+            self.log("{}處於沉默狀態，無法發動技能", self.name)
             return None
 
         for skill_setting in self.skill_settings:
@@ -447,7 +682,7 @@ class BattleChara:
                     and defender.hp / defender.hp_max * 100 <= skill_setting.defender_hp_percentage \
                     and defender.mp / defender.mp_max * 100 <= skill_setting.defender_mp_percentage \
                     and (skill_setting.times_limit == 0 or self.skill_counter[skill_setting.skill.id] < skill_setting.times_limit) \
-                    and skill_setting.probability >= randint(1, 100):
+                    and skill_setting.probability >= self.randint(1, 100):
                 break
         else:
             return None
@@ -461,14 +696,14 @@ class BattleChara:
         # 無防
         if self.has_equipment_effect(2, 1):
             mp_cost -= int(mp_cost * 0.5)
-            self.log(f"[無防特效]{self.name}的技能MP消耗降低")
+            self.log("[無防特效]{}的技能MP消耗降低", self.name)
 
         # 奧義類型25:戰技激發
         if self.has_ability_type(25):
             rate += rate // 2
         rate -= int(rate * self.reduced_skill_rate)
 
-        if self.mp >= mp_cost and rate >= randint(1, 100):
+        if self.mp >= mp_cost and rate >= self.randint(1, 100):
             self.mp -= mp_cost
             self.skill_counter[skill.id] += 1
             return skill
@@ -480,32 +715,32 @@ class BattleChara:
         if self.poison > 0:
             hp_loss = min(self.hp - 1, int(self.hp_max * self.poison / 100))
             self.hp -= hp_loss
-            self.log(f"{self.name}因中毒失去了{hp_loss}點 HP")
+            self.log("{}因中毒失去了{}點 HP", self.name, hp_loss)
 
-            if 20 + self.ability_type_power(42) > randint(1, 100):
+            if 20 + self.ability_type_power(42) > self.randint(1, 100):
                 self.poison = 0
-                self.log(f"{self.name}成功解掉身上的毒")
+                self.log("{}成功解掉身上的毒", self.name)
             elif self.poison >= 10:
                 self.poison -= 1
-                self.log(f"{self.name}身上的毒性降低至{self.poison}層")
+                self.log("{}身上的毒性降低至{}層", self.name, self.poison)
 
-        # 奧義類型61:受攻擊回血(優先於再生術及群體再生，且無法同時發動)
-        if self.has_ability_type(61):
-            pass
-        # 奧義類型62:群體回血
-        elif self.has_ability_type(62):
-            charas = [chara for chara in self.battle.charas if chara.team == self.team and chara.hp > 0]
-            hp_percentage = self.ability_type_power(62) / len(charas)
-            for chara in charas:
-                hp_add = int(chara.hp_max * hp_percentage)
-                chara.log(f"為{chara.name}恢復了{hp_add}HP")
-                chara.gain_hp(hp_add)
+        if self.before_action_hook is not None:
+            self.before_action_hook(self)
 
+    def group_regeneration(self):
+        # 奧義類型62:群體回血
+        charas = [chara for chara in self.battle.charas if chara.team == self.team and chara.hp > 0]
+        hp_percentage = self.ability_type_power(62) / len(charas)
+        for chara in charas:
+            hp_add = int(chara.hp_max * hp_percentage)
+            chara.log("為{}恢復了{}HP", chara.name, hp_add)
+            chara.gain_hp(hp_add)
+
+    def regeneration(self):
         # 奧義類型1:再生
-        elif self.has_ability_type(1):
-            hp_add = int(self.hp_max * self.ability_type_power(1))
-            self.log(f"{self.name}恢復了{hp_add}點 HP")
-            self.gain_hp(hp_add)
+        hp_add = int(self.hp_max * self.ability_type_power(1))
+        self.log("{}恢復了{}點 HP", self.name, hp_add)
+        self.gain_hp(hp_add)
 
     def after_action(self):
         self.weapon_effect_blocked = self.weapon_effect_blocked_flag
@@ -513,9 +748,9 @@ class BattleChara:
 
         self.reduced_skill_rate = 0
 
-        if self.bleed > 0 and 15 > randint(1, 100):
+        if self.bleed > 0 and 15 > self.randint(1, 100):
             self.bleed = 0
-            self.log(f"{self.name}的流血停止了")
+            self.log("{}的流血停止了", self.name)
 
 
         for key, name in [
@@ -526,7 +761,49 @@ class BattleChara:
             if self.effects[key] > 0:
                 self.effects[key] -= 1
                 if self.effects[key] == 0:
-                    self.log(f"{self.name}從{name}狀態中恢復了")
+                    self.log("{}從{}狀態中恢復了", self.name, name)
+
+    def invalidate_stats(self):
+        self.stats_cache.clear()
+
+    def compile_hooks(self):
+        """
+        只保留角色的奧義、技能與裝備可能觸發的特效，特效本身仍會完整判定發動條件
+        封印、複製或卸除裝備後重新編譯；名單只會整個替換，執行中的舊名單仍涵蓋所有可能發動的特效
+        """
+        ability_types = self.ability_types
+        skill_types = {x.skill.type_id for x in self.skill_settings}
+
+        self.skill_effects = {
+            type_id: SKILL_EFFECTS[type_id] for type_id in skill_types if type_id in SKILL_EFFECTS
+        }
+        self.on_hit_hooks = [
+            hook for hook, ability_type_ids, skill_type_ids in ON_HIT_EFFECTS
+            if not ability_type_ids and not skill_type_ids
+            or any(x in ability_types for x in ability_type_ids) or skill_types.intersection(skill_type_ids)
+        ]
+        self.on_damaged_hooks = [BattleChara.counter_regeneration] if 61 in ability_types else []
+
+        weapon_element_type_id = self.equipments[1].element_type_id
+        if weapon_element_type_id == self.element_type.id and weapon_element_type_id in WEAPON_HIT_ELEMENTS:
+            self.weapon_hook = BattleChara.weapon_effect
+        else:
+            self.weapon_hook = None
+        armor_element_type_id = self.equipments[2].element_type_id
+        if armor_element_type_id == self.element_type.id and armor_element_type_id in ARMOR_HIT_ELEMENTS:
+            self.armor_hook = BattleChara.armor_effect
+        else:
+            self.armor_hook = None
+
+        # 奧義類型61:受攻擊回血(優先於再生術及群體再生，且無法同時發動)
+        if 61 in ability_types:
+            self.before_action_hook = None
+        elif 62 in ability_types:
+            self.before_action_hook = BattleChara.group_regeneration
+        elif 1 in ability_types:
+            self.before_action_hook = BattleChara.regeneration
+        else:
+            self.before_action_hook = None
 
     def has_ability_type(self, type_id):
         return type_id in self.ability_types
@@ -536,6 +813,18 @@ class BattleChara:
             return self.ability_types[type_id].power
         return 0
 
+    def counted_has_ability_type(self, type_id):
+        if type_id in self.ability_types:
+            self.battle.metrics.ability_lookups[type_id] += 1
+            return True
+        return False
+
+    def counted_ability_type_power(self, type_id):
+        if type_id in self.ability_types:
+            self.battle.metrics.ability_lookups[type_id] += 1
+            return self.ability_types[type_id].power
+        return 0
+
     def has_equipment_effect(self, slot_type_id, element_type_id):
         if self.weapon_effect_blocked and slot_type_id == 1:
             return False
@@ -543,7 +832,7 @@ class BattleChara:
 
     def gain_hp(self, hp_add):
         if self.bleed > 0:
-            self.log(f"但{self.name}正在流血，無法恢復HP")
+            self.log("但{}正在流血，無法恢復HP", self.name)
         else:
             self.hp = min(self.hp_max, self.hp + hp_add)
 
@@ -556,7 +845,7 @@ class BattleChara:
             self.hp = self.hp_max
 
     def normal_attack(self, defender):
-        self.log(f"{self.name}使出了普通攻擊")
+        self.log("{}使出了普通攻擊", self.name)
 
         attack = self.attack
 
@@ -570,143 +859,39 @@ class BattleChara:
         # 星防
         if self.has_equipment_effect(2, 5):
             attack += int(attack * 0.25)
-            self.log(f"[星防特效]{self.name}造成的普攻攻擊力上升")
+            self.log("[星防特效]{}造成的普攻攻擊力上升", self.name)
 
         # 奧義類型64:真傷
-        if self.has_ability_type(64) and randint(1, 2) == 1:
+        if self.has_ability_type(64) and self.randint(1, 2) == 1:
             damage = attack
             hp_loss = int(self.hp * 0.01)
             self.hp -= hp_loss
-            self.log(f"{self.name}損失了{hp_loss}HP，造成真實傷害")
+            self.log("{}損失了{}HP，造成真實傷害", self.name, hp_loss)
         # 一般
         else:
             damage_max = int((attack * attack) / (attack + defender.defense))
             damage_min = int(
                 damage_max * (self.battle.params['normal_attack_damage_lower_bound'] + 0.2 * self.luck_sigmoid)
             )
-            damage = randint(damage_min, damage_max)
+            damage = self.randint(damage_min, damage_max)
 
         # 奧義類型3:防禦術
         damage -= int(damage * defender.ability_type_power(3))
         # 暗防
         if defender.has_equipment_effect(2, 8):
             damage -= int(damage * 0.4)
-            defender.log(f"[暗防特效]{defender.name}受到的普攻傷害減低")
+            defender.log("[暗防特效]{}受到的普攻傷害減低", defender.name)
 
         damage = int(damage * self.battle.params['normal_attack_damage_ratio'])
         defender.take_damage(self, damage)
 
     def perform_skill(self, defender, skill):
-        self.log(f"{self.name}使出了{skill.name}")
-        damage = None
-
-        # 特殊技能
-        # 不造成 damage
-        # 不受技能加減成影響
-        if skill.type_id == 2:
-            hp_add = skill.power + randint(0, self.men // 2)
-            self.log(f"{self.name}的 HP 恢復了{hp_add}點")
-            self.gain_hp(hp_add)
-        elif skill.type_id == 3:
-            hp_add = self.hp_max // 10
-            mp_add = self.mp_max // 10
-            self.log(f"{self.name}的 HP 恢復了{hp_add}點， MP 恢復了{mp_add}點")
-            self.gain_hp(hp_add)
-            self.gain_mp(mp_add)
-        elif skill.type_id == 4:
-            attack_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
-            self.attack_add_on += attack_add
-            self.buff_count += 1
-            self.log(f"{self.name}的攻擊力上升了{attack_add}點")
-        elif skill.type_id == 5:
-            defense_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
-            self.defense_add_on += defense_add
-            self.buff_count += 1
-            self.log(f"{self.name}的防禦力上升了{defense_add}點")
-        elif skill.type_id == 6:
-            magic_defense_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
-            self.magic_defense_add_on += magic_defense_add
-            self.buff_count += 1
-            self.log(f"{self.name}的魔法防禦力上升了{magic_defense_add}點")
-        elif skill.type_id == 8:
-            mp_draw = min(800, defender.mp, defender.mp_max // 5)
-            self.log(f"{defender.name}被吸取了{mp_draw}點 MP")
-            defender.mp -= mp_draw
-            self.gain_mp(mp_draw)
-        elif skill.type_id == 9:
-            hp_loss = min(defender.hp - 1, int(defender.hp / skill.power))
-            defender.hp -= hp_loss
-            self.log(f"{defender.name}失去了{hp_loss}點 HP")
-        elif skill.type_id == 19:
-            hp_loss = self.hp // 10
-            mp_add = self.hp_max // 10
-            self.log(f"{self.name}失去{hp_loss}點 HP，獲得 {mp_add} 點MP")
-            self.hp -= hp_loss
-            self.gain_mp(mp_add)
-        elif skill.type_id == 21:
-            hp_loss = min(defender.hp - 1, randint(0, self.mp))
-            defender.hp -= hp_loss
-            self.mp = 0
-            self.log(f"{defender.name}失去了{hp_loss}點 HP")
-        elif skill.type_id == 23:
-            hp_loss = min(defender.hp - 1, randint(0, self.men) + self.agi)
-            self.log(f"{defender.name}被吸取了{hp_loss}點 HP")
-            self.gain_hp(hp_loss)
-            defender.hp -= hp_loss
-        elif skill.type_id == 24:
-            mp_loss = min(defender.mp, randint(0, self.men) + self.agi)
-            self.log(f"{defender.name}被吸取了{mp_loss}點 MP")
-            self.gain_mp(mp_loss)
-            defender.mp -= mp_loss
-        elif skill.type_id == 25:
-            mp_loss = min(defender.mp, self.int // 2 + randint(0, self.men * 2))
-            defender.mp -= mp_loss
-            self.log(f"{defender.name}失去了{mp_loss}點 MP")
-        elif skill.type_id == 29:
-            slot_type_id = randint(1, 4)
-            equipment = defender.equipments[slot_type_id]
-            defender.equipments[slot_type_id] = EmptyEquipment()
-            self.log(f"{defender.name}身上的{equipment.name}被卸下了")
-        elif skill.type_id == 30:
-            hp_loss = int(defender.hp_max * skill.power / 100)
-            defender.hp -= hp_loss
-            self.log(f"{defender.name}失去了{hp_loss}點 HP")
-        elif skill.type_id == 31:
-            hp_loss = int(defender.hp_max * skill.power / 100)
-            if hp_loss >= defender.hp:
-                defender.hp -= hp_loss
-                self.log(f"{defender.name}失去了{hp_loss}點 HP")
-        elif skill.type_id == 35:
-            mp_add = int(self.mp_max * skill.power / 100)
-            self.log(f"{self.name}恢復了{mp_add}MP")
-            self.gain_mp(mp_add)
-
-        # 特殊技能結束
-
-        # 一般技能
-        # 造成 damage
-        # 受技能加減成影響
-        elif skill.type_id == 16:
-            damage = skill.power * (randint(0, self.str) + self.int) - defender.magic_defense
-        elif skill.type_id == 17:
-            damage = skill.power + (randint(0, self.men) + self.int) - defender.magic_defense
-        elif skill.type_id == 18:
-            damage = skill.power * (self.int + randint(0, self.men) + randint(0, self.dex)) - defender.magic_defense
-        elif skill.type_id == 20:
-            damage = self.dex + randint(0, self.dex * skill.power)
-        elif skill.type_id == 22:
-            damage = self.vit + randint(0, self.dex * skill.power)
-        elif skill.type_id in [1, 7, 10, 11, 12, 13, 14, 15, 32, 33, 34, 36, 37]:
-            damage = skill.power + randint(0, self.int) - defender.magic_defense
-        elif skill.type_id == 26:
-            damage = skill.power * (randint(0, self.int) + defender.defense)
-        elif skill.type_id == 27:
-            damage = skill.power * (randint(0, self.int) + defender.magic_defense)
-        elif skill.type_id == 28:
-            damage = skill.power * (randint(0, self.int) + defender.speed)
-
-        # 一般技能結束
+        self.log("{}使出了{}", self.name, skill.name)
 
+        effect = self.skill_effects.get(skill.type_id)
+        if effect is None:
+            return
+        damage = effect(self, defender, skill)
         if damage is None:
             return
 
@@ -723,20 +908,153 @@ class BattleChara:
         # 無武
         if self.has_equipment_effect(1, 1):
             damage += int(damage * 0.4)
-            self.log(f"[無武特效]{self.name}的技能傷害增加")
+            self.log("[無武特效]{}的技能傷害增加", self.name)
 
         # 光武
         if defender.has_equipment_effect(1, 7):
             damage -= int(damage * 0.3)
-            defender.log(f"[光武特效]{defender.name}受到的技能傷害減少")
+            defender.log("[光武特效]{}受到的技能傷害減少", defender.name)
         # 光防
         if defender.has_equipment_effect(2, 7):
             damage -= int(damage * 0.64)
-            defender.log(f"[光防特效]{defender.name}受到的技能傷害減少")
+            defender.log("[光防特效]{}受到的技能傷害減少", defender.name)
 
         damage = int(damage * self.battle.params['skill_attack_damage_ratio'])
         defender.take_damage(self, damage, skill)
 
+    # 特殊技能
+    # 不造成 damage
+    # 不受技能加減成影響
+
+    def heal_skill(self, defender, skill):
+        hp_add = skill.power + self.randint(0, self.men // 2)
+        self.log("{}的 HP 恢復了{}點", self.name, hp_add)
+        self.gain_hp(hp_add)
+
+    def recover_skill(self, defender, skill):
+        hp_add = self.hp_max // 10
+        mp_add = self.mp_max // 10
+        self.log("{}的 HP 恢復了{}點， MP 恢復了{}點", self.name, hp_add, mp_add)
+        self.gain_hp(hp_add)
+        self.gain_mp(mp_add)
+
+    def attack_up_skill(self, defender, skill):
+        attack_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
+        self.attack_add_on += attack_add
+        self.invalidate_stats()
+        self.buff_count += 1
+        self.log("{}的攻擊力上升了{}點", self.name, attack_add)
+
+    def defense_up_skill(self, defender, skill):
+        defense_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
+        self.defense_add_on += defense_add
+        self.invalidate_stats()
+        self.buff_count += 1
+        self.log("{}的防禦力上升了{}點", self.name, defense_add)
+
+    def magic_defense_up_skill(self, defender, skill):
+        magic_defense_add = int(self.men * skill.power / 100 * 0.9**max(0, self.buff_count - 10))
+        self.magic_defense_add_on += magic_defense_add
+        self.invalidate_stats()
+        self.buff_count += 1
+        self.log("{}的魔法防禦力上升了{}點", self.name, magic_defense_add)
+
+    def mp_drain_skill(self, defender, skill):
+        mp_draw = min(800, defender.mp, defender.mp_max // 5)
+        self.log("{}被吸取了{}點 MP", defender.name, mp_draw)
+        defender.mp -= mp_draw
+        self.gain_mp(mp_draw)
+
+    def hp_ratio_loss_skill(self, defender, skill):
+        hp_loss = min(defender.hp - 1, int(defender.hp / skill.power))
+        defender.hp -= hp_loss
+        self.log("{}失去了{}點 HP", defender.name, hp_loss)
+
+    def hp_to_mp_skill(self, defender, skill):
+        hp_loss = self.hp // 10
+        mp_add = self.hp_max // 10
+        self.log("{}失去{}點 HP，獲得 {} 點MP", self.name, hp_loss, mp_add)
+        self.hp -= hp_loss
+        self.gain_mp(mp_add)
+
+    def mp_burst_skill(self, defender, skill):
+        hp_loss = min(defender.hp - 1, self.randint(0, self.mp))
+        defender.hp -= hp_loss
+        self.mp = 0
+        self.log("{}失去了{}點 HP", defender.name, hp_loss)
+
+    def hp_steal_skill(self, defender, skill):
+        hp_loss = min(defender.hp - 1, self.randint(0, self.men) + self.agi)
+        self.log("{}被吸取了{}點 HP", defender.name, hp_loss)
+        self.gain_hp(hp_loss)
+        defender.hp -= hp_loss
+
+    def mp_steal_skill(self, defender, skill):
+        mp_loss = min(defender.mp, self.randint(0, self.men) + self.agi)
+        self.log("{}被吸取了{}點 MP", defender.name, mp_loss)
+        self.gain_mp(mp_loss)
+        defender.mp -= mp_loss
+
+    def mp_loss_skill(self, defender, skill):
+        mp_loss = min(defender.mp, self.int // 2 + self.randint(0, self.men * 2))
+        defender.mp -= mp_loss
+        self.log("{}失去了{}點 MP", defender.name, mp_loss)
+
+    def unequip_skill(self, defender, skill):
+        slot_type_id = self.randint(1, 4)
+        equipment = defender.equipments[slot_type_id]
+        defender.equipments[slot_type_id] = EmptyEquipment()
+        defender.invalidate_stats()
+        defender.compile_hooks()
+        self.log("{}身上的{}被卸下了", defender.name, equipment.name)
+
+    def hp_max_ratio_loss_skill(self, defender, skill):
+        hp_loss = int(defender.hp_max * skill.power / 100)
+        defender.hp -= hp_loss
+        self.log("{}失去了{}點 HP", defender.name, hp_loss)
+
+    def execute_skill(self, defender, skill):
+        hp_loss = int(defender.hp_max * skill.power / 100)
+        if hp_loss >= defender.hp:
+            defender.hp -= hp_loss
+            self.log("{}失去了{}點 HP", defender.name, hp_loss)
+
+    def mp_recover_skill(self, defender, skill):
+        mp_add = int(self.mp_max * skill.power / 100)
+        self.log("{}恢復了{}MP", self.name, mp_add)
+        self.gain_mp(mp_add)
+
+    # 一般技能
+    # 造成 damage
+    # 受技能加減成影響
+
+    def magic_attack_skill(self, defender, skill):
+        return skill.power + self.randint(0, self.int) - defender.magic_defense
+
+    def strength_magic_attack_skill(self, defender, skill):
+        return skill.power * (self.randint(0, self.str) + self.int) - defender.magic_defense
+
+    def mental_magic_attack_skill(self, defender, skill):
+        return skill.power + (self.randint(0, self.men) + self.int) - defender.magic_defense
+
+    def dexterity_magic_attack_skill(self, defender, skill):
+        return skill.power * (self.int + self.randint(0, self.men) + self.randint(0, self.dex)) - defender.magic_defense
+
+    def dexterity_attack_skill(self, defender, skill):
+        return self.dex + self.randint(0, self.dex * skill.power)
+
+    def vitality_attack_skill(self, defender, skill):
+        return self.vit + self.randint(0, self.dex * skill.power)
+
+    def anti_defense_skill(self, defender, skill):
+        return skill.power * (self.randint(0, self.int) + defender.defense)
+
+    def anti_magic_defense_skill(self, defender, skill):
+        return skill.power * (self.randint(0, self.int) + defender.magic_defense)
+
+    def anti_speed_skill(self, defender, skill):
+        return skill.power * (self.randint(0, self.int) + defender.speed)
+
     def take_damage(self, attacker, damage, skill=None):
         skill_type = skill.type_id if skill is not None else None
         speed_gap = min(400, self.speed - attacker.speed)
@@ -752,35 +1070,35 @@ class BattleChara:
         if attacker.has_equipment_effect(1, 5):
             speed_gap_check *= 10
             eva_check *= 10
-            attacker.log(f"[星武特效]{attacker.name}的命中率上升")
+            attacker.log("[星武特效]{}的命中率上升", attacker.name)
 
         # 無視反擊、迴避、躲避、奧義類型8
         if skill_type in [17, 18, 26, 34]:
             pass
         # 奧義類型12:反擊
         elif self.has_ability_type(12) and \
-                randint(1, max(500, 1200 - self.vit)) <= 400 * max(0.25, sigmoid(self.vit, 3000)):
-            if attacker.ability_type_power(43) >= randint(1, 100):
+                self.randint(1, max(500, 1200 - self.vit)) <= 400 * max(0.25, sigmoid(self.vit, 3000)):
+            if attacker.ability_type_power(43) >= self.randint(1, 100):
                 damage = None
-                self.log(f"{self.name}的反擊發動！但被{attacker.name}回避了")
+                self.log("{}的反擊發動！但被{}回避了", self.name, attacker.name)
             else:
-                hp_loss = int((damage + randint(0, self.str)) / 2 * self.ability_type_power(12) / 100)
+                hp_loss = int((damage + self.randint(0, self.str)) / 2 * self.ability_type_power(12) / 100)
                 hp_loss = min(attacker.hp - 1, hp_loss)
                 attacker.hp -= hp_loss
                 damage = None
-                self.log(f"{self.name}的反擊發動！對{attacker.name}造成了{hp_loss}點傷害")
+                self.log("{}的反擊發動！對{}造成了{}點傷害", self.name, attacker.name, hp_loss)
         # 迴避
-        elif eva >= randint(1, eva_check):
+        elif eva >= self.randint(1, eva_check):
             damage = None
-            self.log(f"{self.name}迴避了攻擊")
+            self.log("{}迴避了攻擊", self.name)
         # 躲避
-        elif speed_gap >= randint(1, speed_gap_check):
+        elif speed_gap >= self.randint(1, speed_gap_check):
             damage = None
-            self.log(f"{self.name}躲避了攻擊")
+            self.log("{}躲避了攻擊", self.name)
         # 奧義類型8:神聖護體
-        elif self.ability_type_power(8) >= randint(1, 100):
+        elif self.ability_type_power(8) >= self.randint(1, 100):
             damage = None
-            self.log(f"{self.name}擋住了攻擊")
+            self.log("{}擋住了攻擊", self.name)
 
         # 奧義類型54:亡命鎖鏈
         if attacker.has_ability_type(54):
@@ -788,8 +1106,8 @@ class BattleChara:
             attacker.hp = max(0, attacker.hp - hp_loss)
             self.hp = max(0, self.hp - hp_loss * 2)
             self.lose_hp_max(hp_loss)
-            attacker.log(f"[亡命鎖鏈]{attacker.name}自身扣血{hp_loss}")
-            self.log(f"[亡命鎖鏈]{self.name}損失{hp_loss*2}HP，並被減少了{hp_loss}HP上限")
+            attacker.log("[亡命鎖鏈]{}自身扣血{}", attacker.name, hp_loss)
+            self.log("[亡命鎖鏈]{}損失{}HP，並被減少了{}HP上限", self.name, hp_loss*2, hp_loss)
 
         # 未受到攻擊，不進入傷害與特效處理
         if damage is None:
@@ -799,224 +1117,319 @@ class BattleChara:
         # 奧義類型58:詛咒
         # 奧義類型44:安撫
         # 脆弱
-        if skill_type == 33 or attacker.critical * (1 - self.ability_type_power(58)) >= random() / (1 + self.effects['vulnerability']) and not self.has_ability_type(44):
+        if skill_type == 33 or attacker.critical * (1 - self.ability_type_power(58)) >= self.battle.rng.random() / (1 + self.effects['vulnerability']) and not self.has_ability_type(44):
             damage += int(
                 damage * self.battle.params['critical_damage_add_on'] * max(1, sigmoid(attacker.dex, self.dex) * 2)
             )
             # 奧義類型23:暴擊傷害提升
             damage += int(damage * attacker.ability_type_power(23))
-            self.log(f"暴擊！")
+            self.log("暴擊！")
         # 奧義類型26:追加傷害
-        if attacker.has_ability_type(26) and randint(1, 3) == 1:
-            damage_add = randint(0, 200)
+        if attacker.has_ability_type(26) and self.randint(1, 3) == 1:
+            damage_add = self.randint(0, 200)
             damage += damage_add
-            attacker.log(f"追加了{damage_add}點傷害")
+            attacker.log("追加了{}點傷害", damage_add)
         # 屬性相剋
         if attacker.element_type == self.element_type.suppressed_by:
             damage = int(damage * 1.2)
-            attacker.log(f"{self.name}的屬性被剋制了")
+            attacker.log("{}的屬性被剋制了", self.name)
         # 易傷
         damage += int(damage * self.vulnerable * 0.5)
 
         damage = max(1, damage)
         self.hp = max(0, self.hp - damage)
-        self.log(f"{self.name}受到了{damage}點傷害")
+        attacker.damage_dealt += damage
+        self.log("{}受到了{}點傷害", self.name, damage)
+
+        for hook in attacker.on_hit_hooks:
+            hook(self, attacker, damage, skill_type)
+        for hook in self.on_damaged_hooks:
+            hook(self, attacker)
+        if attacker.weapon_hook is not None:
+            attacker.weapon_hook(self, attacker)
+        if self.armor_hook is not None:
+            self.armor_hook(self, attacker)
 
+    # 命中後由攻擊方觸發的特效，self 為受到攻擊的角色
+
+    def combo_effect(self, attacker, damage, skill_type):
         # 奧義類型4:連擊
         attacker.action_points += int(attacker.ability_type_power(4))
 
+    def instant_death_effect(self, attacker, damage, skill_type):
         # 即死
         # 奧義類型9:即死
-        if skill_type == 10 and randint(1, 30) == 1 or attacker.ability_type_power(9) >= randint(1, 1000):
+        if skill_type == 10 and self.randint(1, 30) == 1 or attacker.ability_type_power(9) >= self.randint(1, 1000):
             if self.battle.battle_type == 'dungeon' or isinstance(self.source, WorldBoss):
-                self.log(f"因為神祕力量，即死被無效化了")
+                self.log("因為神祕力量，即死被無效化了")
             # 奧義類型40:免疫即死
-            elif self.ability_type_power(40) >= randint(1, 100):
+            elif self.ability_type_power(40) >= self.randint(1, 100):
                 # 奧義類型60:對即死免疫造成易傷
                 if attacker.has_ability_type(60):
                     self.vulnerable += 1
-                    self.log(f"不死鳥受到損傷，{self.name}當前易傷層數為{self.vulnerable}")
+                    self.log("不死鳥受到損傷，{}當前易傷層數為{}", self.name, self.vulnerable)
                 else:
-                    self.log(f"不死鳥保護住{self.name}")
+                    self.log("不死鳥保護住{}", self.name)
             elif self.has_ability_type(49):
-                if self.ability_type_power(49) >= randint(1, 100):
+                if self.ability_type_power(49) >= self.randint(1, 100):
                     attacker.hp = 0
-                    self.log(f"{attacker.name}對死神使出即死，但死神將即死回報給對方")
+                    self.log("{}對死神使出即死，但死神將即死回報給對方", attacker.name)
                 else:
-                    self.log(f"死神保護住{self.name}")
+                    self.log("死神保護住{}", self.name)
             else:
                 self.hp = 0
-                self.log(f"{self.name}即死")
+                self.log("{}即死", self.name)
 
+    def defense_down_effect(self, attacker, damage, skill_type):
         # 降防
         if skill_type == 11:
             self.defense_add_on -= self.defense // 10
-            self.log(f"{self.name}的防禦力下降")
+            self.invalidate_stats()
+            self.log("{}的防禦力下降", self.name)
 
+    def poison_effect(self, attacker, damage, skill_type):
         # 毒
         # 奧義類型14:毒
-        if skill_type == 12 and randint(1, 4) == 1 or attacker.has_ability_type(14) and randint(1, 6) == 1:
+        if skill_type == 12 and self.randint(1, 4) == 1 or attacker.has_ability_type(14) and self.randint(1, 6) == 1:
             # 奧義類型65:疊毒
             if attacker.has_ability_type(65):
                 self.poison += max(1, int(attacker.ability_type_power(14)))
             else:
                 self.poison = max(1, self.poison, int(attacker.ability_type_power(14)))
-            self.log(f"{self.name}中毒了，當前層數為{self.poison}")
+            self.log("{}中毒了，當前層數為{}", self.name, self.poison)
 
+    def evasion_up_effect(self, attacker, damage, skill_type):
         # 攻擊者迴避提升
-        if skill_type == 13 and randint(1, 3) == 1 and attacker.eva_add < 600:
+        if skill_type == 13 and self.randint(1, 3) == 1 and attacker.eva_add < 600:
             attacker.eva_add += 40
-            attacker.log(f"{attacker.name}的迴避提升了")
+            attacker.log("{}的迴避提升了", attacker.name)
 
+    def paralysis_effect(self, attacker, damage, skill_type):
         # 麻痹
         # 奧義類型24:麻痹
-        if skill_type == 14 and randint(1, 8) == 1 or attacker.has_ability_type(24) and randint(1, 15) == 1:
+        if skill_type == 14 and self.randint(1, 8) == 1 or attacker.has_ability_type(24) and self.randint(1, 15) == 1:
             self.action_points -= 2000
-            self.log(f"{self.name}被麻痹了")
+            self.log("{}被麻痹了", self.name)
 
+    def drain_effect(self, attacker, damage, skill_type):
         # 吸血
         # 奧義類型28:吸血
-        if skill_type == 7 or attacker.has_ability_type(28) and randint(1, 4) == 1:
+        if skill_type == 7 or attacker.has_ability_type(28) and self.randint(1, 4) == 1:
             hp_add = damage // 2
-            self.log(f"{self.name}被吸取了{hp_add}點 HP")
+            self.log("{}被吸取了{}點 HP", self.name, hp_add)
             attacker.gain_hp(hp_add)
 
+    def slow_effect(self, attacker, damage, skill_type):
         # 降速
         # 奧義類型16:降速
-        if skill_type == 15 and randint(1, 8) == 1 or attacker.ability_type_power(16) >= randint(1, 100):
+        if skill_type == 15 and self.randint(1, 8) == 1 or attacker.ability_type_power(16) >= self.randint(1, 100):
             self.speed_add_on -= 50
-            self.log(f"{self.name}的速度降低了")
+            self.invalidate_stats()
+            self.log("{}的速度降低了", self.name)
 
+    def bleed_effect(self, attacker, damage, skill_type):
         # 流血
-        if skill_type == 32 and randint(1, 3):
+        if skill_type == 32 and self.randint(1, 3):
             self.bleed = 1
-            self.log(f"{self.name}開始流血了")
+            self.log("{}開始流血了", self.name)
 
+    def silence_effect(self, attacker, damage, skill_type):
         # 沉默
         if skill_type == 34:
             self.effects['silence'] = 3
-            self.log(f"{self.name}被沉默了")
+            self.log("{}被沉默了", self.name)
 
+    def vulnerability_effect(self, attacker, damage, skill_type):
         # 脆弱
         if skill_type == 36:
             self.effects['vulnerability'] = 2
-            self.log(f"{self.name}變得脆弱了")
+            self.log("{}變得脆弱了", self.name)
 
+    def confusion_effect(self, attacker, damage, skill_type):
         # 混亂
         if skill_type == 37:
             self.effects['confusion'] = 1
-            self.log(f"{self.name}變得混亂了")
-        
+            self.log("{}變得混亂了", self.name)
 
+    def mana_drain_effect(self, attacker, damage, skill_type):
         # 奧義類型27:嗜魔
-        if attacker.has_ability_type(27) and randint(1, 3) == 1:
-            mp_loss = min(self.mp, randint(0, 150))
-            self.log(f"{self.name}的MP被奪走了{mp_loss}")
+        if attacker.has_ability_type(27) and self.randint(1, 3) == 1:
+            mp_loss = min(self.mp, self.randint(0, 150))
+            self.log("{}的MP被奪走了{}", self.name, mp_loss)
             self.mp -= mp_loss
             attacker.gain_mp(mp_loss)
 
+    def bind_effect(self, attacker, damage, skill_type):
         # 奧義類型45:束縛
         if attacker.has_ability_type(45):
             self.action_points -= attacker.ability_type_power(45)
-            self.log(f"[束縛]{self.name}的AP減少了")
+            self.log("[束縛]{}的AP減少了", self.name)
 
+    def vampire_kiss_effect(self, attacker, damage, skill_type):
         # 奧義類型55:吸血鬼之吻
-        if attacker.has_ability_type(55) and randint(1, 7) == 1:
+        if attacker.has_ability_type(55) and self.randint(1, 7) == 1:
             hp_loss = min(self.hp, int((attacker.hp_max - attacker.hp) / attacker.ability_type_power(55)) +
-                          randint(1, attacker.agi + attacker.dex))
+                          self.randint(1, attacker.agi + attacker.dex))
             mp_loss = min(self.mp, int((attacker.mp_max - attacker.mp) / attacker.ability_type_power(55)) +
-                          randint(1, attacker.agi + attacker.dex))
-            attacker.log(f"[吸血鬼之吻]吸收了{self.name}的{hp_loss}HP與{mp_loss}MP")
+                          self.randint(1, attacker.agi + attacker.dex))
+            attacker.log("[吸血鬼之吻]吸收了{}的{}HP與{}MP", self.name, hp_loss, mp_loss)
             self.hp -= hp_loss
             self.mp -= mp_loss
             attacker.gain_hp(hp_loss)
             attacker.gain_mp(mp_loss)
 
+    def copy_equipment_effect(self, attacker, damage, skill_type):
         # 奧義類型66:複製裝備
-        if attacker.has_ability_type(66) and randint(1, 20) == 1:
-            slot_type_id = randint(1, 4)
+        if attacker.has_ability_type(66) and self.randint(1, 20) == 1:
+            slot_type_id = self.randint(1, 4)
             equipment = self.equipments[slot_type_id]
             attacker.equipments[slot_type_id] = equipment
-            attacker.log(f"{attacker.name}複製了{self.name}的{equipment.name}")
+            attacker.invalidate_stats()
+            attacker.compile_hooks()
+            attacker.log("{}複製了{}的{}", attacker.name, self.name, equipment.name)
 
+    def seal_effect(self, attacker, damage, skill_type):
         # 奧義類型31:封印
         # 奧義類型52:十字封印
         if (attacker.has_ability_type(31) or attacker.has_ability_type(52)) and \
-                randint(1, 5 * 2 ** self.blocked_ability_count) == 1:
+                self.randint(1, 5 * 2 ** self.blocked_ability_count) == 1:
             # 奧義類型57:神之封印
             if self.blocked_ability_count >= max(attacker.ability_type_power(31), attacker.ability_type_power(52)) \
                     + attacker.ability_type_power(57):
                 pass
             # 奧義類型41:封印防護
-            elif self.ability_type_power(41) / (1 + int(attacker.has_ability_type(52))) >= randint(1, 100):
-                self.log(f"封印{self.name}的奧義失敗")
+            elif self.ability_type_power(41) / (1 + int(attacker.has_ability_type(52))) >= self.randint(1, 100):
+                self.log("封印{}的奧義失敗", self.name)
             elif len(self.ability_types) > 0:
-                ability = self.ability_types.pop(choice(list(self.ability_types.keys())))
+                ability = self.ability_types.pop(self.battle.rng.choice(list(self.ability_types.keys())))
+                self.invalidate_stats()
+                self.compile_hooks()
+                self.battle.invalidate_target_weights(self.team)
                 self.blocked_ability_count += 1
-                self.log(f"{self.name}的{ability.name}被封印了")
+                self.log("{}的{}被封印了", self.name, ability.name)
+
+    # 受到攻擊的角色的奧義、攻擊方的武器與受到攻擊的角色的防具特效
 
+    def counter_regeneration(self, attacker):
         # 奧義類型61:受攻擊回血
         if self.hp > 0 and self.has_ability_type(61):
             hp_add = int(self.hp_max * self.ability_type_power(61))
-            self.log(f"{self.name}恢復了{hp_add}HP")
+            self.log("{}恢復了{}HP", self.name, hp_add)
             self.gain_hp(hp_add)
 
+    def weapon_effect(self, attacker):
         # 火武
         if attacker.has_equipment_effect(1, 2):
             hp_loss = int(min(self.hp_max, attacker.hp_max * 15) * 0.01)
             self.hp -= hp_loss
-            self.log(f"[火武特效]{self.name}損失了{hp_loss}HP")
+            self.log("[火武特效]{}損失了{}HP", self.name, hp_loss)
         # 水武
         elif attacker.has_equipment_effect(1, 3):
             hp_loss = int(min(self.hp_max, attacker.hp_max * 15) * 0.005)
-            attacker.log(f"[水武特效]吸收了{self.name}的{hp_loss}HP")
+            attacker.log("[水武特效]吸收了{}的{}HP", self.name, hp_loss)
             self.hp -= hp_loss
             attacker.gain_hp(hp_loss)
         # 風武
         elif attacker.has_equipment_effect(1, 4):
             ap_add = min(max(100, self.speed // 10), 500)
             attacker.action_points += ap_add
-            attacker.log(f"[風武特效]{attacker.name}獲得了{ap_add}AP")
+            attacker.log("[風武特效]{}獲得了{}AP", attacker.name, ap_add)
         # 雷武
         elif attacker.has_equipment_effect(1, 6):
-            if randint(1, 5) == 1:
+            if self.randint(1, 5) == 1:
                 self.action_points -= 1000
-                self.log(f"[雷武特效]{self.name}被麻痹了，減少了1000AP")
+                self.log("[雷武特效]{}被麻痹了，減少了1000AP", self.name)
         # 暗武
         elif attacker.has_equipment_effect(1, 8):
             self.reduced_skill_rate = 0.5
-            self.log(f"[暗武特效]{self.name}的技能發動率被降低了")
+            self.log("[暗武特效]{}的技能發動率被降低了", self.name)
 
+    def armor_effect(self, attacker):
         if self.hp <= 0:
             pass
         # 火防
         elif self.has_equipment_effect(2, 2):
             hp_loss = int(min(attacker.hp_max, self.hp_max * 15) * 0.015)
             attacker.hp -= hp_loss
-            attacker.log(f"[火防特效]{attacker.name}損失了{hp_loss}HP")
+            attacker.log("[火防特效]{}損失了{}HP", attacker.name, hp_loss)
         # 水防
         elif self.has_equipment_effect(2, 3):
             hp_add = int(self.hp_max * 0.005)
-            self.log(f"[水防特效]{self.name}恢復了{hp_add}HP，並封印了對手的武器特效")
+            self.log("[水防特效]{}恢復了{}HP，並封印了對手的武器特效", self.name, hp_add)
             self.gain_hp(hp_add)
             attacker.weapon_effect_blocked_flag = True
         # 風防
         elif self.has_equipment_effect(2, 4):
             ap_add = max(100, attacker.speed // 10)
             self.action_points += ap_add
-            self.log(f"[風防特效]{self.name}獲得了{ap_add}AP")
+            self.log("[風防特效]{}獲得了{}AP", self.name, ap_add)
         # 雷防
         elif self.has_equipment_effect(2, 6):
             ap_loss = max(100, attacker.speed // 10)
             attacker.action_points -= ap_loss
-            attacker.log(f"[雷防特效]{attacker.name}的AP減少了{ap_loss}點")
+            attacker.log("[雷防特效]{}的AP減少了{}點", attacker.name, ap_loss)
 
     def check_death(self):
         if self.hp <= 0:
             self.hp = 0
-            self.log(f"{self.name}倒下了")
+            self.log("{}倒下了", self.name)
 
             # 奧義類型11:復活
-            if self.ability_type_power(11) >= randint(1, 100):
+            if self.ability_type_power(11) >= self.randint(1, 100):
                 self.hp = self.hp_max // 2
-                self.log(f"{self.name}復活了")
+                self.log("{}復活了", self.name)
+
+
+SKILL_EFFECTS = {
+    2: BattleChara.heal_skill,
+    3: BattleChara.recover_skill,
+    4: BattleChara.attack_up_skill,
+    5: BattleChara.defense_up_skill,
+    6: BattleChara.magic_defense_up_skill,
+    8: BattleChara.mp_drain_skill,
+    9: BattleChara.hp_ratio_loss_skill,
+    19: BattleChara.hp_to_mp_skill,
+    21: BattleChara.mp_burst_skill,
+    23: BattleChara.hp_steal_skill,
+    24: BattleChara.mp_steal_skill,
+    25: BattleChara.mp_loss_skill,
+    29: BattleChara.unequip_skill,
+    30: BattleChara.hp_max_ratio_loss_skill,
+    31: BattleChara.execute_skill,
+    35: BattleChara.mp_recover_skill,
+    16: BattleChara.strength_magic_attack_skill,
+    17: BattleChara.mental_magic_attack_skill,
+    18: BattleChara.dexterity_magic_attack_skill,
+    20: BattleChara.dexterity_attack_skill,
+    22: BattleChara.vitality_attack_skill,
+    26: BattleChara.anti_defense_skill,
+    27: BattleChara.anti_magic_defense_skill,
+    28: BattleChara.anti_speed_skill,
+}
+for type_id in [1, 7, 10, 11, 12, 13, 14, 15, 32, 33, 34, 36, 37]:
+    SKILL_EFFECTS[type_id] = BattleChara.magic_attack_skill
+
+# 依判定順序排列的命中特效：(特效, 攻擊方的相關奧義類型, 攻擊方的相關技能類型)
+# 兩者皆為空的特效每次命中都會判定（消耗亂數），不可省略
+ON_HIT_EFFECTS = [
+    (BattleChara.combo_effect, [4], []),
+    (BattleChara.instant_death_effect, [], []),
+    (BattleChara.defense_down_effect, [], [11]),
+    (BattleChara.poison_effect, [14], [12]),
+    (BattleChara.evasion_up_effect, [], [13]),
+    (BattleChara.paralysis_effect, [24], [14]),
+    (BattleChara.drain_effect, [28], [7]),
+    (BattleChara.slow_effect, [], []),
+    (BattleChara.bleed_effect, [], [32]),
+    (BattleChara.silence_effect, [], [34]),
+    (BattleChara.vulnerability_effect, [], [36]),
+    (BattleChara.confusion_effect, [], [37]),
+    (BattleChara.mana_drain_effect, [27], []),
+    (BattleChara.bind_effect, [45], []),
+    (BattleChara.vampire_kiss_effect, [55], []),
+    (BattleChara.copy_equipment_effect, [66], []),
+    (BattleChara.seal_effect, [31, 52], []),
+]
+# 命中後發動的武器、防具特效屬性（火、水、風、雷、暗）
+WEAPON_HIT_ELEMENTS = [2, 3, 4, 6, 8]
+ARMOR_HIT_ELEMENTS = [2, 3, 4, 6]
@@ -2,19 +2,28 @@ from random import choice, choices, random
 
 from django.db.models import F
 
-from base.utils import add_class, randint
+from base.utils import add_class, randint, binomial, multinomial, merge_items
 from battle.utils import get_event_item_type
 from battle.battle import Battle
-from battle.models import Monster, WorldBoss, BattleEffect
-from item.models import ItemType, ItemTypePoolGroup, ItemTypePool, Item
-from item.serializers import SimpleItemSerializer
-from chara.models import BattleMapTicket, CharaAttribute
+from battle.loader import battle_templates
+from battle.models import WorldBoss, BattleEffect
+from item.models import Item
+from item.pools import item_type_pools
+from chara.counters import chara_counters, apply_counters, attribute_proficiency_field, today_battle_field
+from chara.models import BattleMapTicket
 from world.models import AttributeType
 
 from system.utils import push_log
 
 BATTLE_MAP_PROCESSORS = {}
 
+# 奧義類型67:養窩，每場戰鬥獲得各物品的機率
+NEST_LOOTS = [
+    (1013, 5 / 1000),  # 超級地獄草
+    (1004, 20 / 1000),  # 地獄草
+    (445, 175 / 1000),  # 熟練之書
+]
+
 
 class BaseBattleMapProcessor():
     upgrade_attribute_limit_after_win = False
@@ -33,6 +42,9 @@ class BaseBattleMapProcessor():
         self.messages = []
 
     def execute(self, n=1):
+        # item.serializers 經由 battle.serializers 匯入此模組，於執行時才匯入
+        from item.serializers import SimpleItemSerializer
+
         self.n = n
         self.monsters = self.get_monsters()
 
@@ -43,15 +55,19 @@ class BaseBattleMapProcessor():
         self.team_members = [x for x in battle.charas if x.team == 'attacker']
         self.win = (battle.winner == 'attacker')
 
-        self.chara.record.total_battle += n
-        self.chara.record.today_battle += n
+        # 戰鬥紀錄加上尚未寫入資料庫的累積值後只用於讀取，增加的次數交由 chara_counters 寫入
+        chara_counters.apply_pending(self.chara.id, record=self.chara.record)
+        counters = {'total_battle': n, today_battle_field(): n}
 
         if self.win:
-            self.chara.record.world_monster_quest_counter += len(self.monsters) * n
+            counters['world_monster_quest_counter'] = len(self.monsters) * n
             if self.chara.country_id is not None and self.chara.country_id == self.location.country_id:
-                self.chara.record.country_monster_quest_counter += len(self.monsters) * n
+                counters['country_monster_quest_counter'] = len(self.monsters) * n
 
-            loots = [x for i in range(n) for x in self.get_loots()]
+        apply_counters(counters, record=self.chara.record)
+
+        if self.win:
+            loots = self.get_loots(n)
             gold = self.get_gold() * n
             exp = self.get_exp() * n
             proficiency = self.get_proficiency() * n
@@ -88,9 +104,8 @@ class BaseBattleMapProcessor():
         self.chara.gold += gold
         self.chara.proficiency += proficiency
         self.chara.gain_exp(exp)
-        CharaAttribute.objects.filter(
-            chara=self.chara, type_id=F('chara__job__attribute_type')
-        ).update(proficiency=F('proficiency') + proficiency)
+        counters[attribute_proficiency_field(self.chara.job.attribute_type_id)] = proficiency
+        chara_counters.add(self.chara.id, counters)
         if found_random_battle_maps:
             BattleMapTicket.objects.filter(
                 chara=self.chara, battle_map__in=found_random_battle_maps
@@ -102,8 +117,6 @@ class BaseBattleMapProcessor():
 
         self.chara.save()
 
-        self.chara.record.save()
-
         if loots:
             log_loots = [x for x in loots if '原料' not in x.type.name and '建國之石' not in x.type.name]
             if log_loots:
@@ -127,27 +140,30 @@ class BaseBattleMapProcessor():
 
     def get_monsters(self):
         number = self.get_monster_number()
-        monster_settings = self.battle_map.monsters.all()
+        monster_settings = battle_templates.get_battle_map_monsters(self.battle_map.id)
         selected_monster_settings = choices(monster_settings, k=number, weights=[m.weight for m in monster_settings])
 
-        monsters = {
-            x.id: x
-            for x in Monster.objects.filter(id__in=[s.monster_id for s in selected_monster_settings])
-        }
-
-        return [monsters[x.monster_id] for x in selected_monster_settings]
+        return [battle_templates.get_monster(x.monster_id) for x in selected_monster_settings]
 
-    def rand_loot(self, n):
+    def rand_loot(self, n, times=1):
+        """
+        回傳 times 次 1/n 機率的掉寶中掉落的次數
+        """
         # 奧義類型13:獲得額外金錢與掉寶
         n = n * (1 - self.chara.equipped_ability_type_power(13) * 0.1)
         n = max(int(n), 1)
-        return randint(1, n) == 1
-
-    def get_loots(self):
-        return self.get_common_loots() + self.get_monster_loots() + self.get_map_loots() + self.get_event_loots() + \
-            self.get_ability_loots() + self.get_member_point_loots()
-
-    def get_common_loots(self):
+        return binomial(times, 1 / n)
+
+    def get_loots(self, n=1):
+        """
+        n 場戰鬥的掉寶，各掉寶來源一次決定 n 場中的掉落次數，同類型的非裝備物品合併為一個
+        """
+        return merge_items(
+            self.get_common_loots(n) + self.get_monster_loots(n) + self.get_map_loots(n) +
+            self.get_event_loots(n) + self.get_ability_loots(n) + self.get_member_point_loots(n)
+        )
+
+    def get_common_loots(self, n):
         loots = []
 
         # 建國之石
@@ -155,85 +171,87 @@ class BaseBattleMapProcessor():
         if self.chara.country_id is None:
             rand = 500
 
-        if self.rand_loot(rand):
-            loots.extend(ItemType.objects.get(id=472).make(1))
+        count = self.rand_loot(rand, n)
+        if count:
+            loots.extend(item_type_pools.get_item_type(472).make(count))
 
-        if self.rand_loot(200) and WorldBoss.objects.filter(location=self.location, is_alive=True).exists():
-            loots.extend(ItemType.objects.get(id=1555).make(1))
+        count = self.rand_loot(200, n)
+        if count and WorldBoss.objects.filter(location=self.location, is_alive=True).exists():
+            loots.extend(item_type_pools.get_item_type(1555).make(count))
 
         return loots
 
-    def get_monster_loots(self):
+    def get_monster_loots(self, n):
         return []
 
-    def get_map_loots(self):
+    def get_map_loots(self, n):
         loots = []
         # ItemTypePoolGroup
         for group_setting in self.map_loot_group_settings:
-            if self.rand_loot(group_setting['rand']):
-                if group_setting['id'] == 1 and self.chara.has_equipped_ability_type(36) and randint(1, 10) == 1:
-                    # 寵物卵
-                    pool = ItemTypePool.objects.get(id=8)
-                    loots.extend(pool.pick())
-                else:
-                    group = ItemTypePoolGroup.objects.get(id=group_setting['id'])
-                    loots.extend(group.pick())
+            count = self.rand_loot(group_setting['rand'], n)
+            if group_setting['id'] == 1 and self.chara.has_equipped_ability_type(36):
+                # 寵物卵
+                egg_count = binomial(count, 0.1)
+                loots.extend(item_type_pools.pick_pool(8, egg_count))
+                count -= egg_count
+            loots.extend(item_type_pools.pick_group(group_setting['id'], count))
 
         # ItemType
         for setting in self.map_loot_settings:
-            if self.rand_loot(setting['rand']):
-                loots.extend(ItemType.objects.get(id=setting['id']).make(1))
+            count = self.rand_loot(setting['rand'], n)
+            if count:
+                loots.extend(item_type_pools.get_item_type(setting['id']).make(count))
 
         return loots
 
-    def get_event_loots(self):
+    def get_event_loots(self, n):
         loots = []
         if self.chara.record.today_battle > 1500:
             return loots
 
-        event_item_type = get_event_item_type()
-
-        if event_item_type is not None and randint(1, 250) == 1:
-            loots.extend(event_item_type.make(1))
+        count = binomial(n, 1 / 250)
+        if count:
+            event_item_type = get_event_item_type()
+            if event_item_type is not None:
+                loots.extend(event_item_type.make(count))
 
         return loots
 
-    def get_ability_loots(self):
+    def get_ability_loots(self, n):
         loots = []
 
         if self.id in [5, 6, 7]:
             # 奧義類型38:尋找原料
-            if self.chara.has_equipped_ability_type(38) and randint(1, self.chara.equipped_ability_type_power(38)) == 1:
-                group = ItemTypePoolGroup.objects.get(id=6)
-                loots.extend(group.pick())
+            if self.chara.has_equipped_ability_type(38):
+                count = binomial(n, 1 / self.chara.equipped_ability_type_power(38))
+                loots.extend(item_type_pools.pick_group(6, count))
         # 奧義類型67:養窩
         for chara in self.team_members:
             if chara.has_ability_type(67):
-                rand = randint(1, 1000)
-                if rand <= 5:
-                    item = Item(type_id=1013, number=1)  # 超級地獄草
-                elif rand <= 25:
-                    item = Item(type_id=1004, number=1)  # 地獄草
-                elif rand <= 200:
-                    item = Item(type_id=445, number=1)  # 熟練之書
-                else:
-                    item = None
-
-                if item is not None:
-                    loots.append(item)
-                    self.messages.append(f"{chara.name}發出了養窩的聲音，獲得了{item.name}*{item.number}")
+                # 每場戰鬥最多獲得一種物品
+                counts = multinomial(n, [probability for _, probability in NEST_LOOTS])
+                items = [
+                    Item(type=item_type_pools.get_item_type(item_type_id), number=count)
+                    for (item_type_id, _), count in zip(NEST_LOOTS, counts) if count
+                ]
+
+                if items:
+                    loots.extend(items)
+                    items_name = '、'.join(f'{x.name}*{x.number}' for x in items)
+                    self.messages.append(f"{chara.name}發出了養窩的聲音，獲得了{items_name}")
                 else:
                     self.messages.append(f"{chara.name}發出了養窩的聲音，但是一無所獲")
         return loots
 
-    def get_member_point_loots(self):
+    def get_member_point_loots(self, n):
         loots = []
         if self.chara.record.today_battle > 3000:
             return loots
 
-        if randint(1, 1000) == 1:
+        count = binomial(n, 1 / 1000)
+        if count:
             # 綁定點數
-            loots.extend(ItemType.objects.get(id=1552).make(10))
+            loots.extend(item_type_pools.get_item_type(1552).make(10 * count))
 
         return loots
 
@@ -388,18 +406,16 @@ class BattleMapProcessor_6(BaseBattleMapProcessor):
         monsters = super().get_monsters()
         if self.chara.has_equipped_ability_type(39) and randint(1, 50) == 1:
             # 魔王
-            monsters[0] = Monster.objects.get(id=41)
+            monsters[0] = battle_templates.get_monster(41)
 
         return monsters
 
-    def get_monster_loots(self):
-        loots = super().get_monster_loots()
+    def get_monster_loots(self, n):
+        loots = super().get_monster_loots(n)
         for monster in self.monsters:
             # 魔王
             if monster.id == 41:
-                if self.rand_loot(250):
-                    group = ItemTypePoolGroup.objects.get(id=7)
-                    loots.extend(group.pick())
+                loots.extend(item_type_pools.pick_group(7, self.rand_loot(250, n)))
 
         return loots
 
@@ -487,8 +503,8 @@ class BattleMapProcessor_11(BaseBattleMapProcessor):
 class BattleMapProcessor_12(BaseBattleMapProcessor):
     id = 12
 
-    def get_map_loots(self):
-        return super().get_map_loots() + ItemType.objects.get(id=482).make(1)
+    def get_map_loots(self, n):
+        return super().get_map_loots(n) + item_type_pools.get_item_type(482).make(n)
 
 
 # 冒險者的試煉
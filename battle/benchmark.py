@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import random
+from glob import glob
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import localtime
+
+from ability.models import Ability
+from battle.battle import Battle
+from battle.battle_map_processors import BATTLE_MAP_PROCESSORS
+from battle.models import BattleMap, Monster, DungeonFloor, WorldBoss, WorldBossTemplate, WorldBossAttribute, WorldBossSkillSetting
+from chara.models import Chara, CharaAttribute, CharaSkillSetting, CharaSlot, CharaPartner
+from item.models import ItemType
+from job.models import Skill
+from team.models import Team
+from user.models import User
+from world.models import AttributeType, ElementType, Location
+
+FIXTURE_APPS = ['world', 'ability', 'job', 'item', 'battle', 'chara']
+
+# 一次決定 LOOT_BATTLES 場戰鬥掉寶的地圖：魔王城、每場皆抽選群組的星空下的夜、每場皆掉落固定物品的傳說密地
+LOOT_BATTLE_MAP_IDS = [7, 11, 12]
+LOOT_BATTLES = 100
+
+# 比較結果時，數值變化超過門檻才視為退步；越大越差的指標
+LOWER_IS_BETTER = ['construction_ms', 'execute_ms', 'queries', 'log_bytes']
+HIGHER_IS_BETTER = ['actions_per_second']
+# 改變代表戰鬥或掉寶的結果不同
+OUTCOMES = ['actions', 'rounds', 'winners', 'loot_items']
+
+
+def load_fixtures():
+    # fixtures 之間互相參照，須在同一次 loaddata 中讀取
+    call_command('loaddata', *[
+        path for app in FIXTURE_APPS
+        for path in sorted(glob(os.path.join(settings.BASE_DIR, 'fixtures', app, '*.json')))
+    ], verbosity=0)
+
+
+class BenchmarkWorld:
+    """
+    以固定的亂數在空資料庫中建立測試用的角色、隊伍與神獸
+    """
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        # ItemType.make 使用全域亂數決定裝備品質
+        random.seed(seed)
+
+        self.user = User.objects.create(email='benchmark@example.com')
+        self.location = Location.objects.get(x=0, y=0)
+        self.abilities = list(Ability.objects.exclude(type_id=68).order_by('id'))
+        self.skills = list(Skill.objects.order_by('id'))
+        self.equipment_types = {
+            slot_type_id: list(ItemType.objects.filter(category_id=1, slot_type_id=slot_type_id).order_by('id'))
+            for slot_type_id in range(1, 5)
+        }
+
+        self.chara = self.create_chara('單人', element_type_id=1, partner_monster=Monster.objects.get(id=5))
+        self.team = self.create_team()
+        self.world_boss = self.create_world_boss()
+        self.mirror_charas = [
+            self.create_chara(f'鏡像{element_type.name}', element_type_id=element_type.id)
+            for element_type in ElementType.objects.order_by('id')
+        ]
+
+    def create_chara(self, name, element_type_id, partner_monster=None):
+        chara = Chara.objects.create(
+            user=self.user, name=name, hp=30000, mp=5000, hp_max=30000, mp_max=5000, job_id=1,
+            location=self.location, element_type_id=element_type_id
+        )
+        chara.init()
+
+        for attribute in CharaAttribute.objects.filter(chara=chara):
+            attribute.value = self.rng.randint(800, 3000)
+            attribute.save()
+
+        # 裝備皆與角色同屬性，觸發各屬性的武防特效
+        for slot in CharaSlot.objects.filter(chara=chara):
+            item = self.rng.choice(self.equipment_types[slot.type_id]).make(1)[0]
+            item.equipment.element_type_id = element_type_id
+            item.equipment.save()
+            slot.item = item
+            slot.save()
+
+        chara.main_ability, chara.job_ability, chara.live_ability = self.rng.sample(self.abilities, 3)
+        for order, skill in enumerate(self.rng.sample(self.skills, 3)):
+            CharaSkillSetting.objects.create(chara=chara, skill=skill, hp_percentage=100, mp_percentage=100,
+                                             order=order)
+
+        if partner_monster is not None:
+            chara.partner = CharaPartner.objects.create(chara=chara, target_monster=partner_monster,
+                                                        due_time=localtime() + timedelta(days=365))
+        chara.save()
+        return chara
+
+    def create_team(self):
+        members = [self.create_chara(f'隊員{i}', element_type_id=i + 2) for i in range(5)]
+        team = Team.objects.create(name='benchmark', leader=members[0])
+        Chara.objects.filter(id__in=[x.id for x in members]).update(team=team)
+        return team
+
+    def create_world_boss(self):
+        template = WorldBossTemplate.objects.order_by('id').first()
+        world_boss = WorldBoss.objects.create(
+            template=template, name='神獸', element_type_id=3, location=self.location,
+            hp=template.base_hp, hp_max=template.base_hp, mp=template.base_mp, mp_max=template.base_mp
+        )
+        WorldBossAttribute.objects.bulk_create([
+            WorldBossAttribute(world_boss=world_boss, type=attribute_type, value=template.base_attribute)
+            for attribute_type in AttributeType.objects.all()
+        ])
+        for order, skill in enumerate(self.rng.sample(self.skills, 2)):
+            WorldBossSkillSetting.objects.create(world_boss=world_boss, skill=skill, hp_percentage=100,
+                                                 mp_percentage=100, order=order)
+        world_boss.abilities.add(*self.rng.sample(self.abilities, 10))
+        return world_boss
+
+    def scenarios(self):
+        """
+        回傳 {名稱: seed -> Battle 參數}，參數中的 queryset 在建構 Battle 時才會讀取
+        """
+        return {
+            'demon_king': lambda seed: dict(
+                attackers=[Chara.objects.get(id=self.chara.id)], defenders=[Monster.objects.get(name='魔王')],
+                battle_type='pve', element_type=self.location.element_type
+            ),
+            'dungeon_floor': lambda seed: dict(
+                attackers=Team.objects.get(id=self.team.id).members.all(),
+                defenders=[x.monster for x in DungeonFloor.objects.get(dungeon_id=1, floor=3).monsters.all()],
+                battle_type='dungeon'
+            ),
+            'world_boss': lambda seed: dict(
+                attackers=Team.objects.get(id=self.team.id).members.all(),
+                defenders=[WorldBoss.objects.get(id=self.world_boss.id)],
+                battle_type='world_boss', element_type=self.world_boss.element_type
+            ),
+            'mirror_elements': lambda seed: (lambda chara: dict(
+                attackers=[chara], defenders=[chara], battle_type='mirror'
+            ))(Chara.objects.get(id=self.mirror_charas[seed % len(self.mirror_charas)].id)),
+        }
+
+    def loot_scenarios(self):
+        """
+        回傳 {名稱: () -> 地圖的 processor}，processor 已設定好怪物與隊伍成員，可直接呼叫 get_loots
+        """
+        def make_processor(battle_map_id):
+            chara = Chara.objects.get(id=self.chara.id)
+            processor = BATTLE_MAP_PROCESSORS[battle_map_id](chara, BattleMap.objects.get(id=battle_map_id))
+            processor.monsters = processor.get_monsters()
+            battle = Battle(attackers=[chara], defenders=processor.monsters, battle_type='pve')
+            processor.team_members = [x for x in battle.charas if x.team == 'attacker']
+            return processor
+
+        return {
+            f'loot_map_{battle_map_id}': (lambda battle_map_id: lambda: make_processor(battle_map_id))(battle_map_id)
+            for battle_map_id in LOOT_BATTLE_MAP_IDS
+        }
+
+
+def run_scenario(make_kwargs, seeds):
+    construction_time = 0
+    execute_time = 0
+    queries = 0
+    log_bytes = 0
+    actions = 0
+    rounds = 0
+    winners = Counter()
+
+    for seed in seeds:
+        kwargs = make_kwargs(seed)
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            battle = Battle(seed=seed, **kwargs)
+            construction_time += time.perf_counter() - start
+
+        # 只量測戰鬥本身，不經過 process pool
+        start = time.perf_counter()
+        battle.run()
+        execute_time += time.perf_counter() - start
+
+        queries += len(context.captured_queries)
+        log_bytes += len(json.dumps(battle.logs, ensure_ascii=False).encode())
+        actions += battle.actions
+        rounds += battle.rounds
+        winners[battle.winner] += 1
+
+    n = len(seeds)
+    return {
+        'construction_ms': construction_time / n * 1000,
+        'execute_ms': execute_time / n * 1000,
+        'actions_per_second': actions / execute_time,
+        'queries': queries / n,
+        'log_bytes': log_bytes / n,
+        'actions': actions / n,
+        'rounds': rounds / n,
+        'winners': dict(winners),
+    }
+
+
+def run_loot_scenario(make_processor, seeds, n=LOOT_BATTLES):
+    loot_time = 0
+    queries = 0
+    loot_items = Counter()
+
+    # 物品類型與抽選池在每個 process 第一次使用時讀取，不計入量測
+    make_processor().get_loots(n)
+
+    for seed in seeds:
+        processor = make_processor()
+        # 掉寶使用全域亂數
+        random.seed(seed)
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            loots = processor.get_loots(n)
+            loot_time += time.perf_counter() - start
+
+        queries += len(context.captured_queries)
+        for item in loots:
+            loot_items[item.type.name] += item.number
+
+    return {
+        'execute_ms': loot_time / len(seeds) * 1000,
+        'queries': queries / len(seeds),
+        'loot_items': dict(loot_items),
+    }
+
+
+def run_benchmark(world, seeds, scenario_names=None):
+    results = {}
+    for name, make_kwargs in world.scenarios().items():
+        if scenario_names and name not in scenario_names:
+            continue
+        results[name] = run_scenario(make_kwargs, seeds)
+    for name, make_processor in world.loot_scenarios().items():
+        if scenario_names and name not in scenario_names:
+            continue
+        results[name] = run_loot_scenario(make_processor, seeds)
+    return results
+
+
+def compare_results(previous, current, threshold):
+    """
+    回傳 [(場景, 指標, 舊值, 新值, 變化比例, 是否退步)]
+    OUTCOMES 改變代表戰鬥或掉寶結果不同，也視為退步；掉寶場景只有部分指標
+    """
+    rows = []
+    for name, result in current.items():
+        if name not in previous:
+            continue
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if key not in result:
+                continue
+            old, new = previous[name][key], result[key]
+            change = (new - old) / old if old else 0
+            regressed = change > threshold if key in LOWER_IS_BETTER else change < -threshold
+            rows.append((name, key, old, new, change, regressed))
+        for key in OUTCOMES:
+            if key in result and previous[name][key] != result[key]:
+                rows.append((name, key, previous[name][key], result[key], None, True))
+    return rows
@@ -0,0 +1,214 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+import django
+from django.conf import settings
+from rest_framework import serializers
+
+# 戰鬥屬於純 CPU 運算，交給獨立的 process pool 執行，避免佔住 ASGI worker 的 GIL
+pool = None
+in_worker = False
+worker_loader = None
+# 已送出但尚未結束的工作數，逾時的工作仍佔用 worker 直到實際結束為止
+pending = 0
+pending_lock = threading.Lock()
+
+BATTLE_STATE_FIELDS = ['executed', 'rounds', 'actions', 'stalemate', 'logs', 'last_profiles', 'rng', 'params']
+# 戰鬥中會改變的角色欄位，其餘欄位與主程序建立的角色相同，不從 worker 複製回來
+BATTLE_CHARA_STATE_FIELDS = [
+    'hp', 'hp_max', 'mp', 'action_points', 'attack_add_on', 'defense_add_on', 'magic_defense_add_on',
+    'speed_add_on', 'effects', 'eva_add', 'poison', 'bleed', 'buff_count', 'blocked_ability_count',
+    'weapon_effect_blocked', 'weapon_effect_blocked_flag', 'reduced_skill_rate', 'vulnerable', 'damage_dealt',
+    'skill_counter'
+]
+
+
+def init_worker():
+    global in_worker, worker_loader
+    django.setup()
+
+    from battle.loader import BattleSourceLoader
+    in_worker = True
+    worker_loader = BattleSourceLoader()
+
+
+def get_pool():
+    global pool
+    if in_worker or settings.BATTLE_EXECUTOR['POOL_SIZE'] <= 0:
+        return None
+
+    if pool is None:
+        pool = ProcessPoolExecutor(
+            max_workers=settings.BATTLE_EXECUTOR['POOL_SIZE'],
+            mp_context=get_context('spawn'),
+            initializer=init_worker
+        )
+    return pool
+
+
+def finish_task(future):
+    global pending
+    with pending_lock:
+        pending -= 1
+
+
+def submit(pool, fn, *args, check_pending=True):
+    """
+    pool 中等待與執行中的工作已達 MAX_PENDING 時直接拒絕，不排隊等待逾時
+    """
+    global pending
+    max_pending = settings.BATTLE_EXECUTOR['MAX_PENDING'] or settings.BATTLE_EXECUTOR['POOL_SIZE'] * 2
+    with pending_lock:
+        if check_pending and pending >= max_pending:
+            raise serializers.ValidationError("伺服器忙碌中，請稍後再試")
+        pending += 1
+    try:
+        future = pool.submit(fn, *args)
+    except BaseException:
+        finish_task(None)
+        raise
+    future.add_done_callback(finish_task)
+    return future
+
+
+def wait_futures(futures):
+    """
+    等待所有工作完成，逾時時取消尚未開始的工作並回傳錯誤
+    已在 worker 中執行的工作無法中斷，不在目前的 process 中重新執行，避免重複運算
+    """
+    done, not_done = wait(futures, timeout=settings.BATTLE_EXECUTOR['TIMEOUT'])
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        raise serializers.ValidationError("戰鬥執行逾時，請稍後再試")
+    return [future.result() for future in futures]
+
+
+def reset_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    pool = None
+
+
+def serialize_equipment(equipment):
+    from battle.loader import EmptyEquipment
+
+    return None if isinstance(equipment, EmptyEquipment) else equipment.serialize()
+
+
+def get_chara_state(chara):
+    """
+    奧義與裝備指向 loader 的物件，只回傳封印後剩下的奧義與各欄位裝備的內容
+    """
+    state = {field: getattr(chara, field) for field in BATTLE_CHARA_STATE_FIELDS}
+    state['ability_type_ids'] = list(chara.ability_types)
+    state['equipments'] = [[slot, serialize_equipment(equipment)] for slot, equipment in chara.equipments.items()]
+    return state
+
+
+def run_battle(replay_data, log_level, instrument):
+    """
+    在 worker 中以參戰者資料重建並執行戰鬥，回傳戰鬥結束時的狀態
+    """
+    from battle.battle import Battle
+
+    battle = Battle.from_replay_data(replay_data, log_level=log_level, loader=worker_loader, instrument=instrument)
+    battle.run()
+    return {
+        'battle': {field: getattr(battle, field) for field in BATTLE_STATE_FIELDS},
+        'metrics': battle.metrics,
+        'charas': [get_chara_state(chara) for chara in battle.charas]
+    }
+
+
+def run_battle_summaries(replay_data, seeds):
+    """
+    以不同的 seed 重複執行同一場戰鬥，只回傳勝負、回合數與各角色的傷害、技能發動次數
+    """
+    from battle.battle import Battle
+    from battle.loader import BattleSourceLoader
+
+    loader = worker_loader or BattleSourceLoader()
+    summaries = []
+    for seed in seeds:
+        battle = Battle.from_replay_data(dict(replay_data, seed=seed), log_level='summary', loader=loader,
+                                         instrument=False)
+        battle.run()
+        summaries.append({
+            'winner': battle.winner,
+            'rounds': battle.rounds,
+            'charas': [[chara.damage_dealt, dict(chara.skill_counter)] for chara in battle.charas],
+        })
+    return summaries
+
+
+def apply_state(battle, state):
+    from battle.loader import EmptyEquipment, EquipmentSnapshot
+
+    for field, value in state['battle'].items():
+        setattr(battle, field, value)
+
+    for chara, chara_state in zip(battle.charas, state['charas']):
+        for field in BATTLE_CHARA_STATE_FIELDS:
+            setattr(chara, field, chara_state[field])
+        chara.ability_types = {
+            type_id: ability for type_id, ability in chara.ability_types.items()
+            if type_id in chara_state['ability_type_ids']
+        }
+        # 只替換被卸下或複製的裝備
+        for slot, equipment in chara_state['equipments']:
+            if serialize_equipment(chara.equipments[slot]) != equipment:
+                chara.equipments[slot] = EmptyEquipment() if equipment is None else EquipmentSnapshot(*equipment)
+        chara.invalidate_stats()
+        chara.compile_hooks()
+    battle.update_rosters()
+
+    if battle.metrics is not None:
+        battle.metrics.merge_execution(state['metrics'])
+
+
+def execute_battle(battle):
+    """
+    POOL_SIZE 為 0 時在目前的 process 中執行，pool 損壞時重建 pool 並改在目前的 process 中執行
+    pool 忙碌或逾時時回傳錯誤
+    """
+    pool = get_pool()
+    if pool is None:
+        battle.run()
+        return
+
+    try:
+        future = submit(pool, run_battle, battle.replay_data(), battle.log_level, battle.metrics is not None)
+        state, = wait_futures([future])
+    except BrokenProcessPool:
+        reset_pool()
+        battle.run()
+    else:
+        apply_state(battle, state)
+
+
+def execute_battles(replay_data, seeds, chunk_size=50):
+    """
+    將 seeds 分批交給 pool 中的 worker 執行，pool 忙碌、損壞或逾時時回傳錯誤
+    """
+    seeds = list(seeds)
+    chunks = [seeds[i:i + chunk_size] for i in range(0, len(seeds), chunk_size)]
+
+    pool = get_pool()
+    if pool is None:
+        return run_battle_summaries(replay_data, seeds)
+
+    try:
+        # 只在送出第一批前檢查是否忙碌，同一次模擬的批次不會被拒絕到一半
+        futures = [
+            submit(pool, run_battle_summaries, replay_data, chunk, check_pending=i == 0)
+            for i, chunk in enumerate(chunks)
+        ]
+        results = wait_futures(futures)
+    except BrokenProcessPool:
+        reset_pool()
+        raise serializers.ValidationError("戰鬥執行失敗，請稍後再試")
+    return [summary for summaries in results for summary in summaries]
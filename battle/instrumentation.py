@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+from time import perf_counter
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger('battle.metrics')
+
+# 在 worker 中執行的階段，由 worker 的紀錄取代
+EXECUTION_TIMINGS = ['before_execute', 'loop', 'finalization']
+
+
+class BattleMetrics:
+    """
+    單場戰鬥的耗時（秒）與計數
+    ability_lookups 為角色擁有該奧義時，查詢該奧義的次數，不等於奧義效果實際發動的次數
+    """
+
+    def __init__(self, battle_type, seed):
+        self.battle_type = battle_type
+        self.seed = seed
+        self.timings = Counter()
+        self.counters = Counter()
+        self.skill_casts = Counter()
+        self.ability_lookups = Counter()
+        self.reported = False
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += perf_counter() - start
+
+    def merge_execution(self, metrics):
+        for name in EXECUTION_TIMINGS:
+            self.timings[name] = metrics.timings[name]
+        self.counters = metrics.counters
+        self.skill_casts = metrics.skill_casts
+        self.ability_lookups = metrics.ability_lookups
+
+    def as_dict(self):
+        return {
+            'battle_type': self.battle_type,
+            'seed': self.seed,
+            'timings': {name: round(value * 1000, 3) for name, value in self.timings.items()},
+            'counters': dict(self.counters),
+            'skill_casts': dict(self.skill_casts),
+            'ability_lookups': dict(self.ability_lookups),
+        }
+
+    def report(self):
+        """
+        輸出一行 JSON 並計入統計，之後只回報新增的部分（例如保存戰鬥結果的耗時）
+        """
+        logger.info(json.dumps(self.as_dict(), ensure_ascii=False))
+        battle_metrics.add(self, new_battle=not self.reported)
+
+        self.reported = True
+        self.timings = Counter()
+        self.counters = Counter()
+        self.skill_casts = Counter()
+        self.ability_lookups = Counter()
+
+
+class BattleMetricsAggregator:
+    """
+    依 battle_type 累計本 process 的戰鬥統計
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.battles = Counter()
+        self.timings = defaultdict(Counter)
+        self.counters = defaultdict(Counter)
+        self.skill_casts = defaultdict(Counter)
+        self.ability_lookups = defaultdict(Counter)
+
+    def add(self, metrics, new_battle=True):
+        battle_type = metrics.battle_type
+        if new_battle:
+            self.battles[battle_type] += 1
+        self.timings[battle_type].update(metrics.timings)
+        self.counters[battle_type].update(metrics.counters)
+        self.skill_casts[battle_type].update(metrics.skill_casts)
+        self.ability_lookups[battle_type].update(metrics.ability_lookups)
+
+    def summary(self):
+        return {
+            'pid': os.getpid(),
+            'battle_types': {
+                battle_type: {
+                    'battles': n,
+                    'average_timings': {
+                        name: round(value / n * 1000, 3) for name, value in self.timings[battle_type].items()
+                    },
+                    'total_timings': {
+                        name: round(value * 1000, 3) for name, value in self.timings[battle_type].items()
+                    },
+                    'counters': dict(self.counters[battle_type]),
+                    'skill_casts': dict(self.skill_casts[battle_type].most_common()),
+                    'ability_lookups': dict(self.ability_lookups[battle_type].most_common()),
+                }
+                for battle_type, n in self.battles.items()
+            }
+        }
+
+
+battle_metrics = BattleMetricsAggregator()
@@ -0,0 +1,424 @@
+from time import monotonic
+from collections import defaultdict
+from django.apps import apps
+from django.conf import settings
+from django.db.models import F
+from django.utils.timezone import localtime
+
+from ability.models import Ability
+from battle.models import BattleEffect, BattleMapMonster, BattleTemplateVersion, Monster, WorldBoss
+from chara.models import Chara, CharaSlot, CharaBuff, CharaBuffType, CharaPartner
+from job.models import Skill
+from npc.models import NPC
+from world.models import ElementType, AttributeType
+
+
+class EmptyEquipment:
+    name = '無裝備'
+
+    attack = 0
+    defense = 0
+    weight = 0
+
+    ability_1 = None
+    ability_2 = None
+
+    element_type_id = None
+
+
+class EquipmentSnapshot:
+    def __init__(self, name, attack, defense, weight, element_type_id):
+        self.name = name
+        self.attack = attack
+        self.defense = defense
+        self.weight = weight
+        self.element_type_id = element_type_id
+
+    @classmethod
+    def from_equipment(cls, equipment):
+        return cls(equipment.display_name, equipment.attack, equipment.defense, equipment.weight,
+                   equipment.element_type_id)
+
+    def serialize(self):
+        return [self.name, self.attack, self.defense, self.weight, self.element_type_id]
+
+
+SKILL_SETTING_FIELDS = [
+    'hp_percentage', 'mp_percentage', 'defender_hp_percentage', 'defender_mp_percentage',
+    'times_limit', 'probability', 'order'
+]
+SKILL_FIELDS = ['id', 'name', 'type_id', 'power', 'rate', 'mp_cost', 'action_cost']
+ABILITY_FIELDS = ['id', 'name', 'type_id', 'power']
+BATTLE_EFFECT_FIELDS = ['id', 'name', 'type_id', 'value']
+
+
+def serialize_fields(obj, fields):
+    return [getattr(obj, field) for field in fields]
+
+
+def deserialize_fields(model, fields, values, **kwargs):
+    return model(**dict(zip(fields, values)), **kwargs)
+
+
+def serialize_ability(ability):
+    return serialize_fields(ability, ABILITY_FIELDS)
+
+
+def deserialize_ability(data):
+    return deserialize_fields(Ability, ABILITY_FIELDS, data)
+
+
+class BattleCharaSnapshot:
+    """
+    BattleChara 建構所需的資料，由 BattleSourceLoader 批次讀取
+    可序列化為 JSON，用於重播戰鬥
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.source_model = type(source)
+        self.name = source.name
+        self.is_admin = getattr(source, 'is_admin', False)
+        self.element_type = None
+        self.luck_sigmoid = 0.5
+
+        if isinstance(source, (Chara, WorldBoss)):
+            self.hp, self.hp_max, self.mp, self.mp_max = source.hp, source.hp_max, source.mp, source.mp_max
+        else:
+            self.hp = self.hp_max = source.hp
+            self.mp = self.mp_max = source.mp
+
+        self.attributes = []
+        self.skill_settings = []
+        self.equipments = {}
+        self.battle_effects = []
+        self.ability_types = {}
+        self.buff_effects = {}
+        self.partner = None
+
+    def buff_effect_power(self, effect_id):
+        try:
+            return self.buff_effects[effect_id].power
+        except KeyError:
+            return 0
+
+    def serialize(self):
+        return {
+            'model': self.source_model._meta.label_lower,
+            'pk': self.source.pk,
+            'name': self.name,
+            'is_admin': self.is_admin,
+            'element_type': self.element_type.id,
+            'luck_sigmoid': self.luck_sigmoid,
+            'hp': [self.hp, self.hp_max, self.mp, self.mp_max],
+            'attributes': [[attr.type.id, attr.type.en_name, attr.value] for attr in self.attributes],
+            'skill_settings': [
+                [serialize_fields(x, SKILL_SETTING_FIELDS), serialize_fields(x.skill, SKILL_FIELDS)]
+                for x in self.skill_settings
+            ],
+            'equipments': [
+                [slot_type_id, None if isinstance(equipment, EmptyEquipment) else equipment.serialize()]
+                for slot_type_id, equipment in self.equipments.items()
+            ],
+            'battle_effects': [serialize_fields(x, BATTLE_EFFECT_FIELDS) for x in self.battle_effects],
+            'ability_types': [serialize_ability(x) for x in self.ability_types.values()],
+            'buff_effects': [[effect_id, x.power] for effect_id, x in self.buff_effects.items()],
+            'partner': None if self.partner is None else self.partner.serialize(),
+        }
+
+    @classmethod
+    def deserialize(cls, data, element_types):
+        model = apps.get_model(data['model'])
+        snapshot = cls(model(pk=data['pk'], name=data['name'], hp=0, mp=0))
+        snapshot.is_admin = data['is_admin']
+        snapshot.element_type = element_types[data['element_type']]
+        snapshot.luck_sigmoid = data['luck_sigmoid']
+        snapshot.hp, snapshot.hp_max, snapshot.mp, snapshot.mp_max = data['hp']
+
+        attribute_model = model._meta.get_field('attributes').related_model
+        snapshot.attributes = [
+            attribute_model(type=AttributeType(id=type_id, en_name=en_name), value=value)
+            for type_id, en_name, value in data['attributes']
+        ]
+        skill_setting_model = model._meta.get_field('skill_settings').related_model
+        snapshot.skill_settings = [
+            deserialize_fields(skill_setting_model, SKILL_SETTING_FIELDS, setting,
+                               skill=deserialize_fields(Skill, SKILL_FIELDS, skill))
+            for setting, skill in data['skill_settings']
+        ]
+        snapshot.equipments = {
+            slot_type_id: EmptyEquipment() if equipment is None else EquipmentSnapshot(*equipment)
+            for slot_type_id, equipment in data['equipments']
+        }
+        snapshot.battle_effects = [
+            deserialize_fields(BattleEffect, BATTLE_EFFECT_FIELDS, x) for x in data['battle_effects']
+        ]
+        snapshot.ability_types = {
+            ability.type_id: ability for ability in map(deserialize_ability, data['ability_types'])
+        }
+        snapshot.buff_effects = {
+            effect_id: CharaBuffType(effect_id=effect_id, power=power) for effect_id, power in data['buff_effects']
+        }
+        if data['partner'] is not None:
+            snapshot.partner = cls.deserialize(data['partner'], element_types)
+
+        return snapshot
+
+
+def group_by(objs, key):
+    groups = defaultdict(list)
+    for obj in objs:
+        groups[getattr(obj, key)].append(obj)
+    return groups
+
+
+def sort_ability_types(abilities):
+    return {
+        ability.type_id: ability
+        for ability in sorted(abilities, key=lambda x: x.power)
+    }
+
+
+def load_element_types():
+    element_types = {x.id: x for x in ElementType.objects.all()}
+    for element_type in element_types.values():
+        element_type.suppressed_by = element_types.get(element_type.suppressed_by_id)
+    return element_types
+
+
+def get_template_version():
+    return BattleTemplateVersion.objects.filter(id=1).values_list('version', flat=True).first() or 0
+
+
+def bump_template_version():
+    if not BattleTemplateVersion.objects.filter(id=1).update(version=F('version') + 1):
+        BattleTemplateVersion.objects.create(id=1, version=1)
+    battle_templates.checked_at = None
+
+
+class BattleTemplateCache:
+    """
+    怪物與 NPC 的戰鬥資料、屬性類型與地圖怪物權重只在重新匯入 fixtures 時變動，每個 process 讀取一次後共用
+    每隔 BATTLE_TEMPLATE_VERSION_CHECK_INTERVAL 秒比對 BattleTemplateVersion，版本改變時重新讀取
+    """
+    models = [Monster, NPC]
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = None
+        self.element_types = {}
+        self.monsters = {}
+        self.snapshots = {}
+        self.battle_map_monsters = {}
+
+    def check_version(self):
+        now = monotonic()
+        if self.checked_at is not None and now - self.checked_at < settings.BATTLE_TEMPLATE_VERSION_CHECK_INTERVAL:
+            return
+
+        version = get_template_version()
+        if version != self.version:
+            self.load()
+            self.version = version
+        self.checked_at = now
+
+    def load(self):
+        element_types = load_element_types()
+        monsters = Monster.objects.in_bulk()
+        npcs = NPC.objects.in_bulk()
+
+        loader = BattleSourceLoader(use_templates=False)
+        loader.element_types = element_types
+        snapshots = loader.load(list(monsters.values()) + list(npcs.values()))
+
+        battle_map_monsters = defaultdict(list)
+        for setting in BattleMapMonster.objects.order_by('id'):
+            battle_map_monsters[setting.battle_map_id].append(setting)
+
+        # 整批替換，讀取中的其他執行緒不會看到讀到一半的資料
+        self.element_types = element_types
+        self.monsters = monsters
+        self.snapshots = {(x.source_model, x.source.pk): x for x in snapshots}
+        self.battle_map_monsters = dict(battle_map_monsters)
+
+    def get_element_types(self):
+        self.check_version()
+        return self.element_types
+
+    def get_monster(self, pk):
+        self.check_version()
+        return self.monsters[pk]
+
+    def get_battle_map_monsters(self, battle_map_id):
+        self.check_version()
+        return self.battle_map_monsters.get(battle_map_id, [])
+
+    def apply(self, model, snapshots):
+        """
+        以快取的模板填入 snapshots，回傳快取中沒有的 snapshots
+        模板的屬性、技能設定與奧義為共用的物件，BattleChara 只會讀取
+        """
+        self.check_version()
+        missing = []
+        for snapshot in snapshots:
+            template = self.snapshots.get((model, snapshot.source.pk))
+            if template is None:
+                missing.append(snapshot)
+            else:
+                snapshot.attributes = template.attributes
+                snapshot.skill_settings = template.skill_settings
+                snapshot.ability_types = template.ability_types
+        return missing
+
+
+battle_templates = BattleTemplateCache()
+
+
+class BattleSourceLoader:
+    """
+    以固定數量的 query 讀取所有參戰者的屬性、技能設定、裝備、奧義、buff 與夥伴
+    summon_filter(partner) 回傳 True 的夥伴才會被讀取
+    已是 BattleCharaSnapshot 的參戰者不會重新讀取，怪物與 NPC 由 battle_templates 提供
+    """
+
+    def __init__(self, summon_filter=None, use_templates=True):
+        self.summon_filter = summon_filter
+        self.use_templates = use_templates
+        self.element_types = None
+
+    def get_element_types(self):
+        if self.element_types is None:
+            if self.use_templates:
+                self.element_types = battle_templates.get_element_types()
+            else:
+                self.element_types = load_element_types()
+        return self.element_types
+
+    def deserialize(self, data):
+        return BattleCharaSnapshot.deserialize(data, self.get_element_types())
+
+    def load(self, sources, with_partners=True):
+        snapshots = [
+            source if isinstance(source, BattleCharaSnapshot) else BattleCharaSnapshot(source)
+            for source in sources
+        ]
+        new_snapshots = [snapshot for snapshot, source in zip(snapshots, sources) if snapshot is not source]
+
+        for model, model_snapshots in group_by(new_snapshots, 'source_model').items():
+            if self.use_templates and model in BattleTemplateCache.models:
+                model_snapshots = battle_templates.apply(model, model_snapshots)
+                if not model_snapshots:
+                    continue
+
+            pks = {x.source.pk for x in model_snapshots}
+            self.load_attributes(model, pks, model_snapshots)
+            self.load_skill_settings(model, pks, model_snapshots)
+
+            if model is Chara:
+                self.load_chara(pks, model_snapshots, with_partners)
+            else:
+                self.load_monster_abilities(model, pks, model_snapshots)
+
+        if new_snapshots:
+            element_types = self.get_element_types()
+            for snapshot in new_snapshots:
+                snapshot.element_type = element_types[snapshot.source.element_type_id]
+
+        return snapshots
+
+    def load_attributes(self, model, pks, snapshots):
+        field = model._meta.get_field('attributes')
+        queryset = field.related_model.objects.filter(**{f'{field.field.name}__in': pks}).select_related('type')
+        attributes = group_by(queryset, field.field.attname)
+
+        for snapshot in snapshots:
+            snapshot.attributes = attributes[snapshot.source.pk]
+
+    def load_skill_settings(self, model, pks, snapshots):
+        field = model._meta.get_field('skill_settings')
+        queryset = field.related_model.objects.filter(
+            **{f'{field.field.name}__in': pks}
+        ).order_by('order', 'id').select_related('skill')
+        skill_settings = group_by(queryset, field.field.attname)
+
+        for snapshot in snapshots:
+            snapshot.skill_settings = skill_settings[snapshot.source.pk]
+
+    def load_monster_abilities(self, model, pks, snapshots):
+        field = model._meta.get_field('abilities')
+        source_field_name = field.m2m_field_name()
+        target_field_name = field.m2m_reverse_field_name()
+
+        queryset = field.remote_field.through.objects.filter(
+            **{f'{source_field_name}__in': pks}
+        ).select_related(target_field_name)
+        abilities = defaultdict(list)
+        for relation in queryset:
+            abilities[getattr(relation, f'{source_field_name}_id')].append(getattr(relation, target_field_name))
+
+        for snapshot in snapshots:
+            snapshot.ability_types = sort_ability_types(abilities[snapshot.source.pk])
+
+    def load_chara(self, pks, snapshots, with_partners):
+        # 裝備
+        slots = group_by(
+            CharaSlot.objects.filter(chara__in=pks).select_related(
+                'item__equipment__battle_effect', 'item__equipment__type'
+            ),
+            'chara_id'
+        )
+        # buff
+        buffs = group_by(
+            CharaBuff.objects.filter(chara__in=pks, due_time__gt=localtime()).select_related('type'),
+            'chara_id'
+        )
+
+        chara_ability_ids = {}
+        for snapshot in snapshots:
+            chara = snapshot.source
+            snapshot.luck_sigmoid = chara.luck_sigmoid
+            ability_ids = {chara.main_ability_id, chara.job_ability_id, chara.live_ability_id}
+
+            for slot in slots[chara.pk]:
+                if slot.item:
+                    equipment = slot.item.equipment
+                    snapshot.equipments[slot.type_id] = EquipmentSnapshot.from_equipment(equipment)
+                    ability_ids.update([equipment.ability_1_id, equipment.ability_2_id])
+                    if equipment.battle_effect:
+                        snapshot.battle_effects.append(equipment.battle_effect)
+                else:
+                    snapshot.equipments[slot.type_id] = EmptyEquipment()
+
+            snapshot.buff_effects = {
+                buff.type.effect_id: buff.type
+                for buff in sorted(buffs[chara.pk], key=lambda x: x.type.power)
+            }
+            ability_ids.discard(None)
+            chara_ability_ids[chara.pk] = ability_ids
+
+        # 奧義
+        abilities = Ability.objects.in_bulk(set().union(*chara_ability_ids.values()))
+        for snapshot in snapshots:
+            snapshot.ability_types = sort_ability_types(
+                abilities[ability_id] for ability_id in sorted(chara_ability_ids[snapshot.source.pk])
+            )
+
+        # 夥伴
+        partner_ids = {x.source.partner_id for x in snapshots if x.source.partner_id is not None}
+        if not with_partners or not partner_ids or self.summon_filter is None:
+            return
+
+        partners = CharaPartner.objects.filter(id__in=partner_ids).select_related(
+            'target_chara', 'target_monster', 'target_npc'
+        ).in_bulk()
+        partner_snapshots = []
+        for snapshot in snapshots:
+            partner = partners.get(snapshot.source.partner_id)
+            if partner is not None and self.summon_filter(partner):
+                partner_snapshots.append(snapshot)
+                snapshot.partner = partner.target_chara or partner.target_monster or partner.target_npc
+
+        # 夥伴不會再召喚自己的夥伴
+        targets = self.load([x.partner for x in partner_snapshots], with_partners=False)
+        for snapshot, target in zip(partner_snapshots, targets):
+            snapshot.partner = target
@@ -0,0 +1,78 @@
+LOG_FORMATS = ['full', 'delta']
+LOG_LEVELS = ['full', 'summary']
+
+
+def diff_profiles(prev_profiles, profiles):
+    """
+    回傳 {角色index: 有變化的欄位}
+    """
+    changes = {}
+    for index, (prev_profile, profile) in enumerate(zip(prev_profiles, profiles)):
+        changed_fields = {key: value for key, value in profile.items() if prev_profile[key] != value}
+        if changed_fields:
+            changes[index] = changed_fields
+    return changes
+
+
+def decode_logs(logs):
+    """
+    將 delta 格式的戰鬥紀錄展開為每個 action 皆帶有完整 charas 的格式，full 格式則原樣回傳
+    """
+    if not logs or logs[0].get('log_format') != 'delta':
+        return logs
+
+    profiles = []
+    decoded_logs = []
+    for log in logs:
+        log = dict(log)
+        log.pop('log_format', None)
+
+        if 'charas' in log:
+            profiles = log['charas']
+        elif 'chara_changes' in log:
+            profiles = [dict(profile) for profile in profiles]
+            for index, changed_fields in log.pop('chara_changes').items():
+                profiles[int(index)].update(changed_fields)
+            log['charas'] = profiles
+
+        decoded_logs.append(log)
+
+    return decoded_logs
+
+
+def encode_logs(logs):
+    """
+    將 full 格式的戰鬥紀錄轉為只在第一筆保存完整 charas 的 delta 格式，delta 格式則原樣回傳
+    """
+    if not logs or logs[0].get('log_format') == 'delta':
+        return logs
+
+    profiles = None
+    encoded_logs = []
+    for log in logs:
+        log = dict(log)
+        if 'charas' in log:
+            charas = log.pop('charas')
+            if profiles is None:
+                log['charas'] = charas
+            else:
+                log['chara_changes'] = diff_profiles(profiles, charas)
+            profiles = charas
+        encoded_logs.append(log)
+
+    encoded_logs[0]['log_format'] = 'delta'
+    return encoded_logs
+
+
+def encode_result(result):
+    if isinstance(result, dict) and isinstance(result.get('logs'), list):
+        result = dict(result)
+        result['logs'] = encode_logs(result['logs'])
+    return result
+
+
+def decode_result(result):
+    if isinstance(result, dict) and isinstance(result.get('logs'), list):
+        result = dict(result)
+        result['logs'] = decode_logs(result['logs'])
+    return result
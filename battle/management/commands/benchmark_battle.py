@@ -0,0 +1,72 @@
+import sys
+import json
+import platform
+import subprocess
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from battle.benchmark import load_fixtures, BenchmarkWorld, run_benchmark, compare_results, LOOT_BATTLES
+
+
+class Command(BaseCommand):
+    help = "在獨立的測試資料庫中讀取 fixtures，量測各戰鬥場景的效能"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seeds', type=int, default=20, help="每個場景執行的場數")
+        parser.add_argument('--scenario', action='append', help="只執行指定的場景，可重複指定")
+        parser.add_argument('--output', help="將結果存成 JSON")
+        parser.add_argument('--compare', help="與先前存下的 JSON 結果比較")
+        parser.add_argument('--threshold', type=float, default=0.1, help="視為退步的變化比例")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            load_fixtures()
+            world = BenchmarkWorld()
+            results = run_benchmark(world, range(options['seeds']), options['scenario'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, result in results.items():
+            if 'loot_items' in result:
+                self.stdout.write(
+                    f"{name:16s} get_loots({LOOT_BATTLES}) {result['execute_ms']:8.2f}ms  "
+                    f"{result['queries']:5.1f} queries  {sum(result['loot_items'].values()) / options['seeds']:6.1f} items"
+                )
+                continue
+            self.stdout.write(
+                f"{name:16s} construction {result['construction_ms']:8.2f}ms  execute {result['execute_ms']:8.2f}ms  "
+                f"{result['actions_per_second']:8.0f} actions/s  {result['queries']:5.1f} queries  "
+                f"{result['log_bytes']:9.0f} log bytes"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'commit': self.get_commit(),
+                    'python': platform.python_version(),
+                    'seeds': options['seeds'],
+                    'results': results,
+                }, f, ensure_ascii=False, indent=2)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+            rows = compare_results(previous['results'], results, options['threshold'])
+            for name, key, old, new, change, regressed in rows:
+                change = '' if change is None else f"{change:+.1%}"
+                style = self.style.ERROR if regressed else self.style.SUCCESS
+                self.stdout.write(style(f"{name:16s} {key:20s} {self.format(old)} -> {self.format(new)} {change}"))
+            if any(row[-1] for row in rows):
+                sys.exit(1)
+
+    def format(self, value):
+        return f"{value:.2f}" if isinstance(value, float) else value
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
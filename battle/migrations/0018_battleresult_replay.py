@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('battle', '0017_alter_battleeffect_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battleresult',
+            name='replay',
+            field=models.JSONField(null=True),
+        ),
+    ]
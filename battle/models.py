@@ -1,4 +1,8 @@
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+from django.utils.timezone import localtime
+
 from base.models import BaseModel, BaseSkillSetting
 
 
@@ -54,6 +58,13 @@ class BattleMapMonster(BaseModel):
     weight = models.PositiveIntegerField(default=10000)
 
 
+class BattleTemplateVersion(BaseModel):
+    """
+    怪物、NPC、技能等戰鬥模板的版本，模板變動時遞增，各 process 據此重新讀取快取
+    """
+    version = models.PositiveIntegerField(default=0)
+
+
 class Dungeon(BaseModel):
     name = models.CharField(max_length=20, unique=True)
     description = models.TextField(blank=True)
@@ -92,6 +103,8 @@ class BattleResult(BaseModel):
     category = models.CharField(max_length=20)
     title = models.CharField(max_length=100)
     content = models.JSONField()
+    # 有 replay 時 content 不保存戰鬥紀錄，讀取時以 Battle.replay 重新產生
+    replay = models.JSONField(null=True)
 
 
 # 神獸
@@ -129,6 +142,33 @@ class WorldBoss(BaseModel):
 
     abilities = models.ManyToManyField("ability.Ability")
 
+    def apply_damage(self, damage, mp_used):
+        """
+        將以 HP、MP 快照進行的戰鬥結果套用至目前的神獸，回傳實際造成的傷害與是否擊敗神獸
+        傷害超過剩餘 HP 時只計入剩餘 HP，使 HP 歸零的隊伍擊敗神獸；神獸已被擊敗時回傳 None
+        戰鬥中回復的 HP、MP 不套用，HP、MP 不超過上限
+        """
+        damage = max(0, damage)
+        mp_used = max(0, mp_used)
+        queryset = type(self).objects.filter(pk=self.pk, is_alive=True)
+        mp_min = int(self.mp_max * 0.2)
+        updates = {
+            'mp': Greatest(F('mp') - mp_used, Value(mp_min)),
+            'updated_at': localtime(),
+        }
+
+        # 剩餘 HP 足夠時直接扣除，不需要先讀取
+        if queryset.filter(hp__gt=damage).update(hp=Least(F('hp') - damage, F('hp_max')), **updates):
+            return damage, False
+
+        world_boss = queryset.select_for_update().first()
+        if world_boss is None:
+            return None
+        damage = min(damage, world_boss.hp)
+        killed = (damage == world_boss.hp)
+        queryset.update(hp=min(world_boss.hp - damage, world_boss.hp_max), is_alive=not killed, **updates)
+        return damage, killed
+
 
 class WorldBossAttribute(BaseModel):
     world_boss = models.ForeignKey("battle.WorldBoss", on_delete=models.CASCADE, related_name="attributes")
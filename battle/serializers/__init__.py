@@ -1,12 +1,15 @@
 import math
 import random
+from django.conf import settings
 from django.db.models import F
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.timezone import localtime
 
 from rest_framework import serializers
 
 from battle.models import BattleMap, Dungeon, DungeonFloor, BattleResult, WorldBoss, Arena, Monster
 from chara.models import Chara
+from npc.models import NPC
 from item.models import Item
 from trade.models import Parcel
 from team.models import TeamDungeonRecord, Team
@@ -15,6 +18,8 @@ from item.serializers import ItemTypeSerializer, ItemSerializer
 from world.serializers import ElementTypeSerializer, LocationSerializer, AttributeTypeSerializer
 from battle.battle_map_processors import BATTLE_MAP_PROCESSORS
 from battle.battle import Battle
+from battle.utils import create_battle_result
+from battle.simulation import simulate_battle
 
 from chara.achievement import update_achievement_counter
 from system.utils import push_log, send_private_message_by_system
@@ -87,7 +92,7 @@ class PvPFightSerializer(BaseSerializer):
             'messages': [f"PvP點數{points if points < 0 else f'+{points}' }"]
         }
 
-        BattleResult.objects.create(title=f"{chara.name}vs{opponent.name}", content=result)
+        create_battle_result(f"{chara.name}vs{opponent.name}", result, battle)
 
         return result
 
@@ -113,6 +118,46 @@ class MirrorFightSerializer(BaseSerializer):
         }
 
 
+class BattleSimulationSerializer(BaseSerializer):
+    target_models = {
+        'monster': Monster,
+        'npc': NPC,
+        'chara': Chara,
+    }
+
+    target_type = serializers.ChoiceField(choices=list(target_models.keys()))
+    target_id = serializers.IntegerField()
+    times = serializers.IntegerField(min_value=1, required=False)
+
+    def save(self):
+        target = self.validated_data['target']
+        times = self.validated_data['times']
+        battle = Battle(attackers=[self.chara], defenders=[target], battle_type='mirror', log_level='summary')
+        result = simulate_battle(battle, times)
+
+        # 角色在檢查行動時間時已鎖定，同一角色的模擬不會同時執行
+        self.chara.set_next_action_time(math.ceil(times / settings.BATTLE_SIMULATION['TIMES_PER_ACTION']))
+        self.chara.save()
+
+        return result
+
+    def validate(self, data):
+        # 未啟用 process pool 時模擬會佔用 ASGI worker，不開放
+        if settings.BATTLE_EXECUTOR['POOL_SIZE'] <= 0:
+            raise serializers.ValidationError("戰鬥模擬未開放")
+
+        max_times = settings.BATTLE_SIMULATION['MAX_TIMES']
+        data.setdefault('times', max_times)
+        if data['times'] > max_times:
+            raise serializers.ValidationError(f"模擬次數不可超過{max_times}")
+
+        try:
+            data['target'] = self.target_models[data['target_type']].objects.get(id=data['target_id'])
+        except ObjectDoesNotExist:
+            raise serializers.ValidationError("目標不存在")
+        return data
+
+
 class PvPTeamFightSerializer(BaseSerializer):
     opponent = serializers.PrimaryKeyRelatedField(queryset=Team.objects.all())
 
@@ -135,7 +180,7 @@ class PvPTeamFightSerializer(BaseSerializer):
             'messages': []
         }
 
-        BattleResult.objects.create(title=f"{self.team.name}vs{opponent.name}", content=result)
+        create_battle_result(f"{self.team.name}vs{opponent.name}", result, battle)
 
         return result
 
@@ -210,7 +255,7 @@ class ArenaFightSerializer(BaseSerializer):
             'messages': [message]
         }
 
-        BattleResult.objects.create(title=f"{arena.name}-{chara.name}vs{opponent.name}", content=result)
+        create_battle_result(f"{arena.name}-{chara.name}vs{opponent.name}", result, battle)
 
         return result
 
@@ -271,7 +316,7 @@ class DungeonFightSerializer(BaseSerializer):
 
         dungeon_record.save()
 
-        BattleResult.objects.create(title=f"{team.name}-{dungeon.name}-{floor_number}層", content=result)
+        create_battle_result(f"{team.name}-{dungeon.name}-{floor_number}層", result, battle)
 
         return result
 
@@ -306,17 +351,27 @@ class WorldBossFightSerializer(BaseSerializer):
 
         self.chara.lose_items('bag', [Item(type_id=1555, number=1)])
 
+        # 戰鬥以讀取時的 HP、MP 進行，不鎖定神獸，多個隊伍可同時挑戰
         battle = Battle(attackers=team.members.all(), defenders=[world_boss],
                         battle_type='world_boss', element_type=world_boss.element_type)
         battle.execute()
-        win = (battle.winner == 'attacker')
         battle_world_boss = battle.find_chara_by_source(world_boss)
 
+        # 戰鬥結束後才套用傷害，期間其他隊伍先擊敗神獸時取消此次挑戰
+        applied = world_boss.apply_damage(world_boss.hp - battle_world_boss.hp, world_boss.mp - battle_world_boss.mp)
+        if applied is None:
+            raise serializers.ValidationError("神獸已被其他隊伍擊敗")
+        damage, win = applied
+        # 以快照進行的戰鬥擊敗神獸，但傷害已被其他隊伍先扣除時不算擊敗
+        if win:
+            winner = 'attacker'
+        else:
+            winner = 'draw' if battle.winner == 'attacker' else battle.winner
+
         self.chara.set_next_action_time(3)
         self.chara.save()
 
         # damage and reward
-        damage = world_boss.hp - battle_world_boss.hp
         damage_ratio = damage / world_boss.hp_max
 
         loots = []
@@ -330,24 +385,15 @@ class WorldBossFightSerializer(BaseSerializer):
             loots.append(Item(type_id=1556, number=1))
         self.chara.get_items('bag', loots)
 
-        # update world boss
-        world_boss.hp = battle_world_boss.hp
-        world_boss.mp = max(world_boss.mp_max * 0.2, battle_world_boss.mp)
-
-        if world_boss.hp == 0:
-            world_boss.is_alive = False
-
-        world_boss.save()
-
         # save and return result
         result = {
-            'winner': battle.winner,
+            'winner': winner,
             'logs': battle.logs,
             'loots': ItemSerializer(loots, fields=['name', 'number'], many=True).data,
             'messages': [f"造成了{damage}傷害({damage_ratio*100:.2f}%)"]
         }
 
-        BattleResult.objects.create(title=f"{team.name}-{world_boss.name}", content=result)
+        create_battle_result(f"{team.name}-{world_boss.name}", result, battle)
         push_log("神獸", f"{team.name}向{world_boss.name}發起了挑戰，造成了{damage}傷害({damage_ratio*100:.2f}%)")
         if win:
             push_log("神獸", f"{world_boss.name}被{team.name}擊敗了")
@@ -361,4 +407,4 @@ class WorldBossFightSerializer(BaseSerializer):
         if world_boss.location != self.chara.location:
             raise serializers.ValidationError("神獸不在此地點")
 
-        return world_boss.lock()
+        return world_boss
@@ -0,0 +1,33 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from ability.models import Ability
+from battle.loader import bump_template_version
+from battle.models import BattleMapMonster, Monster, MonsterAttribute, MonsterSkillSetting
+from job.models import Skill
+from npc.models import NPC, NPCAttribute, NPCSkillSetting
+from world.models import AttributeType, ElementType
+
+# 這些資料變動時（包含 loaddata）遞增模板版本，各 process 的 battle_templates 會重新讀取
+TEMPLATE_MODELS = [
+    Monster, MonsterAttribute, MonsterSkillSetting, BattleMapMonster,
+    NPC, NPCAttribute, NPCSkillSetting,
+    Skill, Ability, AttributeType, ElementType,
+]
+
+
+def template_changed(sender, **kwargs):
+    bump_template_version()
+
+
+def template_abilities_changed(sender, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_template_version()
+
+
+def connect_signals():
+    for model in TEMPLATE_MODELS:
+        post_save.connect(template_changed, sender=model, dispatch_uid=f'battle_template_save_{model.__name__}')
+        post_delete.connect(template_changed, sender=model, dispatch_uid=f'battle_template_delete_{model.__name__}')
+    for model in [Monster, NPC]:
+        m2m_changed.connect(template_abilities_changed, sender=model.abilities.through,
+                            dispatch_uid=f'battle_template_abilities_{model.__name__}')
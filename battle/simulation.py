@@ -0,0 +1,67 @@
+import json
+import hashlib
+from collections import Counter
+from statistics import mean
+
+from django.conf import settings
+from django.core.cache import cache
+
+from battle.executor import execute_battles
+
+SIMULATION_CACHE_TIMEOUT = 60 * 60
+
+
+def get_simulation_cache_key(replay_data, times):
+    data = json.dumps([replay_data, times], sort_keys=True, ensure_ascii=False)
+    return f"battle_simulation:{hashlib.sha256(data.encode()).hexdigest()}"
+
+
+def summarize_simulation(summaries, skill_names):
+    """
+    統計第一位攻擊方角色的勝率、平均回合數、每場造成的傷害分布與技能發動次數
+    """
+    times = len(summaries)
+    damages = sorted(x['charas'][0][0] for x in summaries)
+    winners = Counter(x['winner'] for x in summaries)
+    skill_counter = Counter()
+    for summary in summaries:
+        skill_counter.update(summary['charas'][0][1])
+
+    return {
+        'times': times,
+        'win_rate': winners['attacker'] / times,
+        'lose_rate': winners['defender'] / times,
+        'draw_rate': winners['draw'] / times,
+        'average_rounds': mean(x['rounds'] for x in summaries),
+        'damage': {
+            'min': damages[0],
+            'max': damages[-1],
+            'average': mean(damages),
+            'percentiles': {p: damages[(times - 1) * p // 100] for p in [10, 25, 50, 75, 90]},
+        },
+        'skills': [
+            {
+                'name': skill_names.get(skill_id, ''),
+                'count': count,
+                'average': count / times,
+            }
+            for skill_id, count in skill_counter.most_common()
+        ],
+    }
+
+
+def simulate_battle(battle, times):
+    """
+    以 seed 0 ~ times-1 重複執行 battle，雙方資料相同時直接回傳快取的結果
+    """
+    replay_data = battle.replay_data()
+    replay_data.pop('seed')
+
+    cache_key = get_simulation_cache_key(replay_data, times)
+    result = cache.get(cache_key)
+    if result is None:
+        skill_names = {x.skill.id: x.skill.name for x in battle.charas[0].skill_settings}
+        result = summarize_simulation(execute_battles(replay_data, range(times)), skill_names)
+        cache.set(cache_key, result, SIMULATION_CACHE_TIMEOUT)
+
+    return result
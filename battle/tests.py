@@ -1,3 +1,221 @@
-from django.test import TestCase
+import json
+import math
+import random
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, SimpleTestCase
+
+from base.utils import binomial, multinomial
+from battle.battle import Battle, BattleChara, SKILL_EFFECTS, ON_HIT_EFFECTS
+from battle.battle_map_processors import NEST_LOOTS
+from battle.benchmark import load_fixtures, BenchmarkWorld
+from battle.loader import battle_templates
+from battle.models import Monster, DungeonFloor, WorldBoss
+from chara.models import Chara
+from team.models import Team
+
+
+class BattleQueryCountTest(TestCase):
+    """
+    建立 Battle 時一次讀取所有參戰者的資料，查詢數不隨參戰人數增加
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        load_fixtures()
+        cls.world = BenchmarkWorld()
+
+    def setUp(self):
+        # 怪物模板每個 process 讀取一次，先讀取使各測試的查詢數不受執行順序影響
+        battle_templates.checked_at = None
+        battle_templates.get_element_types()
+
+    def test_pve(self):
+        attackers = [Chara.objects.get(id=self.world.chara.id)]
+        defenders = [Monster.objects.get(name='魔王')]
+        element_type = self.world.location.element_type
+        with self.assertNumQueries(6):
+            Battle(attackers=attackers, defenders=defenders, battle_type='pve', element_type=element_type)
+
+    def test_dungeon(self):
+        attackers = Team.objects.get(id=self.world.team.id).members.all()
+        defenders = [x.monster for x in DungeonFloor.objects.get(dungeon_id=1, floor=3).monsters.all()]
+        with self.assertNumQueries(6):
+            Battle(attackers=attackers, defenders=defenders, battle_type='dungeon')
+
+    def test_world_boss(self):
+        attackers = Team.objects.get(id=self.world.team.id).members.all()
+        world_boss = WorldBoss.objects.get(id=self.world.world_boss.id)
+        element_type = world_boss.element_type
+        with self.assertNumQueries(9):
+            Battle(attackers=attackers, defenders=[world_boss], battle_type='world_boss', element_type=element_type)
+
+    def test_pvp(self):
+        attackers = [Chara.objects.get(id=self.world.chara.id)]
+        defenders = [Chara.objects.get(id=self.world.mirror_charas[0].id)]
+        with self.assertNumQueries(6):
+            Battle(attackers=attackers, defenders=defenders, battle_type='pvp')
+
+
+def uncompiled_hooks(chara):
+    """
+    編譯前的行為：所有特效皆執行，由特效本身判定是否發動
+    """
+    chara.skill_effects = SKILL_EFFECTS
+    chara.on_hit_hooks = [hook for hook, _, _ in ON_HIT_EFFECTS]
+    chara.on_damaged_hooks = [BattleChara.counter_regeneration]
+    chara.weapon_hook = BattleChara.weapon_effect
+    chara.armor_hook = BattleChara.armor_effect
+    chara.before_action_hook = uncompiled_regeneration
+
+
+def uncompiled_regeneration(chara):
+    if chara.has_ability_type(61):
+        pass
+    elif chara.has_ability_type(62):
+        chara.group_regeneration()
+    elif chara.has_ability_type(1):
+        chara.regeneration()
+
+
+class BattleEquivalenceTest(TestCase):
+    """
+    以相同的 seed 用不同的方式執行同一場戰鬥，勝負、行動次數與各角色最後的 HP、MP 須相同
+    """
+    seeds = range(10)
+
+    @classmethod
+    def setUpTestData(cls):
+        load_fixtures()
+        cls.world = BenchmarkWorld()
+
+    def run_battle(self, make_kwargs, seed, **kwargs):
+        battle = Battle(seed=seed, **make_kwargs(seed), **kwargs)
+        battle.run()
+        return battle
+
+    def outcome(self, battle):
+        return battle.winner, battle.actions, [(chara.name, chara.hp, chara.mp) for chara in battle.charas]
+
+    def assert_equivalent(self, run_variant, compare_logs=False):
+        """
+        run_variant(make_kwargs, seed, battle) 以另一種方式執行同一場戰鬥
+        """
+        for name, make_kwargs in self.world.scenarios().items():
+            for seed in self.seeds:
+                with self.subTest(scenario=name, seed=seed):
+                    battle = self.run_battle(make_kwargs, seed)
+                    variant = run_variant(make_kwargs, seed, battle)
+                    self.assertEqual(self.outcome(variant), self.outcome(battle))
+                    self.assertEqual(variant.rounds, battle.rounds)
+                    if compare_logs:
+                        self.assertEqual(variant.logs, battle.logs)
+
+    def test_idle_rounds(self):
+        def run_stepped(make_kwargs, seed, battle):
+            with mock.patch.object(Battle, 'rounds_until_next_action', lambda self: 1):
+                return self.run_battle(make_kwargs, seed)
+
+        self.assert_equivalent(run_stepped)
+
+    def test_summary_log_level(self):
+        self.assert_equivalent(lambda make_kwargs, seed, battle: self.run_battle(make_kwargs, seed, log_level='summary'))
+
+    def test_compiled_hooks(self):
+        def run_uncompiled(make_kwargs, seed, battle):
+            with mock.patch.object(BattleChara, 'compile_hooks', uncompiled_hooks):
+                return self.run_battle(make_kwargs, seed)
+
+        self.assert_equivalent(run_uncompiled, compare_logs=True)
+
+    def test_replay(self):
+        # 與存入資料庫的重播資料相同，經過 JSON 轉換
+        self.assert_equivalent(
+            lambda make_kwargs, seed, battle: Battle.replay(json.loads(json.dumps(battle.replay_data()))),
+            compare_logs=True
+        )
+
+
+def binomial_pmf(n, p):
+    return [math.comb(n, k) * p ** k * (1 - p) ** (n - k) for k in range(n + 1)]
+
+
+def chi_square(samples, pmf):
+    """
+    將期望次數不足 5 的相鄰結果合併後計算卡方值，回傳 (卡方值, 自由度)
+    """
+    counter = Counter(samples)
+    bins = []
+    observed = expected = 0
+    for k, probability in enumerate(pmf):
+        observed += counter[k]
+        expected += probability * len(samples)
+        if expected >= 5:
+            bins.append((observed, expected))
+            observed = expected = 0
+    if expected and bins:
+        last_observed, last_expected = bins.pop()
+        bins.append((last_observed + observed, last_expected + expected))
+    return sum((o - e) ** 2 / e for o, e in bins), len(bins) - 1
+
+
+def chi_square_critical(dof, z=3.09):
+    """
+    卡方分布 0.999 分位數的 Wilson-Hilferty 近似值
+    """
+    return dof * (1 - 2 / (9 * dof) + z * math.sqrt(2 / (9 * dof))) ** 3
+
+
+class LootDistributionTest(SimpleTestCase):
+    """
+    一次決定 n 場戰鬥掉寶次數的分布須與逐場判定相同，以固定的 seed 檢定
+    """
+    samples = 20000
+
+    def assert_binomial(self, samples, n, p):
+        chi2, dof = chi_square(samples, binomial_pmf(n, p))
+        if dof:
+            self.assertLess(chi2, chi_square_critical(dof), (n, p))
+
+        # 樣本平均與樣本變異數的誤差在 4 個標準誤內，變異數的標準誤取決於二項分布的峰度
+        size = len(samples)
+        npq = n * p * (1 - p)
+        mean = sum(samples) / size
+        variance = sum((x - mean) ** 2 for x in samples) / (size - 1)
+        kurtosis = (1 - 6 * p * (1 - p)) / npq
+        self.assertLess(abs(mean - n * p), 4 * math.sqrt(npq / size), (n, p))
+        self.assertLess(abs(variance / npq - 1), 4 * math.sqrt((2 + kurtosis) / size), (n, p))
+
+    def test_binomial(self):
+        rng = random.Random(0)
+        for n, p in [(100, 1 / 250), (100, 0.1), (100, 0.5), (7, 0.9), (100, 1 / 7000)]:
+            samples = [binomial(n, p, rng) for _ in range(self.samples)]
+            self.assert_binomial(samples, n, p)
+
+    def test_binomial_bounds(self):
+        rng = random.Random(0)
+        self.assertEqual(binomial(100, 0, rng), 0)
+        self.assertEqual(binomial(100, 1, rng), 100)
+        self.assertEqual(binomial(0, 0.5, rng), 0)
+
+    def test_nest_multinomial(self):
+        rng = random.Random(0)
+        n = 100
+        probabilities = [probability for _, probability in NEST_LOOTS]
+        samples = [multinomial(n, probabilities, rng) for _ in range(self.samples)]
+
+        self.assertTrue(all(sum(counts) <= n for counts in samples))
+        # 各物品的次數為二項分布
+        for i, p in enumerate(probabilities):
+            self.assert_binomial([counts[i] for counts in samples], n, p)
+        # 同一場戰鬥只會獲得一種物品，兩兩之間的共變異數為 -n * p_i * p_j
+        means = [sum(counts[i] for counts in samples) / len(samples) for i in range(len(probabilities))]
+        for i in range(len(probabilities)):
+            for j in range(i + 1, len(probabilities)):
+                covariance = sum(
+                    (counts[i] - means[i]) * (counts[j] - means[j]) for counts in samples
+                ) / (len(samples) - 1)
+                expected = -n * probabilities[i] * probabilities[j]
+                standard_error = n * math.sqrt(probabilities[i] * probabilities[j] / len(samples))
+                self.assertLess(abs(covariance - expected), 4 * standard_error, (i, j))
@@ -1,6 +1,8 @@
 from datetime import date
 
-from item.models import ItemType
+from battle.battle import Battle
+from battle.models import BattleResult
+from item.pools import item_type_pools
 
 
 def get_event_item_type():
@@ -9,16 +11,40 @@ def get_event_item_type():
     day = today.day
 
     if (month == 1 and day >= 18) or (month == 2):
-        return ItemType.objects.get(id=996)  # 紅包
+        return item_type_pools.get_item_type(996)  # 紅包
     if month == 5 and day <= 8:
-        return ItemType.objects.get(id=997)  # 康乃馨
+        return item_type_pools.get_item_type(997)  # 康乃馨
     if month == 5 and day >= 20:
-        return ItemType.objects.get(id=998)  # 肉粽
+        return item_type_pools.get_item_type(998)  # 肉粽
     if month == 7 or month == 8:
-        return ItemType.objects.get(id=999)  # 七彩冰棒
+        return item_type_pools.get_item_type(999)  # 七彩冰棒
     if month == 9:
-        return ItemType.objects.get(id=1000)  # 生日蛋糕
+        return item_type_pools.get_item_type(1000)  # 生日蛋糕
     if month == 10 and day >= 20:
-        return ItemType.objects.get(id=1001)  # 萬聖糖
+        return item_type_pools.get_item_type(1001)  # 萬聖糖
     if (month == 11 and day >= 16) or (month == 12):
-        return ItemType.objects.get(id=1002)  # 聖誕玩偶
+        return item_type_pools.get_item_type(1002)  # 聖誕玩偶
+
+
+def create_battle_result(title, result, battle):
+    """
+    戰鬥紀錄不寫入資料庫，改存 seed 與參戰者資料，讀取時再以 replay_battle_result 重新產生
+    """
+    if battle.metrics is None:
+        return BattleResult.objects.create(title=title, content=strip_logs(result), replay=battle.replay_data())
+
+    with battle.metrics.timer('finalization'):
+        battle_result = BattleResult.objects.create(title=title, content=strip_logs(result),
+                                                    replay=battle.replay_data())
+    battle.metrics.report()
+    return battle_result
+
+
+def strip_logs(result):
+    return {key: value for key, value in result.items() if key != 'logs'}
+
+
+def replay_battle_result(battle_result):
+    if battle_result.replay is not None:
+        battle_result.content = dict(battle_result.content, logs=Battle.replay(battle_result.replay).logs)
+    return battle_result
@@ -1,5 +1,6 @@
 from django.db.models import Q
 from rest_framework.response import Response
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import action
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, DestroyModelMixin, CreateModelMixin
 from rest_framework.filters import SearchFilter
@@ -11,8 +12,25 @@ from battle.serializers import (
     BattleMapFightSerializer, PvPFightSerializer, DungeonFightSerializer,
     BattleResultSerializer, WorldBossFightSerializer, WorldBossSerializer,
     PvPFightSerializer, MirrorFightSerializer, ArenaFightSerializer, ArenaSerializer,
-    PvPTeamFightSerializer
+    PvPTeamFightSerializer, BattleSimulationSerializer
 )
+from battle.utils import replay_battle_result
+from battle.log_format import encode_result, decode_result
+from battle.instrumentation import battle_metrics
+
+
+class BattleLogFormatMixin:
+    """
+    戰鬥紀錄預設以 full 格式回傳，?log_format=delta 時轉為 delta 格式
+    """
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if isinstance(response.data, dict):
+            convert = encode_result if request.query_params.get('log_format') == 'delta' else decode_result
+            response.data = convert(response.data)
+            if 'content' in response.data:
+                response.data['content'] = convert(response.data['content'])
+        return super().finalize_response(request, response, *args, **kwargs)
 
 
 class BattleMapViewSet(BaseGenericViewSet):
@@ -39,6 +57,11 @@ class MirrorFightView(CharaPostViewMixin, BaseGenericAPIView):
     serializer_class = MirrorFightSerializer
 
 
+class BattleSimulationView(CharaPostViewMixin, BaseGenericAPIView):
+    serializer_class = BattleSimulationSerializer
+    check_next_action_time = True
+
+
 class PvPTeamFightView(TeamPostViewMixin, BaseGenericAPIView):
     serializer_class = PvPTeamFightSerializer
 
@@ -76,7 +99,14 @@ class WorldBossFightView(TeamPostViewMixin, BaseGenericAPIView):
     role = 'leader'
 
 
-class BattleResultViewSet(ListModelMixin, RetrieveModelMixin, BaseGenericViewSet):
+class BattleMetricsView(BaseGenericAPIView):
+    def get(self, request):
+        if not request.user.is_gm:
+            raise PermissionDenied("權限不足")
+        return Response(battle_metrics.summary())
+
+
+class BattleResultViewSet(BattleLogFormatMixin, ListModelMixin, RetrieveModelMixin, BaseGenericViewSet):
     serializer_class = BattleResultSerializer
     queryset = BattleResult.objects.all()
 
@@ -87,3 +117,8 @@ class BattleResultViewSet(ListModelMixin, RetrieveModelMixin, BaseGenericViewSet
         queryset = self.filter_queryset(self.get_queryset()).defer('content').order_by('-created_at')[:200]
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
+
+    def retrieve(self, request, pk):
+        instance = replay_battle_result(self.get_object())
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
@@ -0,0 +1,279 @@
+import atexit
+import logging
+import threading
+import time
+from functools import reduce
+from operator import or_
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F, Q, Case, When, Value
+from django.utils.timezone import localdate
+
+from chara.models import Chara, CharaAttribute, CharaRecord
+
+logger = logging.getLogger('chara.counters')
+
+RECORD_FIELDS = ['total_battle', 'world_monster_quest_counter', 'country_monster_quest_counter']
+# 今日戰鬥次數以 today_battle:<日期> 為欄位名稱，寫入時略過不是今天的累積值
+TODAY_BATTLE_PREFIX = 'today_battle:'
+# 屬性熟練以 attribute_proficiency:<屬性類型 id> 為欄位名稱
+ATTRIBUTE_PROFICIENCY_PREFIX = 'attribute_proficiency:'
+
+
+def today_battle_field(day=None):
+    return f'{TODAY_BATTLE_PREFIX}{(day or localdate()).isoformat()}'
+
+
+def attribute_proficiency_field(type_id):
+    return f'{ATTRIBUTE_PROFICIENCY_PREFIX}{type_id}'
+
+
+class LocalCounterStore:
+    """
+    累積於目前 process 的計數，其他 process 讀不到，只適用於單一 process 的部署與開發環境
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(Counter)
+
+    def add(self, chara_id, counters):
+        with self.lock:
+            self.pending[chara_id].update(counters)
+
+    def get(self, chara_id):
+        with self.lock:
+            return dict(self.pending.get(chara_id, {}))
+
+    def claim(self, chara_ids):
+        with self.lock:
+            return {chara_id: dict(self.pending.pop(chara_id)) for chara_id in chara_ids if chara_id in self.pending}
+
+    def dirty_chara_ids(self):
+        with self.lock:
+            return list(self.pending)
+
+
+class RedisCounterStore:
+    """
+    每個角色的計數存於一個 hash，有計數的角色記錄於 dirty set，各 process 共用
+    """
+    prefix = 'chara_counters:'
+    dirty_key = 'chara_counters:dirty'
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def add(self, chara_id, counters):
+        pipe = self.client.pipeline()
+        for field, value in counters.items():
+            pipe.hincrby(f'{self.prefix}{chara_id}', field, value)
+        pipe.sadd(self.dirty_key, chara_id)
+        pipe.execute()
+
+    def get(self, chara_id):
+        return {
+            field.decode(): int(value)
+            for field, value in self.client.hgetall(f'{self.prefix}{chara_id}').items()
+        }
+
+    def claim(self, chara_ids):
+        # 同一個 transaction 中讀取並刪除，claim 之後的 add 會留到下一次寫入
+        pipe = self.client.pipeline()
+        for chara_id in chara_ids:
+            pipe.hgetall(f'{self.prefix}{chara_id}')
+            pipe.delete(f'{self.prefix}{chara_id}')
+        if chara_ids:
+            pipe.srem(self.dirty_key, *chara_ids)
+        results = pipe.execute()
+
+        claimed = {}
+        for chara_id, counters in zip(chara_ids, results[::2]):
+            if counters:
+                claimed[chara_id] = {field.decode(): int(value) for field, value in counters.items()}
+        return claimed
+
+    def dirty_chara_ids(self):
+        return [int(x) for x in self.client.smembers(self.dirty_key)]
+
+
+def write_counters(pending):
+    """
+    每個資料表以一個 UPDATE 寫入一批角色的計數
+    """
+    record_updates = {}
+    for field in RECORD_FIELDS:
+        whens = [
+            When(chara_id=chara_id, then=Value(counters[field]))
+            for chara_id, counters in pending.items() if counters.get(field)
+        ]
+        if whens:
+            record_updates[field] = F(field) + Case(*whens, default=Value(0))
+
+    # 只寫入今天的今日戰鬥次數，日期不是今天時從 0 開始計算
+    today = localdate()
+    today_field = today_battle_field(today)
+    today_battle_whens = []
+    for chara_id, counters in pending.items():
+        if counters.get(today_field):
+            today_battle_whens.append(When(chara_id=chara_id, today_battle_date=today,
+                                           then=F('today_battle_count') + Value(counters[today_field])))
+            today_battle_whens.append(When(chara_id=chara_id, then=Value(counters[today_field])))
+    if today_battle_whens:
+        today_chara_ids = [chara_id for chara_id, counters in pending.items() if counters.get(today_field)]
+        record_updates['today_battle_count'] = Case(*today_battle_whens, default=F('today_battle_count'))
+        record_updates['today_battle_date'] = Case(
+            When(chara_id__in=today_chara_ids, then=Value(today)), default=F('today_battle_date')
+        )
+
+    if record_updates:
+        CharaRecord.objects.filter(chara_id__in=list(pending)).update(**record_updates)
+
+    attribute_whens = []
+    attribute_filters = []
+    for chara_id, counters in pending.items():
+        for field, value in counters.items():
+            if field.startswith(ATTRIBUTE_PROFICIENCY_PREFIX) and value:
+                type_id = int(field[len(ATTRIBUTE_PROFICIENCY_PREFIX):])
+                attribute_whens.append(When(chara_id=chara_id, type_id=type_id, then=Value(value)))
+                attribute_filters.append(Q(chara_id=chara_id, type_id=type_id))
+    if attribute_whens:
+        CharaAttribute.objects.filter(reduce(or_, attribute_filters)).update(
+            proficiency=F('proficiency') + Case(*attribute_whens, default=Value(0))
+        )
+
+
+def apply_counters(counters, record=None, attributes=()):
+    if record is not None:
+        for field in RECORD_FIELDS:
+            setattr(record, field, getattr(record, field) + counters.get(field, 0))
+
+        today_battle = counters.get(today_battle_field(), 0)
+        if today_battle:
+            record.today_battle_count = record.today_battle + today_battle
+            record.today_battle_date = localdate()
+
+    for attribute in attributes:
+        attribute.proficiency += counters.get(attribute_proficiency_field(attribute.type_id), 0)
+
+
+class CharaCounters:
+    """
+    角色的戰鬥次數、任務計數與屬性熟練先累積於 store，每隔 FLUSH_INTERVAL 秒由背景執行緒批次寫入資料庫
+    資料庫的值加上 get 取得的累積值為目前的值；寫入時先鎖定角色，持有角色鎖的請求讀到的兩者一致
+    """
+
+    def __init__(self):
+        self.store = None
+        self.lock = threading.Lock()
+        self.flusher = None
+        # 目前執行緒中交易尚未提交的累積值
+        self.local = threading.local()
+
+    def get_store(self):
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    if settings.CHARA_COUNTERS['BACKEND'] == 'redis':
+                        self.store = RedisCounterStore(settings.CHARA_COUNTERS['REDIS_URL'])
+                    else:
+                        self.store = LocalCounterStore()
+        return self.store
+
+    def add(self, chara_id, counters):
+        """
+        在持有角色鎖時立即累積，下一個鎖定角色的請求即可讀到
+        交易沒有提交時由 CharaCountersMiddleware 在請求結束後扣回，扣回前其他請求可能讀到多算的值
+        """
+        counters = {field: value for field, value in counters.items() if value}
+        if not counters:
+            return
+
+        self.start_flusher()
+        self.get_store().add(chara_id, counters)
+        if transaction.get_connection().in_atomic_block:
+            entry = (chara_id, counters)
+            uncommitted = self.get_uncommitted()
+            uncommitted.append(entry)
+            transaction.on_commit(lambda: uncommitted.remove(entry))
+
+    def get_uncommitted(self):
+        if not hasattr(self.local, 'uncommitted'):
+            self.local.uncommitted = []
+        return self.local.uncommitted
+
+    def discard_uncommitted(self):
+        """
+        扣回交易沒有提交的累積值，須在交易結束後呼叫
+        """
+        uncommitted = self.get_uncommitted()
+        while uncommitted:
+            chara_id, counters = uncommitted.pop()
+            try:
+                self.get_store().add(chara_id, {field: -value for field, value in counters.items()})
+            except Exception:
+                logger.exception("failed to discard chara counters")
+
+    def get(self, chara_id):
+        return self.get_store().get(chara_id)
+
+    def apply_pending(self, chara_id, record=None, attributes=()):
+        """
+        將累積值加到已讀取的 CharaRecord 與 CharaAttribute，套用後的計數欄位只用於讀取，不可再寫入資料庫
+        """
+        pending = self.get(chara_id)
+        if pending:
+            apply_counters(pending, record=record, attributes=attributes)
+
+    def flush(self, chara_ids=None):
+        """
+        將累積的計數寫入資料庫，未指定角色時寫入所有有累積值的角色
+        取出的累積值在交易失敗時放回，交易回復後無法放回，因此不可在請求的交易中呼叫
+        """
+        assert not transaction.get_connection().in_atomic_block
+
+        store = self.get_store()
+        if chara_ids is None:
+            chara_ids = store.dirty_chara_ids()
+        chara_ids = sorted(chara_ids)
+
+        batch_size = settings.CHARA_COUNTERS['FLUSH_BATCH_SIZE']
+        for i in range(0, len(chara_ids), batch_size):
+            batch = chara_ids[i:i + batch_size]
+            pending = {}
+            try:
+                with transaction.atomic():
+                    # 依 id 順序鎖定角色後才取出累積值
+                    list(Chara.objects.select_for_update().filter(id__in=batch).order_by('id').values_list('id'))
+                    pending = store.claim(batch)
+                    write_counters(pending)
+            except Exception:
+                for chara_id, counters in pending.items():
+                    store.add(chara_id, counters)
+                raise
+
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, name='chara-counters-flusher', daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(settings.CHARA_COUNTERS['FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to flush chara counters")
+            finally:
+                close_old_connections()
+
+
+chara_counters = CharaCounters()
@@ -0,0 +1,16 @@
+from chara.counters import chara_counters
+
+
+class CharaCountersMiddleware:
+    """
+    請求的交易沒有提交時，扣回請求中累積的角色計數
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            chara_counters.discard_uncommitted()
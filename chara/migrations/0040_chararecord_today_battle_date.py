@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.utils.timezone import localdate
+
+
+def set_today_battle_date(apps, schema_editor):
+    # 既有的今日戰鬥次數視為今天的累積值
+    CharaRecord = apps.get_model('chara', 'CharaRecord')
+    CharaRecord.objects.update(today_battle_date=localdate())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chara', '0039_charahome'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='chararecord',
+            old_name='today_battle',
+            new_name='today_battle_count',
+        ),
+        migrations.AddField(
+            model_name='chararecord',
+            name='today_battle_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(set_today_battle_date, migrations.RunPython.noop),
+    ]
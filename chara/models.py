@@ -1,7 +1,7 @@
 from faulthandler import is_enabled
 from django.db import models
 from django.utils.functional import cached_property
-from django.utils.timezone import localtime
+from django.utils.timezone import localtime, localdate
 from django.conf import settings
 
 from rest_framework.exceptions import ValidationError
@@ -176,6 +176,9 @@ class Chara(BaseModel):
         sftp_put_fo(fo, os.path.join(settings.CHARA_AVATAR_PATH, f"{self.id}.jpg"))
         Chara.objects.filter(id=self.id).update(avatar_version=models.F('avatar_version') + 1)
 
+        from system.utils import invalidate_chara_profile
+        invalidate_chara_profile(self.id)
+
     @property
     def basic_time_cost(self):
         if self.has_cold_down_bonus:
@@ -373,11 +376,19 @@ class CharaRecord(BaseModel):
 
     level_down_count = models.IntegerField(default=0)
 
-    today_battle = models.IntegerField(default=0)
+    # 今日戰鬥次數，日期不是今天時視為 0，不需要每日重設
+    today_battle_count = models.IntegerField(default=0)
+    today_battle_date = models.DateField(null=True)
 
     world_monster_quest_counter = models.IntegerField(default=0)
     country_monster_quest_counter = models.IntegerField(default=0)
 
+    @property
+    def today_battle(self):
+        if self.today_battle_date != localdate():
+            return 0
+        return self.today_battle_count
+
 
 class CharaIntroduction(BaseModel):
     chara = models.OneToOneField("chara.Chara", on_delete=models.CASCADE, related_name="introduction")
@@ -16,7 +16,9 @@ from chara.models import (
     CharaFarm, CharaBuff, CharaBuffType, CharaPartner, CharaAchievementType, CharaTitle, CharaTitleType,
     CharaConfig, CharaCustomTitle, CharaHome
 )
-from item.models import Item, ItemTypePoolGroup
+from chara.counters import chara_counters
+from item.models import Item
+from item.pools import item_type_pools
 from battle.serializers import BattleMapSerializer, MonsterSerializer
 from item.serializers import SimpleItemSerializer, ItemSerializer
 from ability.serializers import AbilitySerializer
@@ -25,7 +27,7 @@ from npc.serializers import NPCSerializer
 
 from world.serializers import SlotTypeSerializer, LocationSerializer, ElementTypeSerializer, AttributeTypeSerializer
 from chara.achievement import update_achievement_counter
-from system.utils import push_log, send_private_message_by_system
+from system.utils import push_log, send_private_message_by_system, invalidate_chara_profile
 
 
 class BattleMapTicketSerialiser(SerpyModelSerializer):
@@ -120,9 +122,14 @@ class CharaConfigUpdateSerializer(BaseModelSerializer):
 
 
 class CharaRecordSerializer(SerpyModelSerializer):
+    today_battle = serpy.MethodField()
+
     class Meta:
         model = CharaRecord
-        exclude = ['id', 'created_at', 'updated_at']
+        exclude = ['id', 'created_at', 'updated_at', 'today_battle_count', 'today_battle_date']
+
+    def get_today_battle(self, obj):
+        return obj.today_battle
 
 
 class CharaSimpleSerializer(SerpyModelSerializer):
@@ -168,6 +175,10 @@ class CharaCustomTitleUpdateSerializer(BaseModelSerializer):
         model = CharaCustomTitle
         fields = ['name', 'color']
 
+    def update(self, instance, validated_data):
+        invalidate_chara_profile(instance.chara_id)
+        return super().update(instance, validated_data)
+
 
 class CharaCustomTitleExpandSerializer(BaseSerializer):
     days = serializers.IntegerField(min_value=1)
@@ -179,6 +190,7 @@ class CharaCustomTitleExpandSerializer(BaseSerializer):
 
         self.chara.custom_title.due_time = max(self.chara.custom_title.due_time, localtime()) + timedelta(days=days)
         self.chara.custom_title.save()
+        invalidate_chara_profile(self.chara.id)
 
 
 class CharaPublicProfileSerializer(SerpyModelSerializer):
@@ -441,16 +453,16 @@ class HandInQuestSerializer(BaseSerializer):
     }
 
     def save(self):
+        # 任務計數由 chara_counters 寫入，扣除的數量也一併累積
+        counter = self.validated_data['counter']
         if self.chara.has_quest_bonus:
-            orig = getattr(self.chara.record, self.validated_data['counter'])
             cost = self.quest_requirements[self.validated_data['quest']]
-            setattr(self.chara.record, self.validated_data['counter'], orig - cost)
         else:
-            setattr(self.chara.record, self.validated_data['counter'], 0)
-        self.chara.record.save()
+            cost = getattr(self.chara.record, counter)
+        chara_counters.add(self.chara.id, {counter: -cost})
 
         # 任務池
-        items = ItemTypePoolGroup.objects.get(id=9).pick()
+        items = item_type_pools.pick_group(9)
         self.chara.get_items('bag', items)
 
         gold = 5000000
@@ -505,6 +517,7 @@ class CharaTitleSetSerializer(BaseSerializer):
     def save(self):
         self.chara.title = self.validated_data['title']
         self.chara.save()
+        invalidate_chara_profile(self.chara.id)
 
     def validate_title(self, title):
         if title is not None and title.chara != self.chara:
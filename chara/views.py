@@ -9,10 +9,12 @@ from rest_framework.response import Response
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
+from rest_flex_fields import is_included
 
 from base.pagination import BasePagination
 from item.filters import ItemFilter
 
+from .counters import chara_counters
 from .models import Chara, CharaAchievementType, CharaAchievement, CharaAchievementCounter
 from chara.serializers import (
     SendGoldSerializer, SlotEquipSerializer, SlotDivestSerializer, RestSerializer,
@@ -43,6 +45,12 @@ class CharaProfileView(BaseGenericAPIView):
 
     def get(self, request):
         chara = self.get_chara()
+        # 顯示尚未寫入資料庫的戰鬥紀錄與屬性熟練
+        chara_counters.apply_pending(
+            chara.id,
+            record=chara.record if is_included(request, 'record') else None,
+            attributes=chara.attributes.all() if is_included(request, 'attributes') else ()
+        )
         serializer = self.get_serializer(chara)
         return Response(serializer.data, headers={'Date': str(localtime())})
 
@@ -171,6 +179,7 @@ class IncreaseHPMPMaxView(CharaPostViewMixin, BaseGenericAPIView):
 
 class HandInQuestView(CharaPostViewMixin, BaseGenericAPIView):
     serializer_class = HandInQuestSerializer
+    with_chara_counters = True
 
 
 class ChangeAvatarView(CharaPostViewMixin, BaseGenericAPIView):
@@ -11,7 +11,9 @@ from chara.models import Chara
 from town.models import Town
 
 from chara.achievement import update_achievement_counter
-from system.utils import push_log, send_private_message_by_system, send_refresh_chara_profile_signal
+from system.utils import (
+    push_log, send_private_message_by_system, send_refresh_chara_profile_signal, invalidate_chara_profile
+)
 
 
 class CountrySerializer(SerpyModelSerializer):
@@ -72,6 +74,7 @@ class FoundCountrySerializer(BaseModelSerializer):
         CountryJoinRequest.objects.filter(chara=self.chara).delete()
 
         push_log("建國", f"{self.chara.name}建立了{country.name}")
+        invalidate_chara_profile(self.chara.id)
         send_refresh_chara_profile_signal(self.chara.id)
 
     def validate(self, data):
@@ -130,6 +133,7 @@ class CountryJoinRequestReviewSerializer(BaseSerializer):
 
             CountryJoinRequest.objects.filter(chara=chara).delete()
             push_log("入國", f"{chara.name}加入了{self.country.name}")
+            invalidate_chara_profile(chara.id)
             send_refresh_chara_profile_signal(chara.id)
             # 入國次數次數
             update_achievement_counter(chara, 4, 1, 'increase')
@@ -149,6 +153,7 @@ class LeaveCountrySerializer(BaseSerializer):
         self.chara.save()
 
         push_log("下野", f"{self.chara.name}離開了{country.name}")
+        invalidate_chara_profile(self.chara.id)
         send_refresh_chara_profile_signal(self.chara.id)
 
     def validate(self, data):
@@ -168,6 +173,7 @@ class CountryDismissSerializer(BaseSerializer):
         chara.country = None
         chara.save()
 
+        invalidate_chara_profile(chara.id)
         send_refresh_chara_profile_signal(chara.id)
 
     def validate_chara(self, chara):
@@ -191,6 +197,7 @@ class ChangeKingSerializer(BaseSerializer):
         CountryOfficial.objects.filter(chara=chara).delete()
         self.country.king = chara
         self.country.save()
+        invalidate_chara_profile(chara.id)
 
     def validate_chara(self, chara):
         if chara.country != self.country:
@@ -212,6 +219,7 @@ class CountryOfficialCreateSerializer(BaseModelSerializer):
         fields = ['id', 'chara', 'title']
 
     def create(self, validated_data):
+        invalidate_chara_profile(validated_data['chara'].id)
         return CountryOfficial.objects.create(country=self.country, **validated_data)
 
     def validate_chara(self, chara):
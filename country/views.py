@@ -21,6 +21,7 @@ from country.serializers import (
     CountryUpgradeStorageSerializer, CountrySettingUpdateSerialzier, CountryRenameTownSerializer
 )
 from item.serializers import ItemSerializer
+from system.utils import invalidate_chara_profile
 
 
 class CountryViewSet(ListModelMixin, RetrieveModelMixin, BaseGenericViewSet):
@@ -124,6 +125,10 @@ class CountryOfficialViewSet(CreateModelMixin, ListModelMixin, DestroyModelMixin
         country = self.get_country(role='king')
         return super().destroy(request, pk)
 
+    def perform_destroy(self, instance):
+        invalidate_chara_profile(instance.chara_id)
+        instance.delete()
+
 
 class CountryItemView(BaseGenericAPIView):
     serializer_class = ItemSerializer
@@ -4,6 +4,8 @@ import django
 sys.path.insert(0, "/app")
 django.setup()
 
-from chara.models import CharaRecord
+from chara.counters import chara_counters
 
-CharaRecord.objects.update(today_battle=0)
+# 今日戰鬥次數記錄日期，換日後讀取時即視為 0，不需要重設
+# 寫入累積的計數，一併捨棄昨天尚未寫入的今日戰鬥次數
+chara_counters.flush()
@@ -7,4 +7,6 @@ django.setup()
 
 from battle.models import BattleResult
 
-BattleResult.objects.filter(created_at__lt=datetime.now()-timedelta(hours=1)).delete()
+# 只保存重播資料的戰鬥結果體積小，保留較久
+BattleResult.objects.filter(replay__isnull=True, created_at__lt=datetime.now()-timedelta(hours=1)).delete()
+BattleResult.objects.filter(created_at__lt=datetime.now()-timedelta(days=7)).delete()
@@ -64,6 +64,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'chara.middleware.CharaCountersMiddleware',
 ]
 
 ROOT_URLCONF = 'hero.urls'
@@ -197,4 +198,97 @@ CHARA_AVATAR_PATH = os.path.join(os.environ['SFTP_PATH'], 'chara_avatar')
 # time
 ACTION_TIME_GRACE = 3
 
+# battle executor，POOL_SIZE 為 0 時在 ASGI worker 中直接執行戰鬥
+# 等待與執行中的工作達 MAX_PENDING 時拒絕新的戰鬥，為 0 時使用 POOL_SIZE 的兩倍
+BATTLE_EXECUTOR = {
+    'POOL_SIZE': int(os.environ.get('BATTLE_POOL_SIZE') or 0),
+    'TIMEOUT': float(os.environ.get('BATTLE_TIMEOUT') or 10),
+    'MAX_PENDING': int(os.environ.get('BATTLE_MAX_PENDING') or 0),
+}
+
+# 戰鬥模擬的次數上限，只在 process pool 中執行，未啟用 process pool 時不開放
+# 每 TIMES_PER_ACTION 次模擬消耗一次行動時間
+BATTLE_SIMULATION = {
+    'MAX_TIMES': 1000,
+    'TIMES_PER_ACTION': 100,
+}
+
+# 連續多少回合雙方 HP、MP 皆未改變時提前以平手結束，未列出的戰鬥類型執行至回合數上限
+# pvp 與神獸戰的結果取決於結束時的 HP，不偵測
+BATTLE_STALEMATE_WINDOWS = {
+    'pve': 50,
+    'dungeon': 50,
+    'mirror': 50,
+    'ugc_dungeon': 50,
+    'adventure': 50,
+}
+
+# 每隔幾秒檢查一次怪物、NPC 等戰鬥模板的版本
+BATTLE_TEMPLATE_VERSION_CHECK_INTERVAL = 10
+
+# 每隔幾秒檢查一次物品類型與抽選池的版本
+ITEM_TYPE_POOL_VERSION_CHECK_INTERVAL = 10
+
+# 角色的戰鬥次數、任務計數與屬性熟練先累積，每隔 FLUSH_INTERVAL 秒批次寫入資料庫
+# BACKEND 為 redis 時各 process 共用累積值；local 時累積於目前的 process，只適用於單一 process
+CHARA_COUNTERS = {
+    'BACKEND': os.environ.get('CHARA_COUNTERS_BACKEND') or 'redis',
+    'REDIS_URL': f"redis://:{os.environ['REDIS_PASS']}@{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}/1",
+    'FLUSH_INTERVAL': 5,
+    'FLUSH_BATCH_SIZE': 500,
+}
+
+# default 維持 Django 預設的 LocMemCache；聊天用的角色資料快取由各 process 共用，刪除時對所有 process 生效
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "profiles": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": f"redis://:{os.environ['REDIS_PASS']}@{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}/3",
+    },
+}
+
+# 各聊天頻道保留最近 SIZE 則訊息，連線時不需要查詢資料庫
+# BACKEND 為 redis 時各 process 共用；local 時只保存目前 process 發送的訊息，只適用於單一 process
+CHAT_BUFFERS = {
+    'BACKEND': os.environ.get('CHAT_BUFFERS_BACKEND') or 'redis',
+    'REDIS_URL': f"redis://:{os.environ['REDIS_PASS']}@{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}/2",
+    'SIZE': 10,
+}
+
+# 聊天訊息累積後每隔 FLUSH_INTERVAL 秒批次寫入，累積 BATCH_SIZE 則時立即寫入，超過 MAX_PENDING 則時捨棄
+CHAT_WRITER = {
+    'FLUSH_INTERVAL': 0.3,
+    'BATCH_SIZE': 200,
+    'MAX_PENDING': 10000,
+}
+
+# push_log 的紀錄累積後每隔 FLUSH_INTERVAL 秒批次寫入並發送，累積 BATCH_SIZE 筆時立即寫入，超過 MAX_PENDING 筆時捨棄
+LOG_PUBLISHER = {
+    'FLUSH_INTERVAL': 1,
+    'BATCH_SIZE': 500,
+    'MAX_PENDING': 10000,
+}
+
+# 記錄每場戰鬥的耗時與計數，輸出至 battle.metrics logger
+BATTLE_INSTRUMENTATION = (os.environ.get('BATTLE_INSTRUMENTATION') == 'True')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'battle.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
@@ -3,7 +3,7 @@ from django.conf.urls import include
 from rest_framework.routers import SimpleRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from system.views import LogView, ChangeLogView
+from system.views import LogView, ChangeLogView, ChatWriterMetricsView
 from world.views import MoveView, MapView, ElementTypeView
 from user.views import RegistrationView, ChangePasswordView
 from chara.views import (
@@ -42,7 +42,8 @@ from trade.views import (
 )
 from battle.views import (
     BattleMapViewSet, PvPFightView, DungeonFightView, BattleResultViewSet, WorldBossFightView, WorldBossView,
-    ArenaFightView, ArenaView, MirrorFightView, PvPTeamFightView
+    ArenaFightView, ArenaView, MirrorFightView, PvPTeamFightView, BattleSimulationView,
+    BattleMetricsView
 )
 from town.views import InnSleepView, ChangeNameView, AltarSubmitView
 from home.views import CharaFarmExpandView, CharaFarmPlaceItemView, CharaFarmHarvestView, CharaFarmRemoveItemView
@@ -115,6 +116,8 @@ urlpatterns = [
     path('chara/achievement-types/', CharaAchievementTypeView.as_view()),
     path('battle/pvp-fight/', PvPFightView.as_view()),
     path('battle/mirror-fight/', MirrorFightView.as_view()),
+    path('battle/simulate/', BattleSimulationView.as_view()),
+    path('battle/metrics/', BattleMetricsView.as_view()),
     path('battle/pvp-team-fight/', PvPTeamFightView.as_view()),
     path('battle/arenas/', ArenaView.as_view()),
     path('battle/arena-fight/', ArenaFightView.as_view()),
@@ -159,6 +162,7 @@ urlpatterns = [
     path('town/altar/submit/', AltarSubmitView.as_view()),
     path('change-logs/', ChangeLogView.as_view()),
     path('logs/', LogView.as_view()),
+    path('chat/metrics/', ChatWriterMetricsView.as_view()),
     path('trade/lotteries/', LotteryView.as_view()),
     path('trade/lottery/buy/', BuyLotteryView.as_view()),
     path('world-bosses/', WorldBossView.as_view()),
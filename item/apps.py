@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ItemConfig(AppConfig):
     name = 'item'
+
+    def ready(self):
+        from item.signals import connect_signals
+        connect_signals()
@@ -1,7 +1,6 @@
 from random import choices
-from collections import Counter
 
-from django.db import models
+from django.db import models, connection
 from base.models import BaseModel
 
 
@@ -42,14 +41,20 @@ class ItemType(BaseModel):
     description = models.CharField(max_length=100)
 
     def make(self, number):
+        return create_items(self.build(number))
+
+    def build(self, number):
+        """
+        產生尚未寫入資料庫的物品，裝備為 Equipment，需以 create_items 建立
+        """
         # equipment
         if self.category_id == 1:
             return [
-                Equipment.objects.create(
+                Equipment(
                     type=self, number=1, quality=choices(['普通', '優良', '稀有'], weights=[20, 2, 1])[0],
                     element_type=self.element_type, custom_name=self.name,
                     ability_1_id=self.ability_1_id, ability_2_id=self.ability_2_id
-                ).item_ptr
+                )
                 for i in range(number)
             ]
 
@@ -144,23 +149,66 @@ class Equipment(Item):
             return f"{self.quality}的{self.custom_name}"
 
 
+def bulk_create_items(items):
+    """
+    以 bulk_create 建立物品並取得自動產生的 id
+    MySQL 的 bulk_create 不會回傳 id（Django 只在 PostgreSQL、MariaDB 10.5+、SQLite 3.35+ 回傳），在 MySQL 上逐筆建立
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        Item.objects.bulk_create(items)
+    else:
+        for item in items:
+            item.save()
+    return items
+
+
+def bulk_create_equipments(equipments):
+    """
+    先以 bulk_create_items 建立 Item 取得 id，再以 Item 的 id 作為 item_ptr_id 一次寫入所有 Equipment
+    Django 的 bulk_create 不支援多表繼承的子模型，Equipment 自身的欄位以一個 executemany 寫入
+    MySQL 上 Item 逐筆建立，Equipment 仍一次寫入
+    回傳的 Item 已快取對應的 Equipment，讀取名稱或修改裝備時不需再查詢
+    """
+    if not equipments:
+        return []
+
+    items = bulk_create_items([Item(type=x.type, number=x.number) for x in equipments])
+    for equipment, item in zip(equipments, items):
+        assert item.pk is not None
+        for field in Item._meta.concrete_fields:
+            setattr(equipment, field.attname, getattr(item, field.attname))
+        equipment.item_ptr = item
+        Item.equipment.related.set_cached_value(item, equipment)
+
+    fields = Equipment._meta.local_concrete_fields
+    table = connection.ops.quote_name(Equipment._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    with connection.cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", [
+            [field.get_db_prep_save(field.pre_save(equipment, True), connection) for field in fields]
+            for equipment in equipments
+        ])
+    for equipment in equipments:
+        equipment._state.adding = False
+        equipment._state.db = Equipment.objects.db
+    return items
+
+
+def create_items(items):
+    """
+    一次建立 build 產生的所有裝備，回傳對應的 Item；非裝備的物品不寫入資料庫，由 get_items 建立
+    """
+    equipments = iter(bulk_create_equipments([x for x in items if isinstance(x, Equipment)]))
+    return [next(equipments) if isinstance(x, Equipment) else x for x in items]
+
+
 class ItemTypePoolGroup(BaseModel):
     name = models.CharField(max_length=20, unique=True)
 
     def pick(self, n=1):
-        assert n >= 0
-        if n == 0:
-            return []
-
-        members = self.members.all()
-        picked_members = choices(members, weights=[m.weight for m in members], k=n)
-        picked_pools = [x.pool_id for x in picked_members]
-
-        items = []
-        for pool_id, count in Counter(picked_pools).items():
-            items.extend(ItemTypePool.objects.get(id=pool_id).pick(count))
-
-        return items
+        from item.pools import item_type_pools
+        return item_type_pools.pick_group(self.id, n)
 
 
 class ItemTypePoolGroupMember(BaseModel):
@@ -174,19 +222,8 @@ class ItemTypePool(BaseModel):
     name = models.CharField(max_length=20, unique=True)
 
     def pick(self, n=1):
-        assert n >= 0
-        if n == 0:
-            return []
-
-        members = self.members.all()
-        picked_members = choices(members, weights=[m.weight for m in members], k=n)
-        picked_item_types = [x.item_type_id for x in picked_members]
-
-        items = []
-        for item_type_id, count in Counter(picked_item_types).items():
-            items.extend(ItemType.objects.get(id=item_type_id).make(count))
-
-        return items
+        from item.pools import item_type_pools
+        return item_type_pools.pick_pool(self.id, n)
 
 
 class ItemTypePoolMember(BaseModel):
@@ -195,3 +232,10 @@ class ItemTypePoolMember(BaseModel):
     item_type = models.ForeignKey("item.ItemType", on_delete=models.CASCADE)
     number = models.PositiveIntegerField(default=1)
     weight = models.PositiveIntegerField(default=10000)
+
+
+class ItemTypePoolVersion(BaseModel):
+    """
+    物品類型與抽選池的版本，變動時遞增，各 process 據此重新讀取抽選表
+    """
+    version = models.PositiveIntegerField(default=0)
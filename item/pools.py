@@ -0,0 +1,120 @@
+from time import monotonic
+from random import choices
+from itertools import accumulate
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.models import F
+
+from item.models import ItemType, ItemTypePoolGroupMember, ItemTypePoolMember, ItemTypePoolVersion, create_items
+
+
+def get_pool_version():
+    return ItemTypePoolVersion.objects.filter(id=1).values_list('version', flat=True).first() or 0
+
+
+def bump_pool_version():
+    if not ItemTypePoolVersion.objects.filter(id=1).update(version=F('version') + 1):
+        ItemTypePoolVersion.objects.create(id=1, version=1)
+    item_type_pools.checked_at = None
+
+
+class WeightedSampler:
+    """
+    以累積權重二分搜尋抽選，每次抽選為 O(log k)，抽選結果與 choices(population, weights) 相同
+    """
+
+    def __init__(self, population, weights):
+        self.population = population
+        self.cum_weights = list(accumulate(weights))
+
+    def sample(self, n):
+        return choices(self.population, cum_weights=self.cum_weights, k=n)
+
+
+class ItemTypePoolCache:
+    """
+    物品類型與各抽選池、抽選池群組的權重只在重新匯入 fixtures 時變動，每個 process 讀取一次後共用
+    每隔 ITEM_TYPE_POOL_VERSION_CHECK_INTERVAL 秒比對 ItemTypePoolVersion，版本改變時重新讀取
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = None
+        self.item_types = {}
+        self.pools = {}
+        self.groups = {}
+
+    def check_version(self):
+        now = monotonic()
+        if self.checked_at is not None and now - self.checked_at < settings.ITEM_TYPE_POOL_VERSION_CHECK_INTERVAL:
+            return
+
+        version = get_pool_version()
+        if version != self.version:
+            self.load()
+            self.version = version
+        self.checked_at = now
+
+    def load(self):
+        # Equipment 建立時會讀取 element_type，一併讀取
+        item_types = ItemType.objects.select_related('element_type').in_bulk()
+
+        pool_members = defaultdict(list)
+        for member in ItemTypePoolMember.objects.order_by('id'):
+            pool_members[member.pool_id].append(member)
+        group_members = defaultdict(list)
+        for member in ItemTypePoolGroupMember.objects.order_by('id'):
+            group_members[member.group_id].append(member)
+
+        # 整批替換，讀取中的其他執行緒不會看到讀到一半的資料
+        self.item_types = item_types
+        self.pools = {
+            pool_id: WeightedSampler([item_types[x.item_type_id] for x in members], [x.weight for x in members])
+            for pool_id, members in pool_members.items()
+        }
+        self.groups = {
+            group_id: WeightedSampler([x.pool_id for x in members], [x.weight for x in members])
+            for group_id, members in group_members.items()
+        }
+
+    def get_item_type(self, pk):
+        self.check_version()
+        return self.item_types[pk]
+
+    def build_pool(self, pool_id, n):
+        """
+        回傳 build 產生的物品，快取的 ItemType 為共用的物件，只會讀取
+        """
+        picked_item_types = self.pools[pool_id].sample(n)
+
+        items = []
+        for item_type, count in Counter(picked_item_types).items():
+            items.extend(item_type.build(count))
+
+        return items
+
+    def pick_pool(self, pool_id, n=1):
+        assert n >= 0
+        if n == 0:
+            return []
+
+        self.check_version()
+        return create_items(self.build_pool(pool_id, n))
+
+    def pick_group(self, group_id, n=1):
+        assert n >= 0
+        if n == 0:
+            return []
+
+        self.check_version()
+        picked_pools = self.groups[group_id].sample(n)
+
+        items = []
+        for pool_id, count in Counter(picked_pools).items():
+            items.extend(self.build_pool(pool_id, count))
+
+        return create_items(items)
+
+
+item_type_pools = ItemTypePoolCache()
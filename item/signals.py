@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+
+from item.models import ItemType, ItemTypePoolGroupMember, ItemTypePoolMember
+from item.pools import bump_pool_version
+
+# 這些資料變動時（包含 loaddata）遞增抽選池版本，各 process 的 item_type_pools 會重新讀取
+POOL_MODELS = [ItemType, ItemTypePoolGroupMember, ItemTypePoolMember]
+
+
+def pool_changed(sender, **kwargs):
+    bump_pool_version()
+
+
+def connect_signals():
+    for model in POOL_MODELS:
+        post_save.connect(pool_changed, sender=model, dispatch_uid=f'item_type_pool_save_{model.__name__}')
+        post_delete.connect(pool_changed, sender=model, dispatch_uid=f'item_type_pool_delete_{model.__name__}')
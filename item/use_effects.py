@@ -8,7 +8,7 @@ from datetime import timedelta
 from world.models import AttributeType
 from ability.models import Ability
 from battle.models import BattleMap, Monster
-from item.models import ItemTypePoolGroup
+from item.pools import item_type_pools
 from chara.models import BattleMapTicket, CharaBuff, CharaBuffType, CharaPartner, Chara
 from npc.models import NPC
 from base.utils import add_class
@@ -97,8 +97,7 @@ class UseEffect_5(BaseUseEffect):
     id = 5
 
     def execute(self):
-        group = ItemTypePoolGroup.objects.get(id=self.type.use_effect_param)
-        items = group.pick(self.n)
+        items = item_type_pools.pick_group(self.type.use_effect_param, self.n)
 
         self.chara.get_items('bag', items)
         items_name = '、'.join(f'{x.name}*{x.number}' for x in items)
@@ -136,7 +135,7 @@ class UseEffect_7(BaseUseEffect):
         self.chara.save()
 
         self.chara.record.level_down_count += self.n
-        self.chara.record.save()
+        self.chara.record.save(update_fields=['level_down_count'])
 
         return f"使用了{self.n}個{self.type.name}，降低了{self.n}級。"
 
@@ -77,8 +77,9 @@ class ChangeJobSerializer(BaseSerializer):
         chara.job = job
         chara.save()
 
+        # 戰鬥紀錄已加上累積值，只寫入 level_down_count
         chara.record.level_down_count = 0
-        chara.record.save()
+        chara.record.save(update_fields=['level_down_count'])
 
         # 轉職次數
         update_achievement_counter(chara, 1, 1, 'increase')
@@ -31,6 +31,7 @@ class AvailableJobView(BaseGenericAPIView):
 
 class ChangeJobView(CharaPostViewMixin, BaseGenericAPIView):
     serializer_class = ChangeJobSerializer
+    with_chara_counters = True
 
 
 class SetSkillView(CharaPostViewMixin, BaseGenericAPIView):
@@ -0,0 +1,118 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction, IntegrityError
+
+logger = logging.getLogger('system.chat_writer')
+
+
+class ChatWriter:
+    """
+    聊天訊息放入各 model 的緩衝區後立即返回，由背景執行緒每隔 FLUSH_INTERVAL 秒或累積 BATCH_SIZE 則時以 bulk_create 寫入
+    consumer 不需要為每則訊息佔用 database_sync_to_async 的執行緒，超過 MAX_PENDING 則時捨棄新的訊息
+    """
+
+    def __init__(self):
+        self.buffers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flusher = None
+
+        self.pending = 0
+        self.max_pending = 0
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+
+    def enqueue(self, model, **fields):
+        self.start_flusher()
+        with self.lock:
+            if self.pending >= settings.CHAT_WRITER['MAX_PENDING']:
+                self.dropped += 1
+                return
+            self.buffers[model].append(model(**fields))
+            self.pending += 1
+            self.enqueued += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            is_full = self.pending >= settings.CHAT_WRITER['BATCH_SIZE']
+
+        if is_full:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                buffers = self.buffers
+                self.buffers = defaultdict(list)
+
+            for model, messages in buffers.items():
+                try:
+                    model.objects.bulk_create(messages)
+                    written = len(messages)
+                except IntegrityError:
+                    # 一則訊息違反限制時整批失敗，逐筆重試使其他訊息仍能寫入
+                    written = self.write_each(model, messages)
+                except Exception:
+                    # 其他錯誤不重試，計入捨棄的數量
+                    logger.exception("failed to write %d %s", len(messages), model.__name__)
+                    written = 0
+
+                with self.lock:
+                    self.pending -= len(messages)
+                    self.written += written
+                    self.dropped += len(messages) - written
+
+    def write_each(self, model, messages):
+        written = 0
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([message])
+                written += 1
+            except Exception:
+                logger.exception("failed to write %s", model.__name__)
+        return written
+
+    def get_stats(self, reset_max=False):
+        with self.lock:
+            stats = {
+                'pending': self.pending, 'max_pending': self.max_pending,
+                'pending_by_model': {model.__name__: len(messages) for model, messages in self.buffers.items()},
+                'enqueued': self.enqueued, 'written': self.written, 'dropped': self.dropped
+            }
+            if reset_max:
+                self.max_pending = self.pending
+            return stats
+
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, name='chat-writer-flusher', daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+
+    def run_flusher(self):
+        dropped = 0
+        while True:
+            self.wakeup.wait(settings.CHAT_WRITER['FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to write chat messages")
+            finally:
+                close_old_connections()
+
+            if self.dropped > dropped:
+                logger.warning("dropped %d chat messages, stats: %s", self.dropped - dropped, self.get_stats())
+                dropped = self.dropped
+
+
+chat_writer = ChatWriter()
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from datetime import datetime
 
@@ -5,18 +6,33 @@ from django.db.models import Q
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async, SyncToAsync
 
+from chara.models import Chara
 from system.models import PublicChatMessage, CountryChatMessage, TeamChatMessage, PrivateChatMessage, SystemChatMessage
 from system.serializers import (
     PublicChatMessageSerializer, CountryChatMessageSerializer, TeamChatMessageSerializer,
     PrivateChatMessageSerializer, SystemChatMessageSerializer
 )
 from system.utils import get_chara_profile, send_system_message
+from system.message_buffers import message_buffers
+from system.chat_writer import chat_writer
+from system.log_publisher import get_log_group
 from system.chat_utils import system_chan_reply
 
 
 class MessageConsumer(AsyncJsonWebsocketConsumer):
+    # 送出 subscribe 的連線在這段時間內收到的紀錄依時間排序，合併為一則 log_messages
+    log_coalesce_window = 0.2
+    log_categories_limit = 50
+
     async def connect(self):
-        await self.channel_layer.group_add('log', self.channel_name)
+        # 預設訂閱所有類別，每則紀錄分別以 log_message 送出
+        self.log_groups = ['log']
+        self.coalesce_logs = False
+        self.pending_logs = []
+        self.log_flush_task = None
+
+        for group in self.log_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
         for group in self.scope['group_mapping'].values():
             await self.channel_layer.group_add(group, self.channel_name)
 
@@ -24,60 +40,95 @@ class MessageConsumer(AsyncJsonWebsocketConsumer):
         await self.load_messages()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard('log', self.channel_name)
+        if self.log_flush_task is not None:
+            self.log_flush_task.cancel()
+        for group in self.log_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
         for group in self.scope['group_mapping'].values():
             await self.channel_layer.group_discard(group, self.channel_name)
 
     async def receive_json(self, data):
         if data['type'] == 'ping':
             await self.send_json({'type': 'pong'})
+        elif data['type'] == 'subscribe':
+            await self.subscribe_logs(data.get('categories'))
         elif data['type'] == 'chat_message':
             data['content'] = data['content'][:100].strip()
-            await self.save_message(data)
-
             channel = data['channel']
             receiver = data.pop('receiver', None)
 
+            # 私訊的對象不存在時不寫入也不發送，避免整批寫入失敗，並通知發送者
+            if receiver is not None or channel == 'private':
+                data['receiver'] = await self.get_receiver_profile(receiver)
+                if data['receiver'] is None:
+                    await self.send_json({'type': 'info_message', 'message_type': 'error', 'content': "私訊對象不存在"})
+                    return
+
+            self.save_message(data, receiver)
             data['sender'] = await get_chara_profile(self.scope['chara_id'])
             data['created_at'] = datetime.now().isoformat() + 'Z'
-            if receiver is not None:
-                data['receiver'] = await get_chara_profile(receiver)
 
             if channel == 'private' and receiver != self.scope['chara_id']:
                 await self.channel_layer.group_send(f'private_{receiver}', data)
+                await message_buffers.aappend(f'private_{receiver}', data)
             await self.channel_layer.group_send(self.scope['group_mapping'][channel], data)
+            await message_buffers.aappend(self.scope['group_mapping'][channel], data)
 
             if channel == 'public' and data['content'][:4] == '@系統醬':
                 message = await system_chan_reply(data['content'][4:], data['sender'])
                 await SyncToAsync(send_system_message)("系統醬", 1, message)
 
-    @database_sync_to_async
-    def save_message(self, data):
+    async def get_receiver_profile(self, receiver):
+        if not isinstance(receiver, int):
+            return None
+        try:
+            return await get_chara_profile(receiver)
+        except Chara.DoesNotExist:
+            return None
+
+    def save_message(self, data, receiver):
+        # 由 chat_writer 批次寫入，不等待資料庫
         if data['channel'] == 'public':
-            PublicChatMessage.objects.create(sender_id=self.scope['chara_id'], content=data['content'])
+            chat_writer.enqueue(PublicChatMessage, sender_id=self.scope['chara_id'], content=data['content'])
         elif data['channel'] == 'country':
-            CountryChatMessage.objects.create(
+            chat_writer.enqueue(
+                CountryChatMessage,
                 country_id=self.scope['country_id'], sender_id=self.scope['chara_id'], content=data['content']
             )
         elif data['channel'] == 'team':
-            TeamChatMessage.objects.create(
-                team_id=self.scope['team_id'], sender_id=self.scope['chara_id'], content=data['content']
+            chat_writer.enqueue(
+                TeamChatMessage, team_id=self.scope['team_id'], sender_id=self.scope['chara_id'], content=data['content']
             )
         elif data['channel'] == 'private':
-            PrivateChatMessage.objects.create(
-                sender_id=self.scope['chara_id'], receiver_id=data['receiver'], content=data['content']
+            chat_writer.enqueue(
+                PrivateChatMessage,
+                sender_id=self.scope['chara_id'], receiver_id=receiver, content=data['content']
             )
 
     async def load_messages(self):
-        messages = (
-            await self.get_public_chat_messages() + await self.get_country_chat_messages() +
-            await self.get_team_chat_messages() + await self.get_private_chat_messages() +
-            await self.get_system_chat_messages()
-        )
+        # 各頻道的最近訊息同時從 message_buffers 讀取，只有尚未讀取過的頻道查詢資料庫
+        loaders = {
+            'public': self.get_public_chat_messages,
+            'country': self.get_country_chat_messages,
+            'team': self.get_team_chat_messages,
+            'private': self.get_private_chat_messages,
+            'system': self.get_system_chat_messages,
+        }
+        groups = dict(self.scope['group_mapping'], system='system')
+        results = await asyncio.gather(*[self.get_recent_messages(groups[channel], loader)
+                                         for channel, loader in loaders.items()])
+
+        messages = [message for result in results for message in result]
         messages.sort(key=lambda x: x['created_at'])
         for message in messages:
-            message['is_init'] = True
-            await self.send_json(message)
+            await self.send_json(dict(message, is_init=True))
+
+    async def get_recent_messages(self, group, loader):
+        messages = await message_buffers.aget(group)
+        if messages is None:
+            messages = await loader()
+            await message_buffers.aseed(group, messages)
+        return messages
 
     def select_chara_field(self, chara_field, queryset):
         return queryset.select_related(
@@ -128,6 +179,43 @@ class MessageConsumer(AsyncJsonWebsocketConsumer):
     async def log_message(self, event):
         await self.send_json(event)
 
+    async def log_messages(self, event):
+        if not self.coalesce_logs:
+            for log in event['logs']:
+                await self.send_json({'type': 'log_message', **log})
+            return
+
+        # 同一批紀錄依類別分別送達，等待一段時間後依時間排序再送出
+        self.pending_logs.extend(event['logs'])
+        if self.log_flush_task is None:
+            self.log_flush_task = asyncio.ensure_future(self.flush_logs())
+
+    async def flush_logs(self):
+        await asyncio.sleep(self.log_coalesce_window)
+        logs = sorted(self.pending_logs, key=lambda x: x['created_at'])
+        self.pending_logs = []
+        self.log_flush_task = None
+        await self.send_json({'type': 'log_messages', 'logs': logs})
+
+    async def subscribe_logs(self, categories):
+        """
+        categories 為 null 時訂閱所有類別，否則只訂閱列出的類別
+        """
+        if categories is None:
+            groups = ['log']
+        elif isinstance(categories, list) and len(categories) <= self.log_categories_limit and \
+                all(isinstance(x, str) and 0 < len(x) <= 20 for x in categories):
+            groups = list({get_log_group(x) for x in categories})
+        else:
+            return
+
+        for group in set(self.log_groups) - set(groups):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in set(groups) - set(self.log_groups):
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.log_groups = groups
+        self.coalesce_logs = True
+
     async def info_message(self, event):
         await self.send_json(event)
 
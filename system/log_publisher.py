@@ -0,0 +1,148 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import deque, defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+from system.models import Log
+
+logger = logging.getLogger('system.log_publisher')
+
+
+def get_log_group(category):
+    """
+    各類別的紀錄另外發送至 log_<類別的 md5>，群組名稱只能使用英數字且長度有限
+    """
+    return f"log_{hashlib.md5(category.encode()).hexdigest()}"
+
+
+class LogPublisher:
+    """
+    交易成功後將紀錄放入緩衝區，由背景執行緒每隔 FLUSH_INTERVAL 秒批次寫入 Log 並以一則訊息發送至 log 群組
+    緩衝區累積 BATCH_SIZE 筆時由放入的執行緒直接寫入，超過 MAX_PENDING 筆時捨棄新的紀錄
+    訂閱所有類別的連線加入 log 群組，只訂閱部分類別的連線加入各類別的群組
+    """
+
+    def __init__(self):
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+        self.exiting = False
+
+        self.enqueued = 0
+        self.published = 0
+        self.dropped = 0
+
+    def push(self, category, content):
+        self.start_flusher()
+        transaction.on_commit(lambda: self.enqueue(category, content))
+
+    def enqueue(self, category, content):
+        with self.lock:
+            if len(self.buffer) >= settings.LOG_PUBLISHER['MAX_PENDING']:
+                self.dropped += 1
+                return
+            self.buffer.append((category, content))
+            self.enqueued += 1
+            is_full = len(self.buffer) >= settings.LOG_PUBLISHER['BATCH_SIZE']
+
+        # 產生速度超過背景執行緒時，由產生紀錄的執行緒等待寫入
+        if is_full:
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to publish logs")
+
+    def take_batch(self):
+        with self.lock:
+            batch_size = min(len(self.buffer), settings.LOG_PUBLISHER['BATCH_SIZE'])
+            return [self.buffer.popleft() for _ in range(batch_size)]
+
+    def flush(self):
+        """
+        寫入並發送緩衝區中的所有紀錄，同時只有一個執行緒寫入，維持紀錄的順序
+        """
+        with self.flush_lock:
+            while True:
+                batch = self.take_batch()
+                if not batch:
+                    return
+
+                # 失敗的一批不重試，計入捨棄的數量
+                try:
+                    logs = Log.objects.bulk_create([
+                        Log(category=category, content=content) for category, content in batch
+                    ])
+                    messages = [
+                        {'category': log.category, 'content': log.content, 'created_at': log.created_at.isoformat()}
+                        for log in logs
+                    ]
+                    self.send('log', {'type': 'log_messages', 'logs': messages})
+
+                    messages_by_category = defaultdict(list)
+                    for message in messages:
+                        messages_by_category[message['category']].append(message)
+                    for category, category_messages in messages_by_category.items():
+                        self.send(get_log_group(category), {'type': 'log_messages', 'logs': category_messages})
+                except Exception:
+                    with self.lock:
+                        self.dropped += len(batch)
+                    raise
+                with self.lock:
+                    self.published += len(logs)
+
+    def send(self, group, message):
+        layer = get_channel_layer()
+        if self.exiting:
+            # 程式結束時 async_to_sync 使用的執行緒池已關閉，直接建立 event loop 發送
+            asyncio.run(layer.group_send(group, message))
+        else:
+            async_to_sync(layer.group_send)(group, message)
+
+    def flush_at_exit(self):
+        self.exiting = True
+        self.flush()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.buffer), 'enqueued': self.enqueued,
+                'published': self.published, 'dropped': self.dropped
+            }
+
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, name='log-publisher-flusher', daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush_at_exit)
+
+    def run_flusher(self):
+        dropped = 0
+        while True:
+            time.sleep(settings.LOG_PUBLISHER['FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to publish logs")
+            finally:
+                close_old_connections()
+
+            stats = self.get_stats()
+            if stats['dropped'] > dropped:
+                logger.warning("dropped %d logs, stats: %s", stats['dropped'] - dropped, stats)
+                dropped = stats['dropped']
+
+
+log_publisher = LogPublisher()
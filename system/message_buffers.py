@@ -0,0 +1,149 @@
+import json
+import threading
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+def get_message_key(message):
+    sender = message.get('sender')
+    return message.get('channel'), sender['id'] if sender else message.get('sender_name'), message.get('content')
+
+
+def get_older_messages(messages, newer):
+    """
+    從資料庫讀取的訊息中排除讀取期間已加入緩衝區的訊息，合併時放在緩衝區的訊息之前
+    """
+    keys = {get_message_key(x) for x in newer}
+    return [x for x in messages if get_message_key(x) not in keys]
+
+
+class LocalMessageBuffers:
+    """
+    保存於目前 process 的最近訊息，其他 process 發送的訊息不會加入，只適用於單一 process 的部署與開發環境
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.seeded = set()
+
+    def append(self, key, message):
+        with self.lock:
+            if key not in self.buffers:
+                self.buffers[key] = deque(maxlen=self.size)
+            self.buffers[key].append(message)
+
+    async def aappend(self, key, message):
+        self.append(key, message)
+
+    async def aseed(self, key, messages):
+        with self.lock:
+            if key not in self.seeded:
+                newer = list(self.buffers.get(key, []))
+                self.buffers[key] = deque(get_older_messages(messages, newer) + newer, maxlen=self.size)
+                self.seeded.add(key)
+
+    async def aget(self, key):
+        with self.lock:
+            if key in self.seeded:
+                return list(self.buffers[key])
+
+
+class RedisMessageBuffers:
+    """
+    每個頻道的最近訊息以 JSON 存於一個 list，只保留最後 size 則，各 process 共用
+    seeded key 記錄已從資料庫讀取過的頻道，沒有 seeded key 的頻道視為尚未讀取
+    seeding key 確保同時只有一個連線將資料庫的訊息合併至 list
+    只使用一個同步的 redis client，async 方法在執行緒池中執行
+    """
+    prefix = 'chat_buffer:'
+    seeded_prefix = 'chat_buffer_seeded:'
+    seeding_prefix = 'chat_buffer_seeding:'
+    seeding_timeout = 10
+
+    def __init__(self, url, size):
+        import redis
+        self.size = size
+        self.client = redis.Redis.from_url(url)
+
+    def append(self, key, message):
+        pipe = self.client.pipeline()
+        pipe.rpush(f'{self.prefix}{key}', json.dumps(message, ensure_ascii=False))
+        pipe.ltrim(f'{self.prefix}{key}', -self.size, -1)
+        pipe.execute()
+
+    async def aappend(self, key, message):
+        await sync_to_async(self.append, thread_sensitive=False)(key, message)
+
+    def seed(self, key, messages):
+        # 其他連線正在合併時不重複寫入
+        if not self.client.set(f'{self.seeding_prefix}{key}', 1, ex=self.seeding_timeout, nx=True):
+            return
+        try:
+            if self.client.exists(f'{self.seeded_prefix}{key}'):
+                return
+
+            # 讀取期間加入的訊息保留在 list 尾端，資料庫的訊息由前端插入
+            newer = [json.loads(x) for x in self.client.lrange(f'{self.prefix}{key}', 0, -1)]
+            older = get_older_messages(messages, newer)[-self.size:]
+            pipe = self.client.pipeline()
+            if older:
+                pipe.lpush(f'{self.prefix}{key}', *[json.dumps(x, ensure_ascii=False) for x in older[::-1]])
+                pipe.ltrim(f'{self.prefix}{key}', -self.size, -1)
+            pipe.set(f'{self.seeded_prefix}{key}', 1)
+            pipe.execute()
+        finally:
+            self.client.delete(f'{self.seeding_prefix}{key}')
+
+    async def aseed(self, key, messages):
+        await sync_to_async(self.seed, thread_sensitive=False)(key, messages)
+
+    def get(self, key):
+        pipe = self.client.pipeline()
+        pipe.exists(f'{self.seeded_prefix}{key}')
+        pipe.lrange(f'{self.prefix}{key}', 0, -1)
+        seeded, messages = pipe.execute()
+        if seeded:
+            return [json.loads(x) for x in messages]
+
+    async def aget(self, key):
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+
+class MessageBuffers:
+    """
+    各聊天頻道的最近訊息，以頻道的群組名稱為 key，發送訊息時加入，連線時讀取而不需要查詢資料庫
+    頻道第一次讀取時由呼叫者從資料庫讀取並以 aseed 寫入
+    """
+
+    def __init__(self):
+        self.store = None
+        self.lock = threading.Lock()
+
+    def get_store(self):
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    if settings.CHAT_BUFFERS['BACKEND'] == 'redis':
+                        self.store = RedisMessageBuffers(settings.CHAT_BUFFERS['REDIS_URL'], settings.CHAT_BUFFERS['SIZE'])
+                    else:
+                        self.store = LocalMessageBuffers(settings.CHAT_BUFFERS['SIZE'])
+        return self.store
+
+    def append(self, key, message):
+        self.get_store().append(key, message)
+
+    async def aappend(self, key, message):
+        await self.get_store().aappend(key, message)
+
+    async def aseed(self, key, messages):
+        await self.get_store().aseed(key, messages)
+
+    async def aget(self, key):
+        return await self.get_store().aget(key)
+
+
+message_buffers = MessageBuffers()
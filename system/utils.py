@@ -1,13 +1,26 @@
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.connection import ConnectionProxy
 from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
 
 from asset.models import Image
 from chara.models import Chara
-from system.models import Log, PrivateChatMessage, SystemChatMessage
+from system.models import PrivateChatMessage, SystemChatMessage
+from system.log_publisher import log_publisher
+from system.message_buffers import message_buffers
 
+CHARA_PROFILE_CACHE_TIMEOUT = 60 * 60
+# 與 django.core.cache.cache 相同，每個執行緒使用各自的連線
+profile_cache = ConnectionProxy(caches, 'profiles')
 
-def get_chara_profile_sync(chara_id):
+
+def get_chara_profile_cache_key(chara_id):
+    return f"chara_profile:{chara_id}"
+
+
+def load_chara_profile(chara_id):
     profile = Chara.objects.values(
         'id', 'avatar_version', 'name', 'country__name', 'official__title', 'title__type__name',
         'custom_title__name', 'custom_title__color', 'custom_title__due_time'
@@ -20,16 +33,34 @@ def get_chara_profile_sync(chara_id):
     return profile
 
 
-get_chara_profile = database_sync_to_async(get_chara_profile_sync)
+def get_chara_profile_sync(chara_id):
+    cache_key = get_chara_profile_cache_key(chara_id)
+    profile = profile_cache.get(cache_key)
+    if profile is None:
+        profile = load_chara_profile(chara_id)
+        profile_cache.set(cache_key, profile, CHARA_PROFILE_CACHE_TIMEOUT)
+    return profile
+
+
+async def get_chara_profile(chara_id):
+    cache_key = get_chara_profile_cache_key(chara_id)
+    profile = await profile_cache.aget(cache_key)
+    if profile is None:
+        profile = await database_sync_to_async(load_chara_profile)(chara_id)
+        await profile_cache.aset(cache_key, profile, CHARA_PROFILE_CACHE_TIMEOUT)
+    return profile
+
+
+def invalidate_chara_profile(chara_id):
+    """
+    名稱、頭像、國家、官職、稱號改變時呼叫，交易成功後才刪除快取，避免其他請求在交易完成前重新快取舊的資料
+    """
+    transaction.on_commit(lambda: profile_cache.delete(get_chara_profile_cache_key(chara_id)))
 
 
 def push_log(category, content):
-    log = Log.objects.create(category=category, content=content)
-    layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
-        'log',
-        {'type': 'log_message', 'category': category, 'content': content, 'created_at': log.created_at.isoformat()}
-    )
+    # 交易成功後才寫入並發送，由 log_publisher 批次處理
+    log_publisher.push(category, content)
 
 
 def send_private_message_by_system(sender_id, receiver_id, content):
@@ -43,6 +74,9 @@ def send_private_message_by_system(sender_id, receiver_id, content):
     layer = get_channel_layer()
     for chara_id in [sender_id, receiver_id]:
         async_to_sync(layer.group_send)(f'private_{chara_id}', data)
+    # 交易失敗時訊息不會寫入資料庫，也不加入最近訊息
+    for chara_id in {sender_id, receiver_id}:
+        transaction.on_commit(lambda key=f'private_{chara_id}': message_buffers.append(key, data))
 
 
 def send_system_message(sender_name, avatar_id, content):
@@ -55,6 +89,7 @@ def send_system_message(sender_name, avatar_id, content):
 
     layer = get_channel_layer()
     async_to_sync(layer.group_send)(f'public', data)
+    transaction.on_commit(lambda: message_buffers.append('system', data))
 
 
 def send_refresh_chara_profile_signal(chara_id):
@@ -1,10 +1,12 @@
 from base.views import BaseGenericAPIView, CharaPostViewMixin
 from rest_framework.response import Response
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.mixins import ListModelMixin
 from rest_framework.filters import SearchFilter
 
 from system.models import Log, ChangeLog
 from system.serializers import LogSerializer, ChangeLogSerializer
+from system.chat_writer import chat_writer
 
 
 class ChangeLogView(ListModelMixin, BaseGenericAPIView):
@@ -30,3 +32,10 @@ class LogView(ListModelMixin, BaseGenericAPIView):
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
+
+
+class ChatWriterMetricsView(BaseGenericAPIView):
+    def get(self, request):
+        if not request.user.is_gm:
+            raise PermissionDenied("權限不足")
+        return Response(chat_writer.get_stats(reset_max=True))
@@ -5,6 +5,7 @@ from base.serializers import BaseSerializer, BaseModelSerializer, SerpyModelSeri
 from battle.models import Dungeon
 from chara.models import Chara
 from item.models import Item
+from item.pools import item_type_pools
 from team.models import Team, TeamJoinRequest, TeamDungeonRecord
 from battle.serializers import DungeonSerializer
 from chara.serializers import CharaSimpleSerializer
@@ -203,7 +204,7 @@ class TeamDungeonTerminateSerializer(BaseSerializer):
         if not dungeon.is_infinite or record.current_floor - record.start_floor >= 5:
             gold += dungeon.gold_reward_per_floor * record.current_floor
             for reward in dungeon.rewards.all():
-                loots.extend(reward.group.pick(record.current_floor // reward.divisor * reward.number))
+                loots.extend(item_type_pools.pick_group(reward.group_id, record.current_floor // reward.divisor * reward.number))
 
         if not loots and not gold:
             reward_message = "一些……嗯……寶貴的探索體驗"
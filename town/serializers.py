@@ -9,7 +9,7 @@ from item.models import Item
 from chara.models import Chara, CharaPartner
 
 from chara.achievement import update_achievement_counter
-from system.utils import push_log
+from system.utils import push_log, invalidate_chara_profile
 
 
 class TownSerializer(SerpyModelSerializer):
@@ -53,6 +53,7 @@ class ChangeNameSerializer(BaseSerializer):
         if kind == 'chara':
             orig_name = self.chara.name
             self.chara.name = name
+            invalidate_chara_profile(self.chara.id)
             message = f"{orig_name}改名為{name}"
 
             # 角色改名次數
@@ -16,7 +16,8 @@ from trade.models import (
     Auction, Sale, Purchase, ExchangeOption, ExchangeOptionRequirement, StoreOption, Lottery, LotteryTicket,
     Parcel
 )
-from item.models import Item, ItemTypePoolGroup
+from item.models import Item
+from item.pools import item_type_pools
 
 from chara.achievement import update_achievement_counter
 from system.utils import push_log, send_private_message_by_system
@@ -476,7 +477,7 @@ class MemberShopBuyLevelDownSerializer(BaseSerializer):
         self.chara.save()
 
         self.chara.record.level_down_count += number
-        self.chara.record.save()
+        self.chara.record.save(update_fields=['level_down_count'])
 
         return {'display_message': f'已降低了{number}級'}
 
@@ -494,10 +495,7 @@ class MemberShopBuyPetSerializer(BaseSerializer):
     def save(self):
         number = self.validated_data['number']
 
-        items = []
-        group = ItemTypePoolGroup.objects.get(id=13)
-        for i in range(number):
-            items.extend(group.pick())
+        items = item_type_pools.pick_group(13, number)
 
         self.chara.get_items('bag', items)
         self.chara.lose_member_point(25 * number)
@@ -6,9 +6,9 @@ from ugc.models import (
     UGCDungeon, UGCDungeonFloor, UGCDungeonFloorMonster,
     CharaUGCDungeonRecord
 )
-from battle.models import BattleResult
 
 from battle.battle import Battle
+from battle.utils import create_battle_result
 from system.utils import push_log
 
 
@@ -77,6 +77,6 @@ class CharaUGCDungeonFightSerializer(BaseSerializer):
         self.chara.set_next_action_time()
         self.chara.save()
 
-        BattleResult.objects.create(title=f"{self.chara.name}-{dungeon.name}-{floor_number}層", content=result)
+        create_battle_result(f"{self.chara.name}-{dungeon.name}-{floor_number}層", result, battle)
 
         return result